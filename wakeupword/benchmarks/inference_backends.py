@@ -0,0 +1,70 @@
+import os
+import sys
+import json
+import time
+import numpy as np
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import src.config as cfg
+from src.detector import AUDIO_CONTEXT_SMPL, STEP_SMPL, MEL_WINDOW_FRAMES
+from src.features import EMBEDDING_INPUT_FRAMES
+from src.inference import load_model, BACKENDS, BENCHMARK_FILE
+
+# Measures the melspectrogram and embedding models with each backend and number of threads, for the
+# batch usage (feature extraction in 04.generate.py) and the streaming usage (single detection step).
+# The fastest configurations are written to BENCHMARK_FILE and used when inference.backend is 'auto'.
+# Threads are measured in a single process, with several generation workers they are divided among them.
+
+MIN_SECONDS = 2.0
+THREADS = sorted({1, 2, 4, os.cpu_count() or 1})
+
+batch = cfg.generation.feature_batch_size
+shapes = {
+    'batch': {
+        'melspectrogram': [batch, cfg.INPUT_WINDOW_LENGTH_MS * cfg.SAMPLES_PER_MS],
+        'embedding_model': [batch * cfg.EMBEDDINGS_COUNT, EMBEDDING_INPUT_FRAMES, cfg.MEL_FREQUENCY_VALUES, 1],
+    },
+    'streaming': {
+        'melspectrogram': [1, AUDIO_CONTEXT_SMPL + STEP_SMPL],
+        'embedding_model': [1, MEL_WINDOW_FRAMES, cfg.MEL_FREQUENCY_VALUES, 1],
+    },
+}
+# Number of processed units (windows or steps) in a single run of the models
+units = {'batch': batch, 'streaming': 1}
+
+
+def measure(usage: str, backend: str, threads: int) -> float:
+    # Returns time in milliseconds of one run of both models
+    models = [load_model(name, shape, usage, backend, threads) for name, shape in shapes[usage].items()]
+    generator = np.random.default_rng(0)
+    for model in models:
+        model(generator.standard_normal(model.input().shape).astype(np.float32) * 0.1)
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < MIN_SECONDS:
+        for model in models:
+            model.run()
+        count += 1
+    return (time.perf_counter() - start) / count * 1000
+
+
+results = []
+for usage in shapes:
+    for backend in BACKENDS:
+        for threads in THREADS:
+            try:
+                run_ms = measure(usage, backend, threads)
+            except (ImportError, ValueError) as ex:
+                print(f'{usage:<10} {backend:<7} skipped: {ex}')
+                break
+            results.append({'usage': usage, 'backend': backend, 'threads': threads, 'run_ms': run_ms, 'unit_ms': run_ms / units[usage]})
+            print(f'{usage:<10} {backend:<7} {threads:>2} threads: {run_ms:9.3f} ms per run, {run_ms / units[usage]:8.3f} ms per {"window" if usage == "batch" else "step"}')
+
+best = {}
+for usage in shapes:
+    fastest = min((item for item in results if item['usage'] == usage), key=lambda item: item['unit_ms'])
+    best[usage] = {'backend': fastest['backend'], 'threads': fastest['threads']}
+    print(f'Fastest for {usage}: {fastest["backend"]} with {fastest["threads"]} threads')
+
+with open(BENCHMARK_FILE, 'w', encoding='utf-8') as f:
+    json.dump({'best': best, 'results': results}, f, indent=4)
+print(f'Results written to {BENCHMARK_FILE}')
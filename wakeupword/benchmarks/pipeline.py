@@ -0,0 +1,201 @@
+import os
+import sys
+import json
+import time
+import random
+import platform
+from pathlib import Path
+import numpy as np
+import numpy.typing as npt
+import torch
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import src.config as cfg
+from src.corpus import Corpus
+from src.augmentation import BatchAugmenter
+from src.features import FeatureExtractor
+from src.head_model import SharedLinearNet, head_model_input_size
+from src.embedding_augmentation import EmbeddingAugmenter
+from src.detector import StreamingDetector, STEP_SMPL, AUDIO_CONTEXT_SMPL, MEL_WINDOW_FRAMES
+from src.inference import load_model, select_backend
+
+# Throughput and latency of the main parts of the pipeline on synthetic audio, so it runs offline and
+# gives the same input on every machine:
+#   features   - windows per second of FeatureExtractor.get_features (04.generate.py) for several batch sizes
+#   augment    - windows per second of BatchAugmenter.apply (04.generate.py)
+#   train      - samples per second of a training step of the head model (05.train.py)
+#   streaming  - per-step latency and real-time factor of StreamingDetector (06.check.py), with and without the gate
+# Results with the configuration are written as JSON to the path given as the argument or to DATA_DIR/benchmarks.
+
+MIN_SECONDS = 2.0
+MIN_RUNS = 5
+FEATURE_BATCH_SIZES = sorted({1, 8, cfg.generation.feature_batch_size, 64})
+# Synthetic background sounds and impulse responses for the augmentation
+BACKGROUND_COUNT = 16
+BACKGROUND_SECONDS = 5
+IMPULSE_RESPONSE_COUNT = 16
+IMPULSE_RESPONSE_SECONDS = 0.5
+STREAMING_SECONDS = 60
+# Synthetic audio has speech-like sounds in the first seconds of each period, the rest is quiet
+PERIOD_SECONDS = 6
+SPEECH_SECONDS = 2
+
+window_smpl = cfg.INPUT_WINDOW_LENGTH_MS * cfg.SAMPLES_PER_MS
+generator = np.random.default_rng(0)
+
+
+def synthetic_audio(samples: int) -> npt.NDArray[np.float32]:
+    # Quiet noise with louder harmonic bursts (about 0.3 s long) in the first SPEECH_SECONDS of every
+    # PERIOD_SECONDS, roughly like speech with pauses in a room
+    audio = generator.standard_normal(samples) * 0.003
+    time_axis = np.arange(samples) / cfg.SAMPLE_RATE
+    for start in range(0, samples, cfg.SAMPLE_RATE // 2):
+        if start / cfg.SAMPLE_RATE % PERIOD_SECONDS >= SPEECH_SECONDS or generator.random() < 0.3:
+            continue
+        length = min(samples - start, int(generator.uniform(0.15, 0.45) * cfg.SAMPLE_RATE))
+        pitch = generator.uniform(90, 250)
+        burst = sum(np.sin(2 * np.pi * pitch * harmonic * time_axis[start:start + length]) / harmonic for harmonic in range(1, 6))
+        audio[start:start + length] += burst * np.hanning(length) * generator.uniform(0.05, 0.3)
+    return np.clip(audio, -1, 1).astype(np.float32)
+
+
+def synthetic_corpus(count: int, samples: int, decay_smpl: float = 0) -> Corpus:
+    # Recordings of noise, exponentially decaying if decay_smpl is given (like impulse responses)
+    data = generator.standard_normal((count, samples)) * 0.1
+    if decay_smpl > 0:
+        data *= np.exp(-np.arange(samples) / decay_smpl)
+        data[:, 0] = 1
+    data = (np.clip(data, -1, 1) * 32767).astype(np.int16).reshape(-1)
+    lengths = np.full(count, samples, dtype=np.int64)
+    return Corpus(data, np.array([f'{index}.wav' for index in range(count)], dtype=np.str_), np.arange(count, dtype=np.int64) * samples, lengths)
+
+
+def measure(function) -> npt.NDArray[np.float64]:
+    # Durations (in seconds) of the calls after a warm-up call, at least MIN_SECONDS and MIN_RUNS in total
+    function()
+    durations = []
+    start = time.perf_counter()
+    while time.perf_counter() - start < MIN_SECONDS or len(durations) < MIN_RUNS:
+        begin = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - begin)
+    return np.array(durations)
+
+
+def latency(durations: npt.NDArray[np.float64]) -> dict[str, float]:
+    return {
+        'mean_ms': float(durations.mean() * 1000),
+        'p50_ms': float(np.percentile(durations, 50) * 1000),
+        'p90_ms': float(np.percentile(durations, 90) * 1000),
+        'p99_ms': float(np.percentile(durations, 99) * 1000),
+        'max_ms': float(durations.max() * 1000),
+    }
+
+
+def benchmark_features() -> list[dict]:
+    results = []
+    for batch_size in FEATURE_BATCH_SIZES:
+        extractor = FeatureExtractor(batch_size)
+        windows = np.stack([synthetic_audio(window_smpl) for _ in range(batch_size)])
+        durations = measure(lambda: extractor.get_features(windows))
+        results.append({'batch_size': batch_size, 'windows_per_second': batch_size / durations.mean(), **latency(durations)})
+        print(f'features   batch {batch_size:>4}: {results[-1]["windows_per_second"]:10.1f} windows/s')
+    return results
+
+
+def benchmark_augment() -> dict:
+    batch_size = cfg.generation.feature_batch_size
+    background = synthetic_corpus(BACKGROUND_COUNT, BACKGROUND_SECONDS * cfg.SAMPLE_RATE)
+    impulse_responses = synthetic_corpus(IMPULSE_RESPONSE_COUNT, int(IMPULSE_RESPONSE_SECONDS * cfg.SAMPLE_RATE), 0.05 * cfg.SAMPLE_RATE)
+    augmenter = BatchAugmenter(batch_size, window_smpl, background, impulse_responses)
+    source = np.stack([synthetic_audio(window_smpl) for _ in range(batch_size)])
+    windows = np.empty_like(source)
+    random.seed(0)
+    def run():
+        # New random parameters for each batch, as in the generation
+        windows[:] = source
+        for row in range(batch_size):
+            augmenter.draw(row)
+        augmenter.apply(windows)
+    durations = measure(run)
+    result = {'batch_size': batch_size, 'windows_per_second': batch_size / durations.mean(), **latency(durations)}
+    print(f'augment    batch {batch_size:>4}: {result["windows_per_second"]:10.1f} windows/s')
+    return result
+
+
+def benchmark_train() -> dict:
+    batch_size = cfg.training.batch_size
+    if cfg.training.threads > 0:
+        torch.set_num_threads(cfg.training.threads)
+    torch.manual_seed(0)
+    model = SharedLinearNet()
+    criterion = torch.nn.BCEWithLogitsLoss(pos_weight=torch.tensor([cfg.training.positive_weight]))
+    optimizer = torch.optim.Adam(model.parameters(), lr=cfg.training.base_learning_rate)
+    augment = EmbeddingAugmenter()
+    x = torch.randn(batch_size, head_model_input_size)
+    y = (torch.rand(batch_size, len(cfg.KEYWORDS)) < 0.3).float()
+    def step():
+        # The same step as in 05.train.py
+        optimizer.zero_grad(set_to_none=True)
+        loss = criterion(model(augment(x, y)), y)
+        loss.backward()
+        optimizer.step()
+    durations = measure(step)
+    result = {'batch_size': batch_size, 'threads': torch.get_num_threads(), 'samples_per_second': batch_size / durations.mean(), **latency(durations)}
+    print(f'train      batch {batch_size:>4}: {result["samples_per_second"]:10.1f} samples/s')
+    return result
+
+
+def benchmark_streaming() -> list[dict]:
+    melspectrogram = load_model('melspectrogram', [1, AUDIO_CONTEXT_SMPL + STEP_SMPL], 'streaming')
+    embedding = load_model('embedding_model', [1, MEL_WINDOW_FRAMES, cfg.MEL_FREQUENCY_VALUES, 1], 'streaming')
+    torch.manual_seed(0)
+    model = SharedLinearNet().eval()
+    def head(features: npt.NDArray[np.float32]) -> npt.NDArray[np.float32]:
+        with torch.no_grad():
+            return model(torch.from_numpy(features)).numpy()
+    audio = synthetic_audio(STREAMING_SECONDS * cfg.SAMPLE_RATE)
+    steps = audio.shape[0] // STEP_SMPL
+    results = []
+    for vad in (False, True):
+        detector = StreamingDetector(melspectrogram, embedding, head, vad=vad)
+        # Warm-up on the first second, so the buffers are full
+        detector.process(audio[:cfg.SAMPLE_RATE])
+        warmup_runs = detector.embedding_runs
+        durations = np.empty(steps)
+        for step in range(steps):
+            begin = time.perf_counter()
+            detector.process(audio[step * STEP_SMPL:(step + 1) * STEP_SMPL])
+            durations[step] = time.perf_counter() - begin
+        results.append({
+            'vad': vad,
+            'steps': steps,
+            'embedding_runs': detector.embedding_runs - warmup_runs,
+            'real_time_factor': float(durations.sum() / (steps * STEP_SMPL / cfg.SAMPLE_RATE)),
+            **latency(durations),
+        })
+        print(f'streaming  vad {"on " if vad else "off"}: {results[-1]["p50_ms"]:8.3f} ms median step, '
+              f'{results[-1]["p99_ms"]:8.3f} ms p99, real-time factor {results[-1]["real_time_factor"]:.4f}')
+    return results
+
+
+if __name__ == '__main__':
+    path = Path(sys.argv[1]) if len(sys.argv) > 1 else cfg.DATA_DIR / 'benchmarks' / f'pipeline-{time.strftime("%Y%m%d-%H%M%S")}.json'
+    results = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'machine': {'platform': platform.platform(), 'processor': platform.processor(), 'cpus': os.cpu_count(), 'python': platform.python_version()},
+        'config': {
+            'backend': {usage: select_backend(usage) for usage in ('batch', 'streaming')},
+            'INPUT_WINDOW_LENGTH_MS': cfg.INPUT_WINDOW_LENGTH_MS,
+            'EMBEDDINGS_COUNT': cfg.EMBEDDINGS_COUNT,
+            'EMBEDDINGS_WINDOW_DEVISABLE_BY': cfg.EMBEDDINGS_WINDOW_DEVISABLE_BY,
+            'KEYWORDS': [keyword.name for keyword in cfg.KEYWORDS],
+        },
+        'features': benchmark_features(),
+        'augment': benchmark_augment(),
+        'train': benchmark_train(),
+        'streaming': benchmark_streaming(),
+    }
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=4)
+    print(f'Results written to {path}')
@@ -0,0 +1,98 @@
+import os
+import sys
+import time
+import numpy as np
+import numpy.typing as npt
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import src.config as cfg
+from src.audio import fade, copy_range, assemble_window
+
+# Microbenchmark of the positive window assembly (cutting, fading and gluing) from 04.generate.py.
+# Loudness normalization and augmentations are not included, they are the same in both versions.
+
+ITERATIONS = 2000
+
+total_smpl = cfg.INPUT_WINDOW_LENGTH_MS * cfg.SAMPLES_PER_MS
+fade_smpl = 2 * cfg.MEL_WINDOW_LENGTH_MS * cfg.SAMPLES_PER_MS
+
+# ===== Previous implementation =====
+
+def fade_before(data: npt.NDArray[np.float32], direction: float) -> None:
+    step = 1 / data.shape[0] * direction
+    start = 0 if step > 0 else 1
+    for i in range(data.shape[0]):
+        start += step
+        data[i] *= start
+
+def assemble_before(data, begin_smpl, end_smpl, prepend_source, append_source, prepend_smpl, append_smpl):
+    length_smpl = end_smpl - begin_smpl
+    if begin_smpl < fade_smpl:
+        data = np.pad(data[0:end_smpl + fade_smpl], (fade_smpl - begin_smpl, 0), mode='constant', constant_values=0)
+        end_smpl += fade_smpl - begin_smpl
+        begin_smpl += fade_smpl - begin_smpl
+    if data.shape[0] - end_smpl < fade_smpl:
+        data = np.pad(data[begin_smpl - fade_smpl:], (0, fade_smpl - (data.shape[0] - end_smpl)), mode='constant', constant_values=0)
+        end_smpl -= begin_smpl - fade_smpl
+        begin_smpl -= begin_smpl - fade_smpl
+    data = data[begin_smpl - fade_smpl:end_smpl + fade_smpl].copy()
+    fade_before(data[:fade_smpl], 1)
+    fade_before(data[-fade_smpl:], -1)
+    prepend_data = prepend_source[:prepend_smpl].astype(np.float32) / 32767
+    append_data = append_source[:append_smpl].astype(np.float32) / 32767
+    fade_before(prepend_data[-fade_smpl:], -1)
+    fade_before(append_data[:fade_smpl], 1)
+    result = np.zeros(total_smpl, dtype=np.float32)
+    result[prepend_smpl - fade_smpl:prepend_smpl + length_smpl + fade_smpl] = data
+    result[:prepend_smpl] += prepend_data
+    result[prepend_smpl + length_smpl:] += append_data
+    return result
+
+# ===== Current implementation =====
+
+window_buffer = np.zeros(total_smpl, dtype=np.float32)
+word_buffer = np.zeros((cfg.MAX_WORD_LENGTH_MS + 4 * cfg.MEL_WINDOW_LENGTH_MS) * cfg.SAMPLES_PER_MS, dtype=np.float32)
+prepend_buffer = np.zeros(total_smpl, dtype=np.float32)
+append_buffer = np.zeros(total_smpl, dtype=np.float32)
+
+def assemble_after(data, begin_smpl, end_smpl, prepend_source, append_source, prepend_smpl, append_smpl):
+    word = copy_range(data, begin_smpl - fade_smpl, end_smpl + fade_smpl, word_buffer)
+    fade(word[:fade_smpl], 1)
+    fade(word[-fade_smpl:], -1)
+    prepend_data = np.divide(prepend_source[:prepend_smpl], np.float32(32767), out=prepend_buffer[:prepend_smpl])
+    append_data = np.divide(append_source[:append_smpl], np.float32(32767), out=append_buffer[:append_smpl])
+    fade(prepend_data[-fade_smpl:], -1)
+    fade(append_data[:fade_smpl], 1)
+    assemble_window(window_buffer, prepend_data, word, append_data, fade_smpl)
+    return window_buffer
+
+# ===== Benchmark =====
+
+def make_cases(count: int) -> list[tuple]:
+    rng = np.random.default_rng(0)
+    data = rng.uniform(-0.5, 0.5, 60 * cfg.SAMPLE_RATE).astype(np.float32)
+    negative = (rng.uniform(-0.5, 0.5, 2 * total_smpl) * 32767).astype(np.int16)
+    cases = []
+    for i in range(count):
+        length_smpl = int(rng.integers(cfg.MIN_WORD_LENGTH_MS, cfg.MAX_WORD_LENGTH_MS) * cfg.SAMPLES_PER_MS)
+        # Some words at the edges of the recording to cover the padding
+        begin_smpl = int(rng.integers(0, data.shape[0] - length_smpl)) if i % 10 else (i % 20) * 100
+        prepend_smpl = cfg.WORD_PREFIX_LENGTH_MS * cfg.SAMPLES_PER_MS + cfg.MAX_WORD_LENGTH_MS * cfg.SAMPLES_PER_MS - length_smpl
+        prepend_smpl -= int(rng.integers(0, cfg.WORD_SHIFT_LENGTH_MS * cfg.SAMPLES_PER_MS))
+        append_smpl = total_smpl - prepend_smpl - length_smpl
+        cases.append((data, begin_smpl, begin_smpl + length_smpl, negative, negative[total_smpl:], prepend_smpl, append_smpl))
+    return cases
+
+def measure(function, cases) -> float:
+    start = time.perf_counter()
+    for case in cases:
+        function(*case)
+    return len(cases) / (time.perf_counter() - start)
+
+cases = make_cases(ITERATIONS)
+max_error = max(np.abs(assemble_before(*case) - assemble_after(*case)).max() for case in cases[:100])
+print(f'Maximum difference: {max_error:.2e}')
+before = measure(assemble_before, cases)
+after = measure(assemble_after, cases)
+print(f'Before: {before:10.1f} samples/s')
+print(f'After:  {after:10.1f} samples/s')
+print(f'Speedup: {after / before:.1f}x')
@@ -5,7 +5,7 @@ import math
 from tqdm import tqdm
 import numpy as np
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from src.common import find_samples
+from src.common import find_samples, keyword_index
 import src.config as cfg
 
 positive_length_max = 0
@@ -13,12 +13,15 @@ positive_length_min = float('inf')
 negative_length_max = 0
 negative_length_min = float('inf')
 hist = np.zeros(100).astype('int32')
+keyword_counts = np.zeros(len(cfg.KEYWORDS)).astype('int32')
 total = 0
 for sample in tqdm(find_samples(cfg.SAMPLE_DIR)):
     for label in sample.labels:
         total += 1
         length = label.end - label.begin
-        if label.text.lower().startswith('p'):
+        keyword = keyword_index(label)
+        if keyword >= 0:
+            keyword_counts[keyword] += 1
             positive_length_max = max(positive_length_max, length)
             positive_length_min = min(positive_length_min, length)
             hist[math.ceil(length * 10)] += 1
@@ -27,6 +30,8 @@ for sample in tqdm(find_samples(cfg.SAMPLE_DIR)):
             negative_length_min = min(negative_length_min, length)
 print(f'Total labels: {total}')
 print(f'    Positive: {sum(hist)}')
+for keyword, count in zip(cfg.KEYWORDS, keyword_counts):
+    print(f'        {keyword.name}: {count}')
 print(f'    Negative: {total - sum(hist)}')
 print(f'Positive length max: {positive_length_max}')
 print(f'Positive length min: {positive_length_min}')
@@ -1,39 +1,30 @@
 import sys
 import os
 from pathlib import Path
-import datasets
-from scipy.io import wavfile
 from tqdm import tqdm
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 import src.config as cfg
-import numpy as np
+from src.corpus import ingest, ingest_directory, corpus_paths
 
 print("Downloading RIRs...")
 
+# RIRs are packed into a single corpus file, the directory of WAV files is written by the older version of this script
 output_dir = Path(__file__).parent.parent / 'data/mit_rirs'
-if output_dir.exists():
-    print(f"Output directory {output_dir} already exists, skipping download.")
+if corpus_paths('mit_rirs')[1].exists():
+    print(f"Corpus {corpus_paths('mit_rirs')[1]} already exists, skipping download.")
     exit(0)
 
-removed_max = 0
-tmp_dir = output_dir.with_suffix('.tmp')
-tmp_dir.mkdir(parents=True, exist_ok=True)
-rir_dataset = datasets.load_dataset("davidscripka/MIT_environmental_impulse_responses", split="train", streaming=True)
-for row in tqdm(rir_dataset):
-    name = row['audio']['path'].split('/')[-1]
-    file = tmp_dir / name
-    sample_rate = row['audio']['sampling_rate']
-    data = (row['audio']['array'] * 32767).astype(np.int16)
-    if sample_rate != 16000:
-        raise ValueError(f"Expected sampling rate of 16000, got {row['audio']['sampling_rate']}")
-    threshold = max(abs(data.max()), abs(data.min())) / 4
-    first_real_sample = 0
-    for i in range(len(data)):
-        if abs(data[i]) > threshold:
-            first_real_sample = max(0, i - 1)
-            break
-    data = data[first_real_sample:]
-    removed_max = max(removed_max, first_real_sample)
-    wavfile.write(file, 16000, data)
-tmp_dir.rename(output_dir)
-print(f'Maximum removed {removed_max / sample_rate} seconds from the beginning of each RIR file.')
+if output_dir.exists():
+    print(f"Packing the files from {output_dir}...")
+    corpus, trimmed = ingest_directory('mit_rirs', output_dir, trim_onset=True)
+else:
+    import datasets
+    rir_dataset = datasets.load_dataset("davidscripka/MIT_environmental_impulse_responses", split="train", streaming=True)
+    def rows():
+        for row in tqdm(rir_dataset):
+            name = row['audio']['path'].split('/')[-1]
+            yield name, row['audio']['array'], row['audio']['sampling_rate']
+    # Silence before the direct sound is removed from each RIR
+    corpus, trimmed = ingest('mit_rirs', rows(), trim_onset=True)
+print(f'Packed {len(corpus)} RIRs, {corpus.data.shape[0] / cfg.SAMPLE_RATE:.0f} seconds.')
+print(f'Maximum removed {trimmed.max(initial=0) / cfg.SAMPLE_RATE} seconds from the beginning of each RIR file.')
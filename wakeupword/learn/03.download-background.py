@@ -1,31 +1,28 @@
 import sys
 import os
 from pathlib import Path
-import datasets
-from scipy.io import wavfile
-from scipy.signal import resample
 from tqdm import tqdm
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 import src.config as cfg
-import numpy as np
+from src.corpus import ingest, ingest_directory, corpus_paths
 
 print("Downloading background sounds...")
 
+# Sounds are packed into a single corpus file, the directory of WAV files is written by the older version of this script
 output_dir = Path(__file__).parent.parent / 'data/esc50'
-if not output_dir.exists():
-    tmp_dir = output_dir.with_suffix('.tmp')
-    tmp_dir.mkdir(parents=True, exist_ok=True)
-    esc50_dataset = datasets.load_dataset("ashraq/esc50", split="train", streaming=True)
-    for row in tqdm(esc50_dataset):
-        name = row['filename']
-        file = tmp_dir / name
-        data = row['audio']['array']
-        sampling_rate = row['audio']['sampling_rate']
-        if sampling_rate != cfg.SAMPLE_RATE:
-            duration = data.shape[0] / sampling_rate
-            num_samples = int(duration * cfg.SAMPLE_RATE)
-            data = resample(data, num_samples)
-        wavfile.write(file, 16000, (data * 32767).astype(np.int16))
-    tmp_dir.rename(output_dir)
+if corpus_paths('esc50')[1].exists():
+    print(f"Corpus {corpus_paths('esc50')[1]} already exists, skipping download.")
+    exit(0)
+
+if output_dir.exists():
+    print(f"Packing the files from {output_dir}...")
+    corpus, _ = ingest_directory('esc50', output_dir)
 else:
-    print(f"Output directory {output_dir} already exists, skipping download.")
+    import datasets
+    esc50_dataset = datasets.load_dataset("ashraq/esc50", split="train", streaming=True)
+    def rows():
+        for row in tqdm(esc50_dataset):
+            yield row['filename'], row['audio']['array'], row['audio']['sampling_rate']
+    # Sounds are resampled to the sample rate in batches of the same length
+    corpus, _ = ingest('esc50', rows())
+print(f'Packed {len(corpus)} sounds, {corpus.data.shape[0] / cfg.SAMPLE_RATE:.0f} seconds.')
@@ -2,82 +2,57 @@
 import os
 import sys
 import math
+import time
+import queue
+import hashlib
+import cProfile
+import multiprocessing
+from dataclasses import dataclass
 from tqdm import tqdm
 from pathlib import Path
 import numpy as np
 import numpy.typing as npt
 from scipy.io import wavfile
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from src.common import find_labels, Label
+from src.common import keyword_index, Label
+from src.label_index import load_label_index, NEGATIVE_CLASS
+from src.features import FeatureExtractor
+from src.inference import select_backend, model_file
+from src.audio import fade, copy_range, assemble_window, resample_range
+from src.feature_cache import FeatureCache, KEY_SIZE
+from src.augmentation import BatchAugmenter
+from src.corpus import open_corpus, load_sample_corpus
+from src.timing import StageTimer
+from src.loudness import normalize_segments
 import src.config as cfg
-import audiomentations
 import random
-from scipy.signal import resample
-import tensorflow as tf
-
-normalize_trans = audiomentations.LoudnessNormalization(
-    p=1.0,
-    min_lufs=cfg.LOUDNESS_NORMALIZATION_DB,
-    max_lufs=cfg.LOUDNESS_NORMALIZATION_DB,
-)
-
-default_trans = audiomentations.Compose([
-    audiomentations.AddBackgroundNoise(
-        p=cfg.modifications.background_noise_probability,
-        min_snr_db=cfg.modifications.background_noise_min_db,
-        max_snr_db=cfg.modifications.background_noise_max_db,
-        sounds_path=str(cfg.DATA_DIR / 'esc50'),
-        noise_rms='relative',
-    ),
-    audiomentations.AddColorNoise(
-        p=cfg.modifications.color_noise_probability,
-        min_snr_db=cfg.modifications.color_noise_min_db,
-        max_snr_db=cfg.modifications.color_noise_max_db,
-    ),
-    audiomentations.ApplyImpulseResponse(
-        p=cfg.modifications.impulse_response_probability,
-        ir_path=str(cfg.DATA_DIR / 'mit_rirs'),
-    ),
-    audiomentations.LoudnessNormalization(
-        p=1.0,
-        min_lufs=cfg.LOUDNESS_NORMALIZATION_DB,
-        max_lufs=cfg.LOUDNESS_NORMALIZATION_DB,
-    ),
-    audiomentations.Gain(
-        p=cfg.modifications.gain_probability,
-        min_gain_db=cfg.modifications.gain_min_db,
-        max_gain_db=cfg.modifications.gain_max_db,
-    ),
-    audiomentations.Clip(
-        p=1.0,
-    ),
-])
-
-
-# Load the TFLite models
-melspec_model = tf.lite.Interpreter(model_path=str(cfg.MODELS_DIR / 'melspectrogram.tflite'))
-melspec_model.resize_tensor_input(
-    melspec_model.get_input_details()[0]['index'],
-    [1, cfg.INPUT_WINDOW_LENGTH_MS * cfg.SAMPLES_PER_MS],
-    strict=True)
-melspec_model.allocate_tensors()
-melspec_input_index = melspec_model.get_input_details()[0]['index']
-melspec_output_index = melspec_model.get_output_details()[0]['index']
-
-emb_model = tf.lite.Interpreter(model_path=str(cfg.MODELS_DIR / 'embedding_model.tflite'))
-emb_model.resize_tensor_input(
-    emb_model.get_input_details()[0]['index'],
-    [cfg.EMBEDDINGS_COUNT, 76, 32, 1],
-    strict=True)
-emb_model.allocate_tensors()
-emb_input_index = emb_model.get_input_details()[0]['index']
-emb_output_index = emb_model.get_output_details()[0]['index']
-
-esc50_files = list((cfg.DATA_DIR / 'esc50').glob('*.wav'))
-
-positive_labels, negative_labels = find_labels(cfg.SAMPLE_DIR)
-
-def resample_sample(data: npt.NDArray[np.float32], begin: float, end: float, check: bool) -> tuple[npt.NDArray[np.float32], float, float]:
+from fractions import Fraction
+
+# Time spent in the stages of the generation, workers send their timers to the main process at the end
+timer = StageTimer(cfg.timing.enabled)
+TIMING_DIR = cfg.DATA_DIR / 'timing'
+
+# Corpora packed by 02.download-rirs.py and 03.download-background.py, memory-mapped and shared by the workers
+background = open_corpus('esc50')
+impulse_responses = open_corpus('mit_rirs')
+
+# Background noise, color noise, impulse response, loudness normalization, gain and clipping applied to each batch of windows
+augmenter = BatchAugmenter(cfg.generation.feature_batch_size, cfg.INPUT_WINDOW_LENGTH_MS * cfg.SAMPLES_PER_MS, background, impulse_responses)
+
+label_index = load_label_index(cfg.SAMPLE_DIR)
+positive_labels, negative_labels = label_index.labels()
+# Recordings in the order of the label index files, packed again when they change
+samples = load_sample_corpus(label_index)
+
+# Changed when the same configuration and source audio give different windows than before
+GENERATOR_VERSION = 4
+
+# Maximum denominator of the resampling rate, bigger values give more precise rates, but longer filters
+RESAMPLE_MAX_DENOMINATOR = 50
+
+@timer.timed('resample')
+def resample_sample(data: npt.NDArray[np.float32], begin: float, end: float, check: bool, margin_smpl: int = 0) -> tuple[npt.NDArray[np.float32], float, float]:
+    # Only the label and margin_smpl samples around it are resampled, returned begin and end are relative to the returned data
     if random.random() >= cfg.modifications.resample_probability:
         return data, begin, end
     if check:
@@ -90,41 +65,44 @@ def resample_sample(data: npt.NDArray[np.float32], begin: float, end: float, che
         rate_min = cfg.modifications.resample_min_rate
     if rate_min > rate_max:
         return data, begin, end
-    rate = random.uniform(rate_min, rate_max)
-    new_sample_count = int(math.ceil(data.shape[0] * rate))
-    rate = new_sample_count / data.shape[0]
-    data = resample(data, new_sample_count) # can be optimized - resample needed range and some margin only
-    begin *= rate
-    end *= rate
+    rate = Fraction(random.uniform(rate_min, rate_max)).limit_denominator(RESAMPLE_MAX_DENOMINATOR)
+    # Margin is needed after resampling, so scale it back to the source rate
+    margin_smpl = int(math.ceil(margin_smpl / rate))
+    begin_smpl = int(math.floor(begin * cfg.SAMPLE_RATE)) - margin_smpl
+    end_smpl = int(math.ceil(end * cfg.SAMPLE_RATE)) + margin_smpl
+    data, offset_smpl = resample_range(data, begin_smpl, end_smpl, rate.numerator, rate.denominator)
+    begin = begin * float(rate) + offset_smpl / cfg.SAMPLE_RATE
+    end = end * float(rate) + offset_smpl / cfg.SAMPLE_RATE
     return data, begin, end
 
+@timer.timed('random negative')
 def get_random_negative(part1_smpl, part2_smpl) -> tuple[npt.NDArray[np.float32], npt.NDArray[np.float32]]:
+    # Returned parts are views of the reused buffers, they are valid until the next call
     required_smpl = (part1_smpl + part2_smpl + max(part1_smpl, part2_smpl)) // 2
-    while True:
-        index = random.randint(0, len(negative_labels) - 1)
-        label = negative_labels[index]
-        begin_smpl = int(round(label.begin * cfg.SAMPLE_RATE))
-        end_smpl = int(round(label.end * cfg.SAMPLE_RATE))
-        length_smpl = end_smpl - begin_smpl
-        if length_smpl < required_smpl:
-            continue
-        sample_rate, data = wavfile.read(label.set.wav)
-        part1 = data[begin_smpl:begin_smpl + part1_smpl].astype(np.float32) / 32767
-        part2 = data[end_smpl - part2_smpl:end_smpl].astype(np.float32) / 32767
-        return part1, part2
-
-def fade(data: npt.NDArray[np.float32], direction: float) -> None:
-    step = 1 / data.shape[0] * direction
-    start = 0 if step > 0 else 1
-    for i in range(data.shape[0]):
-        start += step
-        data[i] *= start
+    label = label_index.random_label(NEGATIVE_CLASS, required_smpl)
+    if label < 0:
+        raise ValueError(f'No negative label is at least {required_smpl / cfg.SAMPLE_RATE:.2f} s long.')
+    begin_smpl = int(label_index.begin_smpl[label])
+    end_smpl = int(label_index.end_smpl[label])
+    data = samples[int(label_index.file_ids[label])]
+    part1 = np.divide(data[begin_smpl:begin_smpl + part1_smpl], np.float32(32767), out=prepend_buffer[:part1_smpl])
+    part2 = np.divide(data[end_smpl - part2_smpl:end_smpl], np.float32(32767), out=append_buffer[:part2_smpl])
+    return part1, part2
+
+# Buffers reused by each generated positive sample
+window_buffer = np.zeros(cfg.INPUT_WINDOW_LENGTH_MS * cfg.SAMPLES_PER_MS, dtype=np.float32)
+word_buffer = np.zeros((cfg.MAX_WORD_LENGTH_MS + 4 * cfg.MEL_WINDOW_LENGTH_MS) * cfg.SAMPLES_PER_MS, dtype=np.float32)
+prepend_buffer = np.zeros(cfg.INPUT_WINDOW_LENGTH_MS * cfg.SAMPLES_PER_MS, dtype=np.float32)
+append_buffer = np.zeros(cfg.INPUT_WINDOW_LENGTH_MS * cfg.SAMPLES_PER_MS, dtype=np.float32)
 
 index_aaa = 0
 
+@timer.timed('positive window')
 def generate_positive_from_label(data: npt.NDArray[np.float32], label: Label) -> 'npt.NDArray[np.float32]|None':
     global index_aaa
-    data, begin, end = resample_sample(data, label.begin, label.end, True)
+    # Number of sample for fade-in and fade-out
+    fade_smpl = 2 * cfg.MEL_WINDOW_LENGTH_MS * cfg.SAMPLES_PER_MS
+    data, begin, end = resample_sample(data, label.begin, label.end, True, fade_smpl)
     begin_smpl = int(round(begin * cfg.SAMPLE_RATE))
     end_smpl = int(round(end * cfg.SAMPLE_RATE))
     length_smpl = end_smpl - begin_smpl
@@ -139,98 +117,136 @@ def generate_positive_from_label(data: npt.NDArray[np.float32], label: Label) ->
     # Append audio at the end to ensure correct audio sample count
     total_smpl = cfg.INPUT_WINDOW_LENGTH_MS * cfg.SAMPLES_PER_MS
     append_smpl = total_smpl - prepend_smpl - length_smpl
-    # Number of sample for fade-in and fade-out
-    fade_smpl = 2 * cfg.MEL_WINDOW_LENGTH_MS * cfg.SAMPLES_PER_MS
     assert append_smpl > fade_smpl and prepend_smpl > fade_smpl
-    # If not enough audio before or after the word, add silence
-    if begin_smpl < fade_smpl:
-        data = np.pad(data[0:end_smpl + fade_smpl], (fade_smpl - begin_smpl, 0), mode='constant', constant_values=0)
-        end_smpl += fade_smpl - begin_smpl
-        begin_smpl += fade_smpl - begin_smpl
-    if data.shape[0] - end_smpl < fade_smpl:
-        data = np.pad(data[begin_smpl - fade_smpl:], (0, fade_smpl - (data.shape[0] - end_smpl)), mode='constant', constant_values=0)
-        end_smpl -= begin_smpl - fade_smpl
-        begin_smpl -= begin_smpl - fade_smpl
-    # Cut-off the word (with fading areas)
-    data = data[begin_smpl - fade_smpl:end_smpl + fade_smpl].copy()
+    # Cut-off the word (with fading areas), if not enough audio before or after the word, add silence
+    data = copy_range(data, begin_smpl - fade_smpl, end_smpl + fade_smpl, word_buffer)
     fade(data[:fade_smpl], 1)  # Fade-in at the beginning
     fade(data[-fade_smpl:], -1)  # Fade-out at the end
-    data = normalize_trans(data, cfg.SAMPLE_RATE)
     # Get some random negative samples to prepend and append
     prepend_data, append_data = get_random_negative(prepend_smpl, append_smpl)
     # Fade-out and fade-in additional samples
     fade(prepend_data[-fade_smpl:], -1)
     fade(append_data[:fade_smpl], 1)
-    prepend_data = normalize_trans(prepend_data, cfg.SAMPLE_RATE)
-    append_data = normalize_trans(append_data, cfg.SAMPLE_RATE)
+    # Loudness of all three parts is normalized separately, but measured together
+    with timer.stage('loudness'):
+        normalize_segments([data, prepend_data, append_data], cfg.LOUDNESS_NORMALIZATION_DB)
     # Glue everything together
-    result = np.zeros(total_smpl, dtype=np.float32)
-    result[prepend_smpl - fade_smpl:prepend_smpl + length_smpl + fade_smpl] = data
-    result[:prepend_smpl] += prepend_data
-    result[prepend_smpl + length_smpl:] += append_data
-    # Transform the audio
-    result = default_trans(result, cfg.SAMPLE_RATE)
+    assemble_window(window_buffer, prepend_data, data, append_data, fade_smpl)
+    # The audio is transformed later together with the whole batch
+    result = window_buffer
     #wavfile.write(Path(__file__).parent / f"../tmp/{index_aaa}.wav", cfg.SAMPLE_RATE, result)
     index_aaa += 1
     return result
 
 
-def get_features(data: npt.NDArray[np.float32]) -> npt.NDArray[np.float32]:
-    melspec_model.set_tensor(melspec_input_index, data.reshape(1, -1))
-    melspec_model.invoke()
-    spec = melspec_model.get_tensor(melspec_output_index)
-    spec = spec.reshape((-1, 32, 1))
-    emb_input = np.zeros((cfg.EMBEDDINGS_COUNT, 76, 32, 1), dtype=np.float32)
-    for i in range(cfg.EMBEDDINGS_COUNT):
-        emb_input[i] = spec[i * 8:i * 8 + 76]
-    emb_model.set_tensor(emb_input_index, emb_input)
-    emb_model.invoke()
-    features = emb_model.get_tensor(emb_output_index)
-    features = features.reshape((-1, 96))
-    return features
-
-def generate_from_samples(labels: list[Label], to_generate: int, callback) -> None:
+def get_config_digest() -> bytes:
+    # Everything, except the source audio, that changes the generated windows
+    digest = hashlib.blake2b(digest_size=KEY_SIZE)
+    for name in sorted(dir(cfg.modifications)):
+        if not name.startswith('_'):
+            digest.update(f'{name}={getattr(cfg.modifications, name)!r};'.encode())
+    digest.update(repr((
+        cfg.generation.seed,
+        cfg.generation.negative_from_start_of_label_probability,
+        cfg.INPUT_WINDOW_LENGTH_MS,
+        cfg.MAX_WORD_LENGTH_MS,
+        cfg.MIN_WORD_LENGTH_MS,
+        cfg.WORD_PREFIX_LENGTH_MS,
+        cfg.WORD_SHIFT_LENGTH_MS,
+        cfg.LOUDNESS_NORMALIZATION_DB,
+        background.names.tolist(),
+        impulse_responses.names.tolist(),
+        GENERATOR_VERSION,
+    )).encode())
+    backend, _ = select_backend('batch')
+    for name in ('melspectrogram', 'embedding_model'):
+        digest.update(model_file(name, backend).read_bytes())
+    return digest.digest()
+
+def get_negative_digest() -> bytes:
+    # Negative labels and their audio, positive windows are surrounded by the randomly drawn ones
+    digest = hashlib.blake2b(digest_size=KEY_SIZE)
+    for label in np.flatnonzero(label_index.classes == NEGATIVE_CLASS).tolist():
+        file_id = int(label_index.file_ids[label])
+        begin_smpl = int(label_index.begin_smpl[label])
+        end_smpl = int(label_index.end_smpl[label])
+        digest.update(repr((label_index.files[file_id], begin_smpl, end_smpl)).encode())
+        digest.update(samples[file_id][begin_smpl:end_smpl].tobytes())
+    return digest.digest()
+
+def get_file_digest(data: npt.NDArray[np.float32]) -> bytes:
+    # Whole recording, the resampling and the fades also use the samples around the label
+    return hashlib.blake2b(data.tobytes(), digest_size=KEY_SIZE).digest()
+
+def get_label_digest(file_digest: bytes, label: Label, context: bytes) -> bytes:
+    digest = hashlib.blake2b(file_digest + context, digest_size=KEY_SIZE)
+    digest.update(repr((str(label.set.wav.relative_to(cfg.SAMPLE_DIR)), label.begin, label.end, label.text)).encode())
+    return digest.digest()
+
+def get_window_key(*parts) -> bytes:
+    digest = hashlib.blake2b(config_digest, digest_size=KEY_SIZE)
+    digest.update(repr(parts).encode())
+    return digest.digest()
+
+def seed_window(key: bytes) -> None:
+    # Each window has its own random sequence, so it can be reused from the cache regardless of the other windows
+    random.seed(key)
+    np.random.seed(np.frombuffer(key, dtype=np.uint32))
+
+def generate_from_samples(labels: list[Label], to_generate: int, callback, context: bytes = b'') -> None:
+    # Context is the digest of the other inputs of the windows (besides the recording of the label)
     prev_file = None
+    attempts = [0] * len(labels)
     while to_generate > 0:
         for index, label in enumerate(labels):
             count = int(math.ceil(to_generate / (len(labels) - index)))
             count = min(count, to_generate)
+            if count == 0:
+                continue
             if prev_file != label.set.wav:
                 prev_file = label.set.wav
-                sample_rate, data = wavfile.read(label.set.wav)
-                if sample_rate != cfg.SAMPLE_RATE:
-                    raise ValueError(f"Invalid sample rate.")
-                data = data.astype(np.float32) / 32767
+                with timer.stage('read'):
+                    data = samples[samples.find(label.set.wav.relative_to(label_index.root).as_posix())]
+                    data = data.astype(np.float32) / 32767
+                    file_digest = get_file_digest(data)
+            label_digest = get_label_digest(file_digest, label, context)
             failure_left = 2 * count
             success_left = count
             while failure_left > 0 and success_left > 0:
-                if callback(data, label):
+                if callback(data, label, get_window_key(label_digest, attempts[index])):
                     success_left -= 1
                     to_generate -= 1
                 else:
                     failure_left -= 1
+                attempts[index] += 1
 
 
 dump_sample_counter = 0
 
+@timer.timed('dump')
 def dump_sample(name: str, data: npt.NDArray[np.float32]) -> None:
     global dump_sample_counter
-    if random.random() < cfg.generation.dump_probability:
-        wavfile.write(cfg.DATA_DIR / f'../tmp/{name}_{dump_sample_counter}.wav', cfg.SAMPLE_RATE, data)
-        dump_sample_counter += 1
+    wavfile.write(cfg.DATA_DIR / f'../tmp/{name}_{worker_index}_{dump_sample_counter}.wav', cfg.SAMPLE_RATE, data)
+    dump_sample_counter += 1
 
-def generate_positive_from_samples():
-    def callback(data: npt.NDArray[np.float32], label: Label) -> bool:
+def generate_positive_from_samples(labels: list[Label], to_generate: int):
+    def callback(data: npt.NDArray[np.float32], label: Label, key: bytes) -> bool:
+        keyword = keyword_index(label)
+        with timer.stage('cache'):
+            features = cache.get(key)
+        if features is not None:
+            add_features(features, key, True, keyword)
+            return True
+        seed_window(key)
         sample_data = generate_positive_from_label(data, label)
         if sample_data is None:
             return False
-        dump_sample('positive', sample_data)
-        features = get_features(sample_data)
-        add_positive(features)
+        add_window(sample_data, key, True, keyword)
         return True
-    generate_from_samples(positive_labels, cfg.generation.positive_from_samples, callback)
+    generate_from_samples(labels, to_generate, callback, negative_digest)
 
 
+@timer.timed('negative window')
 def generate_negative_from_label(data: npt.NDArray[np.float32], label: Label) -> 'npt.NDArray[np.float32]|None':
     data, begin, end = resample_sample(data, label.begin, label.end, False)
     begin_smpl = int(round(begin * cfg.SAMPLE_RATE))
@@ -244,83 +260,314 @@ def generate_negative_from_label(data: npt.NDArray[np.float32], label: Label) ->
     else:
         max_shift = length_smpl - total_smpl
         shift = random.randint(0, max_shift)
-    data = data[begin_smpl + shift:begin_smpl + shift + total_smpl].copy()
-    data = default_trans(data, cfg.SAMPLE_RATE)
-    return data
+    return data[begin_smpl + shift:begin_smpl + shift + total_smpl]
 
 
-def generate_negative_from_samples():
-    def callback(data: npt.NDArray[np.float32], label: Label) -> bool:
+def generate_negative_from_samples(labels: list[Label], to_generate: int):
+    def callback(data: npt.NDArray[np.float32], label: Label, key: bytes) -> bool:
+        with timer.stage('cache'):
+            features = cache.get(key)
+        if features is not None:
+            add_features(features, key, False)
+            return True
+        seed_window(key)
         sample_data = generate_negative_from_label(data, label)
         if sample_data is None:
             return False
-        dump_sample('negative', sample_data)
-        features = get_features(sample_data)
-        add_negative(features)
+        add_window(sample_data, key, False)
         return True
-    generate_from_samples(negative_labels, cfg.generation.negative_from_samples, callback)
+    generate_from_samples(labels, to_generate, callback)
 
 
-def generate_negative_from_noise():
-    for i in range(cfg.generation.negative_from_background):
-        file = random.choice(esc50_files)
-        sample_rate, data = wavfile.read(file)
-        data = data.astype(np.float32) / 32767
+def generate_negative_from_noise(to_generate: int, first_index: int):
+    for i in range(first_index, first_index + to_generate):
+        key = get_window_key('noise', i)
+        with timer.stage('cache'):
+            features = cache.get(key)
+        if features is not None:
+            add_features(features, key, False)
+            continue
+        seed_window(key)
+        with timer.stage('read'):
+            data = background[random.randrange(len(background))].astype(np.float32) / 32767
         sample_data = generate_negative_from_label(data, Label(
             begin=0.0,
-            end=len(data) / sample_rate,
+            end=len(data) / cfg.SAMPLE_RATE,
             text='n',
             set=None
         ))
         assert sample_data is not None
-        dump_sample('negative', sample_data)
-        features = get_features(sample_data)
-        add_negative(features)
+        add_window(sample_data, key, False)
+
+@dataclass
+class Shard:
+    index: int
+    positive_labels: list[Label]
+    positive_count: int
+    positive_offset: int
+    negative_labels: list[Label]
+    negative_count: int
+    negative_offset: int
+    noise_count: int
+    noise_offset: int
+
+def split_labels(labels: list[Label], to_generate: int, parts: int) -> list[tuple[list[Label], int, int]]:
+    # Contiguous parts, so labels from the same file stay together, with the sample count proportional to the number of labels
+    result = []
+    for i in range(parts):
+        begin = len(labels) * i // parts
+        end = len(labels) * (i + 1) // parts
+        offset = to_generate * begin // len(labels) if len(labels) > 0 else 0
+        count = (to_generate * end // len(labels) if len(labels) > 0 else 0) - offset
+        result.append((labels[begin:end], count, offset))
+    return result
+
+def create_shards(workers: int) -> list[Shard]:
+    # Without labels, the arrays would be left with zero rows that are trained as real samples
+    for name, labels, to_generate in (('positive', positive_labels, cfg.generation.positive_from_samples),
+                                      ('negative', negative_labels, cfg.generation.negative_from_samples)):
+        if len(labels) == 0 and to_generate > 0:
+            raise ValueError(f'No {name} labels found, but {to_generate} {name} samples are requested.')
+    positive_parts = split_labels(positive_labels, cfg.generation.positive_from_samples, workers)
+    negative_parts = split_labels(negative_labels, cfg.generation.negative_from_samples, workers)
+    shards: list[Shard] = []
+    for i in range(workers):
+        noise_offset = cfg.generation.negative_from_background * i // workers
+        noise_end = cfg.generation.negative_from_background * (i + 1) // workers
+        shards.append(Shard(
+            index=i,
+            positive_labels=positive_parts[i][0],
+            positive_count=positive_parts[i][1],
+            positive_offset=positive_parts[i][2],
+            negative_labels=negative_parts[i][0],
+            negative_count=negative_parts[i][1],
+            negative_offset=negative_parts[i][2],
+            noise_count=noise_end - noise_offset,
+            noise_offset=cfg.generation.negative_from_samples + noise_offset,
+        ))
+    return shards
 
 def prepare_arrays():
-    global positive_outputs, positive_count, negative_outputs, negative_count, progress_bar
     total_positive = cfg.generation.positive_from_samples
-    positive_count = 0
-    positive_outputs = np.memmap(
-        cfg.DATA_DIR / 'positive.dat',
-        dtype='float32',
-        mode='w+',
-        shape=(total_positive, cfg.EMBEDDINGS_COUNT, cfg.FEATURES_COUNT))
     total_negative = cfg.generation.negative_from_samples + cfg.generation.negative_from_background
-    negative_count = 0
-    negative_outputs = np.memmap(
-        cfg.DATA_DIR / 'negative.dat',
-        dtype='float32',
-        mode='w+',
-        shape=(total_negative, cfg.EMBEDDINGS_COUNT, cfg.FEATURES_COUNT))
-    progress_bar = tqdm(total=total_positive + total_negative)
+    for name, total in (('positive', total_positive), ('negative', total_negative)):
+        outputs = np.memmap(
+            cfg.DATA_DIR / f'{name}.dat',
+            dtype='float32',
+            mode='w+',
+            shape=(total, cfg.EMBEDDINGS_COUNT, cfg.FEATURES_COUNT))
+        outputs.flush()
+        del outputs
+        # Cache key of each window
+        keys = np.memmap(cfg.DATA_DIR / f'{name}.keys', dtype='uint8', mode='w+', shape=(total, KEY_SIZE))
+        keys.flush()
+        del keys
+    # Index of the keyword (in cfg.KEYWORDS) of each positive window
+    keywords = np.memmap(cfg.DATA_DIR / 'positive.keywords', dtype='uint8', mode='w+', shape=(total_positive,))
+    keywords.flush()
+    del keywords
+    return total_positive, total_negative
+
+def open_arrays(shard: Shard):
+    # Each worker writes only to its own slices of the arrays
+    global positive_outputs, positive_keys, positive_keywords, positive_count, negative_outputs, negative_keys, negative_count
+    positive_outputs = np.memmap(cfg.DATA_DIR / 'positive.dat', dtype='float32', mode='r+')
+    positive_outputs = positive_outputs.reshape(-1, cfg.EMBEDDINGS_COUNT, cfg.FEATURES_COUNT)
+    positive_keys = np.memmap(cfg.DATA_DIR / 'positive.keys', dtype='uint8', mode='r+').reshape(-1, KEY_SIZE)
+    positive_keywords = np.memmap(cfg.DATA_DIR / 'positive.keywords', dtype='uint8', mode='r+')
+    negative_outputs = np.memmap(cfg.DATA_DIR / 'negative.dat', dtype='float32', mode='r+')
+    negative_outputs = negative_outputs.reshape(-1, cfg.EMBEDDINGS_COUNT, cfg.FEATURES_COUNT)
+    negative_keys = np.memmap(cfg.DATA_DIR / 'negative.keys', dtype='uint8', mode='r+').reshape(-1, KEY_SIZE)
+    positive_count = shard.positive_offset
+    negative_count = shard.negative_offset
 
-def done_arrays():
-    global positive_outputs, positive_count, negative_outputs, negative_count
-    assert positive_outputs.shape[0] == positive_count, f'Expected {positive_outputs.shape[0]} positive samples, but got {positive_count}.'
+def done_arrays(shard: Shard):
+    global positive_outputs, positive_keys, positive_keywords, positive_count, negative_outputs, negative_keys, negative_count
+    expected = shard.positive_offset + shard.positive_count
+    assert expected == positive_count, f'Expected {shard.positive_count} positive samples, but got {positive_count - shard.positive_offset}.'
     positive_outputs.flush()
-    del positive_outputs
+    positive_keys.flush()
+    positive_keywords.flush()
+    del positive_outputs, positive_keys, positive_keywords
     positive_outputs = None
-    assert negative_outputs.shape[0] == negative_count, f'Expected {negative_outputs.shape[0]} negative samples, but got {negative_count}.'
+    positive_keys = None
+    positive_keywords = None
+    expected = shard.noise_offset + shard.noise_count
+    assert expected == negative_count, f'Expected {shard.noise_count} negative samples from background, but got {negative_count - shard.noise_offset}.'
     negative_outputs.flush()
-    del negative_outputs
+    negative_keys.flush()
+    del negative_outputs, negative_keys
     negative_outputs = None
+    negative_keys = None
+
+def update_cache(total_positive: int, total_negative: int) -> None:
+    # Only the main process writes to the cache, after all workers are done
+    datasets = {}
+    for name, total in (('positive', total_positive), ('negative', total_negative)):
+        outputs = np.memmap(cfg.DATA_DIR / f'{name}.dat', dtype='float32', mode='r', shape=(total, cfg.EMBEDDINGS_COUNT, cfg.FEATURES_COUNT))
+        keys = np.memmap(cfg.DATA_DIR / f'{name}.keys', dtype='uint8', mode='r', shape=(total, KEY_SIZE))
+        cache.update(keys, outputs)
+        del outputs, keys
+        datasets[name] = {
+            'file': f'{name}.dat',
+            'keys': f'{name}.keys',
+            'count': total,
+        }
+    datasets['positive']['keywords'] = 'positive.keywords'
+    datasets['positive']['keyword_names'] = [keyword.name for keyword in cfg.KEYWORDS]
+    cache.save(datasets)
+    print(f'Feature cache: {cache.hits} hits, {cache.misses} misses, {len(cache.slots)} entries, {cache.evicted} evicted.')
+
+def update_progress(count: int) -> None:
+    if progress_bar is not None:
+        progress_bar.update(count)
+    else:
+        with progress_counter.get_lock():
+            progress_counter.value += count
 
-def add_positive(features: npt.NDArray[np.float32]) -> None:
-    global positive_outputs, positive_count, progress_bar
-    positive_outputs[positive_count] = features
-    positive_count += 1
-    progress_bar.update()
+def next_row(key: bytes, positive: bool, keyword: int) -> int:
+    global positive_count, negative_count
+    if positive:
+        row = positive_count
+        positive_count += 1
+        positive_keys[row] = np.frombuffer(key, dtype=np.uint8)
+        positive_keywords[row] = keyword
+    else:
+        row = negative_count
+        negative_count += 1
+        negative_keys[row] = np.frombuffer(key, dtype=np.uint8)
+    return row
+
+def add_window(data: npt.NDArray[np.float32], key: bytes, positive: bool, keyword: int = 0) -> None:
+    global pending_count, pending_positive
+    # Windows are collected and their features are extracted in batches
+    if pending_count > 0 and pending_positive != positive:
+        flush_windows()
+    pending_positive = positive
+    pending_windows[pending_count] = data
+    pending_rows[pending_count] = next_row(key, positive, keyword)
+    # Random values of the window are drawn now, while the generator is seeded for the window
+    pending_dumps[pending_count] = random.random() < cfg.generation.dump_probability
+    augmenter.draw(pending_count)
+    pending_count += 1
+    if pending_count == pending_windows.shape[0]:
+        flush_windows()
+
+def add_features(features: npt.NDArray[np.float32], key: bytes, positive: bool, keyword: int = 0) -> None:
+    outputs = positive_outputs if positive else negative_outputs
+    with timer.stage('write'):
+        outputs[next_row(key, positive, keyword)] = features
+    update_progress(1)
+
+def flush_windows() -> None:
+    global pending_count
+    if pending_count == 0:
+        return
+    with timer.stage('augment'):
+        augmenter.apply(pending_windows[:pending_count])
+    for row in np.flatnonzero(pending_dumps[:pending_count]):
+        dump_sample('positive' if pending_positive else 'negative', pending_windows[row])
+    with timer.stage('features'):
+        features = extractor.get_features(pending_windows[:pending_count])
+    outputs = positive_outputs if pending_positive else negative_outputs
+    with timer.stage('write'):
+        outputs[pending_rows[:pending_count]] = features
+    update_progress(pending_count)
+    pending_count = 0
+
+def run_shard(shard: Shard) -> None:
+    global worker_index, negative_count, extractor, pending_windows, pending_rows, pending_dumps, pending_count, pending_positive
+    worker_index = shard.index
+    extractor = FeatureExtractor(cfg.generation.feature_batch_size, timer=timer, processes=len(shards))
+    pending_windows = np.zeros((cfg.generation.feature_batch_size, cfg.INPUT_WINDOW_LENGTH_MS * cfg.SAMPLES_PER_MS), dtype=np.float32)
+    pending_rows = np.zeros(cfg.generation.feature_batch_size, dtype=np.int64)
+    pending_dumps = np.zeros(cfg.generation.feature_batch_size, dtype=bool)
+    pending_count = 0
+    pending_positive = True
+    open_arrays(shard)
+    generate_positive_from_samples(shard.positive_labels, shard.positive_count)
+    generate_negative_from_samples(shard.negative_labels, shard.negative_count)
+    assert negative_count == shard.negative_offset + shard.negative_count, f'Expected {shard.negative_count} negative samples, but got {negative_count - shard.negative_offset}.'
+    negative_count = shard.noise_offset
+    generate_negative_from_noise(shard.noise_count, shard.noise_offset - cfg.generation.negative_from_samples)
+    flush_windows()
+    done_arrays(shard)
 
-def add_negative(features: npt.NDArray[np.float32]) -> None:
-    global negative_outputs, negative_count, progress_bar
-    negative_outputs[negative_count] = features
-    negative_count += 1
-    progress_bar.update()
+def run_worker(shard: Shard, timing_queue: 'multiprocessing.Queue|None') -> None:
+    if cfg.timing.profile:
+        profiler = cProfile.Profile()
+        profiler.runcall(run_shard, shard)
+        TIMING_DIR.mkdir(parents=True, exist_ok=True)
+        profiler.dump_stats(TIMING_DIR / f'generate-{shard.index}.prof')
+    else:
+        run_shard(shard)
+    if timing_queue is not None:
+        timing_queue.put(timer.state())
+
+def run_workers(shards: list[Shard], total: int) -> None:
+    global progress_bar, progress_counter
+    # Fork, so the workers inherit already loaded labels and configuration
+    context = multiprocessing.get_context('fork')
+    progress_counter = context.Value('q', 0)
+    progress_bar = None
+    timing_queue = context.Queue()
+    processes = [context.Process(target=run_worker, args=(shard, timing_queue), name=f'generate-{shard.index}') for shard in shards]
+    for process in processes:
+        process.start()
+    states = []
+    with tqdm(total=total) as bar:
+        while any(process.is_alive() for process in processes):
+            # Timers are received while the workers run, a worker cannot exit until its timer is read from the queue
+            try:
+                states.append(timing_queue.get(timeout=0.5))
+            except queue.Empty:
+                pass
+            bar.update(progress_counter.value - bar.n)
+        bar.update(progress_counter.value - bar.n)
+    for process in processes:
+        process.join()
+        if process.exitcode != 0:
+            raise RuntimeError(f'Worker {process.name} failed with exit code {process.exitcode}.')
+    # Timers of the workers that exited during the last poll
+    while len(states) < len(processes):
+        states.append(timing_queue.get())
+    for state in states:
+        timer.merge(state)
+
+def save_timing(wall_seconds: float, total: int) -> None:
+    # Configuration of the run is saved with the timing, so the runs with different configurations can be compared
+    config = {}
+    for name, params in (('generation', cfg.generation), ('modifications', cfg.modifications), ('inference', cfg.inference)):
+        config[name] = {key: getattr(params, key) for key in sorted(dir(params)) if not key.startswith('_')}
+    backend, threads = select_backend('batch', len(shards))
+    path = TIMING_DIR / f'generate-{time.strftime("%Y%m%d-%H%M%S")}.json'
+    timer.save(path, wall_seconds, windows=total, backend=backend, threads=threads, config=config)
+    print(f'Timing saved to {path}.')
+
+worker_index = 0
+progress_bar = None
+progress_counter = None
 
 print(f'Found {len(positive_labels)} positive labels and {len(negative_labels)} negative labels.')
-prepare_arrays()
-generate_positive_from_samples()
-generate_negative_from_samples()
-generate_negative_from_noise()
-done_arrays()
+config_digest = get_config_digest()
+negative_digest = get_negative_digest()
+cache = FeatureCache(cfg.DATA_DIR / 'feature_cache', (cfg.EMBEDDINGS_COUNT, cfg.FEATURES_COUNT), cfg.generation.cache_max_bytes)
+total_positive, total_negative = prepare_arrays()
+shards = create_shards(cfg.generation.workers)
+start_time = time.perf_counter()
+if cfg.generation.workers > 1:
+    print(f'Generating with {cfg.generation.workers} workers.')
+    run_workers(shards, total_positive + total_negative)
+else:
+    progress_bar = tqdm(total=total_positive + total_negative)
+    run_worker(shards[0], None)
+    progress_bar.close()
+wall_seconds = time.perf_counter() - start_time
+update_cache(total_positive, total_negative)
+if cfg.timing.enabled:
+    # Stages of all workers are summed, so their share is relative to the time of all workers
+    timer.print_summary(wall_seconds * len(shards))
+    if cfg.timing.save_json:
+        save_timing(wall_seconds, total_positive + total_negative)
+if cfg.timing.profile:
+    print(f'Profiles of the workers saved to {TIMING_DIR}.')
@@ -3,127 +3,176 @@ import sys
 import torch.nn as nn
 import torch.optim as optim
 from torch.utils.tensorboard import SummaryWriter
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler
 import numpy as np
 import os
+import time
 from datetime import datetime
 from tqdm import tqdm
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 import src.config as cfg
-from sklearn.metrics import confusion_matrix, precision_score, recall_score, f1_score
-
-head_model_input_size = cfg.EMBEDDINGS_COUNT * cfg.FEATURES_COUNT
-shared_input_parts = cfg.EMBEDDINGS_WINDOW_DEVISABLE_BY
-shared_output_size = 16
-middle_layer_size = 16
-
-# ===== Model Definition =====
-
-class SharedLinearNet(nn.Module):
-    def __init__(self):
-        super(SharedLinearNet, self).__init__()
-
-        assert head_model_input_size % shared_input_parts == 0, "Input size must be divisible by number of parts"
-
-        self.part_size = head_model_input_size // shared_input_parts
-        self.shared_linear = nn.Linear(self.part_size, shared_output_size)
-
-        self.classifier = nn.Sequential(
-            nn.ReLU(),
-            nn.Linear(shared_output_size * shared_input_parts, middle_layer_size),
-            nn.ReLU(),
-            nn.Linear(middle_layer_size, 1),
-            #nn.Sigmoid()
-        )
-
-    def forward(self, x):
-        parts = torch.chunk(x, chunks=shared_input_parts, dim=1)
-        transformed_parts = [self.shared_linear(part) for part in parts]
-        combined = torch.cat(transformed_parts, dim=1)
-        return self.classifier(combined)
+from src.common import ROOT
+from src.feature_cache import read_manifest
+from src.head_model import SharedLinearNet, head_model_input_size
+from src.metrics import binary_metrics
+from src.embedding_augmentation import EmbeddingAugmenter
 
 # ===== Dataset Loader with np.memmap =====
 
 class MemmapDataset(Dataset):
-    def __init__(self, positive_file, negative_file, input_size):
-        # Load positive samples
+    # Samples are read directly from the memmaps (positive first, then negative), nothing is loaded
+    # into memory upfront. Each item is a whole batch selected by an array of sample indexes.
+    # Optional hard negatives follow the negative samples, they are not included in the length.
+    # Labels are (batch, keywords), the keyword of each positive sample is read from the .keywords
+    # file next to the positive file, all positives are the first keyword if it does not exist.
+    def __init__(self, positive_file, negative_file, input_size, hard_negative_file=None):
+        self.input_size = input_size
         self.positive = np.memmap(positive_file, dtype='float32', mode='r')
         self.positive = self.positive.reshape(-1, input_size)
+        keywords_file = os.path.splitext(positive_file)[0] + '.keywords'
+        if os.path.exists(keywords_file) and os.path.getsize(keywords_file) > 0:
+            self.keywords = np.memmap(keywords_file, dtype='uint8', mode='r')
+        else:
+            self.keywords = np.zeros(len(self.positive), dtype='uint8')
         self.negative = np.memmap(negative_file, dtype='float32', mode='r')
         self.negative = self.negative.reshape(-1, input_size)
-
-        self.data = np.vstack([self.positive, self.negative])
-        self.labels = np.hstack([
-            np.ones(len(self.positive), dtype='float32'),
-            np.zeros(len(self.negative), dtype='float32')
-        ])
+        self.hard_negative = np.zeros((0, input_size), dtype='float32')
+        if hard_negative_file is not None and os.path.exists(hard_negative_file) and os.path.getsize(hard_negative_file) > 0:
+            self.hard_negative = np.memmap(hard_negative_file, dtype='float32', mode='r')
+            self.hard_negative = self.hard_negative.reshape(-1, input_size)
 
     def __len__(self):
-        return len(self.data)
+        return len(self.positive) + len(self.negative)
+
+    def __getitem__(self, indexes):
+        # Sorted indexes give sequential reads from each file
+        indexes = np.sort(np.asarray(indexes))
+        split = np.searchsorted(indexes, len(self.positive))
+        hard_split = np.searchsorted(indexes, len(self))
+        x = np.empty((len(indexes), self.input_size), dtype='float32')
+        x[:split] = self.positive[indexes[:split]]
+        x[split:hard_split] = self.negative[indexes[split:hard_split] - len(self.positive)]
+        x[hard_split:] = self.hard_negative[indexes[hard_split:] - len(self)]
+        y = np.zeros((len(indexes), len(cfg.KEYWORDS)), dtype='float32')
+        y[np.arange(split), self.keywords[indexes[:split]]] = 1
+        return torch.from_numpy(x), torch.from_numpy(y)
+
+class BatchIndexSampler(Sampler):
+    # Yields arrays of sample indexes for MemmapDataset, reshuffled on each epoch. If there are extra
+    # samples (hard negatives following the dataset), extra_ratio of each batch is drawn from them.
+    def __init__(self, size, batch_size, shuffle, seed=0, extra_size=0, extra_ratio=0.0):
+        self.size = size
+        self.extra_size = extra_size
+        self.extra_batch_size = int(round(batch_size * extra_ratio)) if extra_size > 0 else 0
+        self.batch_size = batch_size - self.extra_batch_size
+        self.shuffle = shuffle
+        self.generator = np.random.default_rng(seed)
 
-    def __getitem__(self, idx):
-        x = torch.from_numpy(self.data[idx])
-        y = torch.tensor(self.labels[idx])
-        return x, y
+    def __len__(self):
+        return (self.size + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        order = self.generator.permutation(self.size) if self.shuffle else np.arange(self.size)
+        for begin in range(0, self.size, self.batch_size):
+            batch = order[begin:begin + self.batch_size]
+            if self.extra_batch_size > 0:
+                extra = self.generator.integers(self.extra_size, size=self.extra_batch_size)
+                batch = np.concatenate((batch, self.size + extra))
+            yield batch
+
+def create_loader(dataset, batch_size, shuffle, hard_negative_ratio=0.0):
+    # Batches are already formed by the sampler, so automatic batching is disabled
+    workers = cfg.training.loader_workers
+    sampler = BatchIndexSampler(len(dataset), batch_size, shuffle, extra_size=len(dataset.hard_negative), extra_ratio=hard_negative_ratio)
+    return DataLoader(
+        dataset,
+        sampler=sampler,
+        batch_size=None,
+        num_workers=workers,
+        prefetch_factor=cfg.training.prefetch_batches if workers > 0 else None,
+        persistent_workers=workers > 0,
+        pin_memory=torch.cuda.is_available())
 
 def evaluate(model, dataloader, criterion):
     model.eval()
-    total_loss = 0.0
-    correct = 0
-    total = 0
-
-    all_preds = []
-    all_labels = []
-
-    with torch.no_grad():
+    # Logits of the whole validation set are collected first and all metrics are computed at once
+    size = len(dataloader.dataset)
+    logits = torch.empty(size, len(cfg.KEYWORDS))
+    labels = torch.empty(size, len(cfg.KEYWORDS))
+    begin = 0
+    with torch.inference_mode():
         for x, y in dataloader:
-            output = model(x).view(-1)
-            loss = criterion(output, y)
-            total_loss += loss.item()
-            preds = (output >= 0.0).float()
-            correct += (preds == y).sum().item()
-            total += y.size(0)
-            all_preds.extend(preds.cpu().numpy())
-            all_labels.extend(y.cpu().numpy())
-
-    avg_loss = total_loss / len(dataloader)
-    accuracy = correct / total
-
-    # Evaluation metrics
-    y_true = np.array(all_labels)
-    y_pred = np.array(all_preds)
-
-    cm = confusion_matrix(y_true, y_pred)
-    tn, fp, fn, tp = cm.ravel() if cm.size == 4 else (0, 0, 0, 0)
-
-    precision = precision_score(y_true, y_pred, zero_division=0)
-    recall = recall_score(y_true, y_pred, zero_division=0)
-    f1 = f1_score(y_true, y_pred, zero_division=0)
-
-    print(f"False Positives: {fp}/{fp + tn} = ({fp / (fp + tn) * 100:.2f}%)")
-    print(f"False Negatives: {fn}/{fn + tp} = ({fn / (fn + tp) * 100:.2f}%)")
-    print(f"Precision: {precision:.3f}")
-    print(f"Recall:    {recall:.3f}")
-    print(f"F1 Score:  {f1:.3f}")
-
-    return avg_loss, accuracy
+            end = begin + y.shape[0]
+            logits[begin:end] = model(x)
+            labels[begin:end] = y
+            begin = end
+        loss = criterion(logits, labels).item()
+    model.train()
+
+    # Each keyword is evaluated as a separate binary classifier, other keywords count as negatives
+    correct = 0
+    keyword_metrics = {}
+    for index, keyword in enumerate(cfg.KEYWORDS):
+        positive = labels[:, index] >= 0.5
+        if not 0 < int(positive.sum()) < size:
+            # Metrics are undefined without positive or negative samples, only the accuracy counts this keyword
+            correct += int(((logits[:, index] >= 0.0) == positive).sum())
+            print(f"Keyword {keyword.name}: skipped, no positive or no negative validation samples")
+            continue
+        metrics = binary_metrics(logits[:, index], labels[:, index], 0.0, cfg.training.target_false_accept_rate)
+        keyword_metrics[keyword.name] = metrics
+        tp, fp, fn, tn = metrics['tp'], metrics['fp'], metrics['fn'], metrics['tn']
+        correct += tp + tn
+
+        print(f"Keyword {keyword.name}:")
+        print(f"    False Positives: {fp}/{fp + tn} = ({fp / max(1, fp + tn) * 100:.2f}%)")
+        print(f"    False Negatives: {fn}/{fn + tp} = ({fn / max(1, fn + tp) * 100:.2f}%)")
+        print(f"    Precision: {metrics['precision']:.3f}")
+        print(f"    Recall:    {metrics['recall']:.3f}")
+        print(f"    F1 Score:  {metrics['f1']:.3f}")
+        print(f"    EER:       {metrics['eer'] * 100:.2f}% at {metrics['eer_threshold']:.3f}")
+        print(f"    Recall {metrics['target_recall']:.3f} at {metrics['target_false_accept_rate'] * 100:.3f}% false accepts, threshold {metrics['target_threshold']:.3f}")
+    accuracy = correct / max(1, labels.numel())
+
+    return loss, accuracy, keyword_metrics
+
+def check_manifest():
+    # Manifest written by the generator describes the datasets in the data directory
+    manifest = read_manifest(cfg.DATA_DIR / 'feature_cache')
+    if manifest is None:
+        return
+    if manifest['shape'] != [cfg.EMBEDDINGS_COUNT, cfg.FEATURES_COUNT]:
+        raise ValueError(f"Generated features have shape {manifest['shape']}, expected {[cfg.EMBEDDINGS_COUNT, cfg.FEATURES_COUNT]}.")
+    for name, dataset in manifest['datasets'].items():
+        print(f"Dataset {name}: {dataset['count']} samples in {dataset['file']}")
+        if 'keyword_names' in dataset and dataset['keyword_names'] != [keyword.name for keyword in cfg.KEYWORDS]:
+            raise ValueError(f"Dataset {name} was generated for keywords {dataset['keyword_names']}, expected {[keyword.name for keyword in cfg.KEYWORDS]}.")
+    print(f"Feature cache hits: {manifest['hits']}, misses: {manifest['misses']}")
 
 # ===== Training Function =====
 
 def train():
-    batch_size = 32
-    epochs = 100
-    lr = 1e-5
-
-    dataset = MemmapDataset('data/positive.dat', 'data/negative.dat', head_model_input_size)
-    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True)
-    val_dataset = MemmapDataset('data/v_positive.dat', 'data/v_negative.dat', head_model_input_size)
-    val_loader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False)
+    batch_size = cfg.training.batch_size
+    epochs = cfg.training.epochs
+    # Linear scaling of the learning rate with the batch size
+    lr = cfg.training.base_learning_rate * batch_size / cfg.training.base_batch_size
+
+    if cfg.training.threads > 0:
+        torch.set_num_threads(cfg.training.threads)
+    print(f"Batch size: {batch_size}, learning rate: {lr:.2e}, threads: {torch.get_num_threads()}, loader workers: {cfg.training.loader_workers}")
+
+    check_manifest()
+    dataset = MemmapDataset(cfg.DATA_DIR / 'positive.dat', cfg.DATA_DIR / 'negative.dat', head_model_input_size, cfg.DATA_DIR / 'hard_negative.dat')
+    print(f"Hard negatives: {len(dataset.hard_negative)}, ratio in batch: {cfg.mining.train_ratio if len(dataset.hard_negative) > 0 else 0}")
+    dataloader = create_loader(dataset, batch_size, shuffle=True, hard_negative_ratio=cfg.mining.train_ratio)
+    val_dataset = MemmapDataset(cfg.DATA_DIR / 'v_positive.dat', cfg.DATA_DIR / 'v_negative.dat', head_model_input_size)
+    val_loader = create_loader(val_dataset, batch_size, shuffle=False)
 
     model = SharedLinearNet()
     #criterion = nn.BCELoss()
-    criterion = nn.BCEWithLogitsLoss(pos_weight=torch.tensor([3.0]))
+    criterion = nn.BCEWithLogitsLoss(pos_weight=torch.tensor([cfg.training.positive_weight]))
     optimizer = optim.Adam(model.parameters(), lr=lr)
+    augment = EmbeddingAugmenter()
 
     # TensorBoard setup
     log_dir = f"runs/binary_classifier_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
@@ -133,32 +182,42 @@ def train():
 
     for epoch in range(epochs):
         progress_bar.update()
-        correct = 0
+        # Metrics stay on tensors and are read once per epoch
+        correct = torch.zeros((), dtype=torch.int64)
         total = 0
-        total_loss = 0.0
-        for batch_idx, (x, y) in enumerate(dataloader):
-            optimizer.zero_grad()
-            output = model(x).squeeze()
+        total_loss = torch.zeros(())
+        start = time.perf_counter()
+        for x, y in dataloader:
+            x = augment(x, y)
+            optimizer.zero_grad(set_to_none=True)
+            output = model(x)
             loss = criterion(output, y)
             loss.backward()
             optimizer.step()
-            total_loss += loss.item()
-            preds = (output >= 0.5).float()
-            correct += (preds == y).sum().item()
-            total += y.size(0)
-
-        avg_loss = total_loss / len(dataloader)
-        accuracy = correct / total
-        val_loss, val_accuracy = evaluate(model, val_loader, criterion)
+            output = output.detach()
+            total_loss += loss.detach() * y.shape[0]
+            correct += ((output >= 0.0) == (y >= 0.5)).sum()
+            total += y.shape[0]
+
+        avg_loss = total_loss.item() / total
+        accuracy = correct.item() / (total * len(cfg.KEYWORDS))
+        writer.add_scalar("Throughput/train_samples_per_second", total / (time.perf_counter() - start), epoch)
+        val_loss, val_accuracy, metrics = evaluate(model, val_loader, criterion)
         writer.add_scalars("Loss", {"train": avg_loss, "val": val_loss}, epoch)
         writer.add_scalars("Accuracy", {"train": accuracy, "val": val_accuracy}, epoch)
+        for name, keyword_metrics in metrics.items():
+            writer.add_scalar(f"Validation/{name}/eer", keyword_metrics['eer'], epoch)
+            writer.add_scalar(f"Validation/{name}/roc_auc", keyword_metrics['roc_auc'], epoch)
+            writer.add_scalar(f"Validation/{name}/average_precision", keyword_metrics['average_precision'], epoch)
+            writer.add_scalar(f"Validation/{name}/target_recall", keyword_metrics['target_recall'], epoch)
+            writer.add_scalar(f"Validation/{name}/target_threshold", keyword_metrics['target_threshold'], epoch)
         writer.flush()
         progress_bar.set_description(f"Loss: {avg_loss:.7f}, Acc: {accuracy*100:.2f}%, VLoss: {val_loss:.8f}, VAcc: {val_accuracy*100:.2f}%", True)
-        torch.save(model.state_dict(), "binary_model.pth")
+        torch.save(model.state_dict(), ROOT / "binary_model.pth")
 
     writer.close()
     #torch.save(model.state_dict(), "binary_model.pth")
-    print("Training complete. Model saved to binary_model.pth")
+    print(f"Training complete. Model saved to {ROOT / 'binary_model.pth'}")
 
 if __name__ == "__main__":
     train()
@@ -1,125 +1,103 @@
+import os
+import sys
 import numpy as np
 import math
 import sounddevice as sd
-import queue
+import time
 import threading
 import onnxruntime as ort
-import torch.nn as nn
-import torch
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.detector import StreamingDetector, KeywordDecoder, STEP_SMPL, AUDIO_CONTEXT_SMPL, MEL_WINDOW_FRAMES
+from src.common import ROOT
+from src.inference import load_model, select_backend
+from src.audio_queue import AudioQueue, OVERLOAD_POLICIES
+import src.config as cfg
 
 # Parameters
 SAMPLE_RATE = 16000
-FRAME_SIZE = 640
-STEP_SIZE = 160
-FIRST_MODEL_OUTPUT_SIZE = 32
-SECOND_MODEL_INPUT_SIZE = 76
-SECOND_MODEL_STEP = 8  # Vectors per step -> 1280 samples
 
-# Load first model (ONNX or TFLite)
-USE_TFLITE = False  # Change to True to use TFLite
-FIRST_MODEL_PATH = "models/melspectrogram.onnx"  # or .tflite
-SECOND_MODEL_PATH = "models/embedding_model.onnx"  # or .tflite
-
-head_model_input_size = 96 * 27
-shared_input_parts = 3
-shared_output_size = 16
-middle_layer_size = 16
-
-# ===== Model Definition =====
-
-class SharedLinearNet(nn.Module):
-    def __init__(self):
-        super(SharedLinearNet, self).__init__()
-
-        assert head_model_input_size % shared_input_parts == 0, "Input size must be divisible by number of parts"
-
-        self.part_size = head_model_input_size // shared_input_parts
-        self.shared_linear = nn.Linear(self.part_size, shared_output_size)
-
-        self.classifier = nn.Sequential(
-            nn.ReLU(),
-            nn.Linear(shared_output_size * shared_input_parts, middle_layer_size),
-            nn.ReLU(),
-            nn.Linear(middle_layer_size, 1),
-            #nn.Sigmoid()
-        )
-
-    def forward(self, x):
-        parts = torch.chunk(x, chunks=shared_input_parts, dim=0)
-        transformed_parts = [self.shared_linear(part) for part in parts]
-        combined = torch.cat(transformed_parts, dim=0)
-        return self.classifier(combined)
-
-
-def load_model(path, use_tflite=False):
-    if use_tflite:
-        interpreter = tflite.Interpreter(model_path=path)
-        interpreter.allocate_tensors()
-        input_details = interpreter.get_input_details()
-        output_details = interpreter.get_output_details()
-        return ('tflite', interpreter, input_details, output_details)
-    else:
-        session = ort.InferenceSession(path)
-        input_name = session.get_inputs()[0].name
-        output_name = session.get_outputs()[0].name
-        print(path)
-        print('    input ', session.get_inputs()[0])
-        print('    output ', session.get_outputs()[0])
-        return ('onnx', session, input_name, output_name)
-
-first_model = load_model(FIRST_MODEL_PATH, USE_TFLITE)
-second_model = load_model(SECOND_MODEL_PATH, USE_TFLITE)
+# Runtime of the first and second model (TFLite or ONNX) is selected by the configuration (inference.backend)
+
+# Head model exported by 08.export-head.py, PyTorch model is used if it does not exist or is older
+# than the PyTorch model (retrained by 05.train.py and not exported again)
+HEAD_MODEL_PATH = ROOT / "binary_model.onnx"
+HEAD_MODEL_TORCH_PATH = ROOT / "binary_model.pth"
+
+
+def load_head():
+    if HEAD_MODEL_PATH.exists():
+        if not HEAD_MODEL_TORCH_PATH.exists() or HEAD_MODEL_PATH.stat().st_mtime >= HEAD_MODEL_TORCH_PATH.stat().st_mtime:
+            session = ort.InferenceSession(str(HEAD_MODEL_PATH))
+            return lambda features: session.run(['score'], {'features': features.reshape(1, -1)})[0][0]
+        print(f'Warning: {HEAD_MODEL_PATH} is older than {HEAD_MODEL_TORCH_PATH}, using the PyTorch model. '
+              'Run 08.export-head.py to export it again.')
+    import torch
+    from src.head_model import load_head_model
+    model = load_head_model(HEAD_MODEL_TORCH_PATH)
+    def run_head(features):
+        with torch.no_grad():
+            return model(torch.from_numpy(features)).numpy()
+    return run_head
+
+backend, threads = select_backend('streaming')
+print(f'Inference backend: {backend}, threads: {threads if threads > 0 else "default"}')
+first_model = load_model('melspectrogram', [1, AUDIO_CONTEXT_SMPL + STEP_SMPL], 'streaming')
+second_model = load_model('embedding_model', [1, MEL_WINDOW_FRAMES, cfg.MEL_FREQUENCY_VALUES, 1], 'streaming')
+
+if cfg.streaming.overload_policy not in OVERLOAD_POLICIES:
+    raise ValueError(f'Unknown overload policy "{cfg.streaming.overload_policy}", expected one of {OVERLOAD_POLICIES}.')
 
 # Audio stream setup
-audio_queue = queue.Queue()
+audio_queue = AudioQueue(cfg.streaming.queue_steps, STEP_SMPL)
 
-def audio_callback(indata, frames, time, status):
+def audio_callback(indata, frames, time_info, status):
     if status:
         print("Audio status:", status)
-    audio_queue.put(indata.copy())
+    # The block is complete when the callback is called, so this is the capture time of its last sample
+    audio_queue.put(indata.reshape(-1), time.perf_counter())
+
+def print_report(latencies, skipped):
+    latencies = np.array(latencies) * 1000
+    print(f'Queue depth: {audio_queue.depth} (max {audio_queue.max_depth} of {audio_queue.capacity}), '
+          f'dropped blocks: {audio_queue.dropped}, skipped embeddings: {skipped}, '
+          f'latency: mean {latencies.mean():.1f} ms, max {latencies.max():.1f} ms')
 
 # Processing thread
 def process_audio():
-    mel = np.zeros((76, 32), dtype=np.float32)  # Placeholder for mel spectrogram
-    history = np.zeros(480, dtype=np.float32)
-    features = np.zeros((27, 96), dtype=np.float32)
-    model = SharedLinearNet()
-    model.load_state_dict(torch.load("binary_model.pth"))
-    model.eval()
     abs_max = 0.0
+    detector = StreamingDetector(first_model, second_model, load_head())
+    decoder = KeywordDecoder()
+    block = np.zeros(STEP_SMPL, dtype=np.float32)
+    latencies = []
 
     while True:
         # Pull new audio
-        new_audio = audio_queue.get()
-        new_audio = new_audio.flatten().astype(np.float32)
-        full_window = np.concatenate((history, new_audio))
-        history = full_window[-480:]
-        #print("-- ", len(full_window), min(full_window), max(full_window))
-        input_tensor = full_window.astype(np.float32).reshape(1, -1)
-        mel_output = first_model[1].run([first_model[3]], {(first_model[2]): input_tensor})[0].reshape(8, -1)
-        mel[:-8] = mel[8:].copy()
-        mel[-8:] = mel_output
-        #print("-- ", min(mel.flatten()), max(mel.flatten()))
-        features_output = second_model[1].run([second_model[3]], {(second_model[2]): mel.reshape((1, 76, 32, 1))})[0].flatten()
-        features[:-1] = features[1:].copy()
-        features[-1] = features_output
-        #print("-- ", features.shape, min(features.flatten()), max(features.flatten()))
-        output = model(torch.from_numpy(features.flatten()))
-        result = output.detach().numpy()[0]
-        abs_max = max(abs_max, abs(result))
-        if result > 0:
-            RED = "\033[91m"
-            RESET = "\033[0m"
-            #print(f"{RED}{result:3.2f} - DETECTED!!!{RESET}")
-            mag = math.ceil(result / (abs_max if abs_max > 0 else 1) * 20)
-            print(RED + ' ' * 20 + '█' * mag + ' ' * (20 - mag) + f' {result:3.2f} - DETECTED!!!' + RESET)
-        else:
-            mag = math.ceil(result / (abs_max if abs_max > 0 else 1) * -20)
-            print(' ' * (20 - mag) + '▒' * mag + ' ' * 20 + f' {result:3.2f}')
-        continue
+        length, capture_time = audio_queue.get(block)
+        skip_embedding = cfg.streaming.overload_policy == 'skip_embedding' and audio_queue.depth > cfg.streaming.skip_embedding_depth
+        for scores in detector.process(block[:length], skip_embedding):
+            # Latency from the capture of the last sample of the step to its score
+            latencies.append(time.perf_counter() - capture_time)
+            if len(latencies) == cfg.streaming.report_interval_steps:
+                print_report(latencies, detector.overload_skips)
+                latencies.clear()
+            detected = decoder.update(scores)
+            # Show the keyword with the highest score
+            keyword = int(np.argmax(scores))
+            result = float(scores[keyword])
+            abs_max = max(abs_max, abs(result))
+            if result > 0:
+                RED = "\033[91m"
+                RESET = "\033[0m"
+                #print(f"{RED}{result:3.2f} - DETECTED!!!{RESET}")
+                mag = math.ceil(result / (abs_max if abs_max > 0 else 1) * 20)
+                status = f' - {cfg.KEYWORDS[keyword].name} DETECTED!!!' if keyword in detected else ''
+                print(RED + ' ' * 20 + '█' * mag + ' ' * (20 - mag) + f' {result:3.2f}{status}' + RESET)
+            else:
+                mag = math.ceil(result / (abs_max if abs_max > 0 else 1) * -20)
+                print(' ' * (20 - mag) + '▒' * mag + ' ' * 20 + f' {result:3.2f}')
 
 # Start audio input stream
-stream = sd.InputStream(callback=audio_callback, channels=1, samplerate=SAMPLE_RATE, blocksize=1280)
+stream = sd.InputStream(callback=audio_callback, channels=1, samplerate=SAMPLE_RATE, blocksize=STEP_SMPL)
 stream.start()
 
 # Start processing thread
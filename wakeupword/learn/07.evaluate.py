@@ -0,0 +1,149 @@
+import os
+import sys
+import time
+import numpy as np
+import numpy.typing as npt
+import torch
+from tqdm import tqdm
+from scipy.io import wavfile
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.common import find_samples, keyword_index, ROOT, SampleSet
+from src.detector import StreamingDetector, KeywordDecoder, STEP_SMPL, AUDIO_CONTEXT_SMPL, MEL_WINDOW_FRAMES
+from src.inference import load_model
+from src.head_model import load_head_model
+import src.config as cfg
+
+# Replays the labeled recordings through the detector as fast as possible and compares
+# the detections with the positive labels. If the voice activity gate is enabled, the recordings
+# are also replayed without it to report the saved compute and the recall lost by the gate.
+
+
+class TimedModel:
+    # Measures the time spent in the wrapped model
+    def __init__(self, model):
+        self.model = model
+        self.runs = 0
+        self.seconds = 0.0
+
+    def __call__(self, input: npt.NDArray[np.float32]) -> npt.NDArray[np.float32]:
+        start = time.perf_counter()
+        output = self.model(input)
+        self.seconds += time.perf_counter() - start
+        self.runs += 1
+        return output
+
+
+def load_head():
+    model = load_head_model(ROOT / 'binary_model.pth')
+    def run(features: npt.NDArray[np.float32]) -> npt.NDArray[np.float32]:
+        with torch.no_grad():
+            return model(torch.from_numpy(features).reshape(1, -1)).numpy()
+    return run
+
+
+def detect_events(scores: npt.NDArray[np.float32]) -> list[npt.NDArray[np.float64]]:
+    # Times (in seconds) of the detections of each keyword, decoded the same way as in the live detection
+    decoder = KeywordDecoder()
+    events: list[list[int]] = [[] for _ in cfg.KEYWORDS]
+    for step in range(scores.shape[0]):
+        for keyword in decoder.update(scores[step]):
+            events[keyword].append(step)
+    # Score of step N is available after (N + 1) * STEP_SMPL samples
+    return [(np.array(steps, dtype=np.float64) + 1) * STEP_SMPL / cfg.SAMPLE_RATE for steps in events]
+
+
+class Results:
+    def __init__(self):
+        self.positive = np.zeros(len(cfg.KEYWORDS), dtype=np.int64)
+        self.detected = np.zeros(len(cfg.KEYWORDS), dtype=np.int64)
+        self.false_accepts = np.zeros(len(cfg.KEYWORDS), dtype=np.int64)
+        self.latencies: list[list[float]] = [[] for _ in cfg.KEYWORDS]
+        self.audio_seconds = 0.0
+        self.process_seconds = 0.0
+        self.steps = 0
+        self.embedding_runs = 0
+
+    def add(self, sample: SampleSet, events: list[npt.NDArray[np.float64]]) -> None:
+        # Detections of a keyword that do not match any label of the same keyword are false accepts
+        matched = [np.zeros(keyword_events.shape[0], dtype=bool) for keyword_events in events]
+        for label in sample.labels:
+            keyword = keyword_index(label)
+            if keyword < 0:
+                continue
+            self.positive[keyword] += 1
+            inside = (events[keyword] >= label.begin) & (events[keyword] <= label.end + cfg.evaluation.max_latency_ms / 1000)
+            if inside.any():
+                self.detected[keyword] += 1
+                self.latencies[keyword].append(events[keyword][np.argmax(inside)] - label.end)
+            matched[keyword] |= inside
+        for keyword in range(len(cfg.KEYWORDS)):
+            self.false_accepts[keyword] += int((~matched[keyword]).sum())
+
+    def false_rejects(self) -> npt.NDArray[np.int64]:
+        return self.positive - self.detected
+
+    def print(self) -> None:
+        if self.audio_seconds == 0:
+            print('Audio:             no recordings evaluated')
+            return
+        hours = self.audio_seconds / 3600
+        print(f'Audio:             {hours:.2f} h in {self.process_seconds:.1f} s')
+        print(f'Real-time factor:  {self.process_seconds / self.audio_seconds:.4f} ({self.audio_seconds / max(1e-9, self.process_seconds):.1f}x faster than real time)')
+        for keyword in range(len(cfg.KEYWORDS)):
+            if len(cfg.KEYWORDS) > 1:
+                print(f'Keyword "{cfg.KEYWORDS[keyword].name}":')
+            false_rejects = self.false_rejects()[keyword]
+            print(f'Positive labels:   {self.positive[keyword]}')
+            print(f'False rejects:     {false_rejects} ({false_rejects / max(1, self.positive[keyword]) * 100:.2f}%)')
+            print(f'False accepts:     {self.false_accepts[keyword]} ({self.false_accepts[keyword] / hours:.2f} per hour)')
+            if len(self.latencies[keyword]) > 0:
+                latencies = np.array(self.latencies[keyword]) * 1000
+                print(f'Latency:           mean {latencies.mean():.0f} ms, median {np.median(latencies):.0f} ms, 90% {np.percentile(latencies, 90):.0f} ms')
+
+
+def replay(detector: StreamingDetector, results: Results, sample: SampleSet, data: npt.NDArray[np.int16]) -> None:
+    start = time.perf_counter()
+    scores = np.array(detector.process(data), dtype=np.float32).reshape(-1, len(cfg.KEYWORDS))
+    results.process_seconds += time.perf_counter() - start
+    results.audio_seconds += data.shape[0] / cfg.SAMPLE_RATE
+    results.steps += detector.steps
+    results.embedding_runs += detector.embedding_runs
+    results.add(sample, detect_events(scores))
+
+
+def print_gate(gated: Results, reference: Results, embedding: TimedModel) -> None:
+    if gated.audio_seconds == 0:
+        return
+    hours = gated.audio_seconds / 3600
+    skipped = gated.steps - gated.embedding_runs
+    embedding_ms = embedding.seconds / max(1, embedding.runs) * 1000
+    print('Voice activity gate:')
+    print(f'Embedding runs:    {gated.embedding_runs} of {gated.steps} steps, {skipped / max(1, gated.steps) * 100:.1f}% skipped')
+    print(f'Compute saved:     {skipped / hours * embedding_ms / 1000:.1f} s per hour ({embedding_ms:.2f} ms per embedding run)')
+    print(f'Processing time:   {gated.process_seconds:.1f} s, without the gate {reference.process_seconds:.1f} s')
+    for keyword in range(len(cfg.KEYWORDS)):
+        lost = gated.false_rejects()[keyword] - reference.false_rejects()[keyword]
+        print(f'Recall loss "{cfg.KEYWORDS[keyword].name}": {lost} of {reference.positive[keyword]} labels ({lost / max(1, reference.positive[keyword]) * 100:.2f}%), '
+              f'false accepts change {gated.false_accepts[keyword] - reference.false_accepts[keyword]:+d}')
+
+
+def evaluate():
+    melspectrogram = load_model('melspectrogram', [1, AUDIO_CONTEXT_SMPL + STEP_SMPL], 'streaming')
+    embedding = TimedModel(load_model('embedding_model', [1, MEL_WINDOW_FRAMES, cfg.MEL_FREQUENCY_VALUES, 1], 'streaming'))
+    head = load_head()
+    results = Results()
+    reference = Results()
+    for sample in tqdm(find_samples(cfg.SAMPLE_DIR)):
+        sample_rate, data = wavfile.read(sample.wav)
+        if sample_rate != cfg.SAMPLE_RATE:
+            raise ValueError(f"Invalid sample rate in {sample.wav}.")
+        replay(StreamingDetector(melspectrogram, embedding, head), results, sample, data)
+        if cfg.vad.enabled:
+            replay(StreamingDetector(melspectrogram, embedding, head, vad=False), reference, sample, data)
+    results.print()
+    if cfg.vad.enabled:
+        print_gate(results, reference, embedding)
+
+
+if __name__ == "__main__":
+    evaluate()
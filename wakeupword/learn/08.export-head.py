@@ -0,0 +1,39 @@
+import os
+import sys
+import time
+import numpy as np
+import onnxruntime as ort
+import torch
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.common import ROOT
+import src.config as cfg
+from src.head_model import StackedHeads, export_onnx, head_model_input_size, load_head_model
+
+# Exports the trained head model to ONNX, so the detector can run without PyTorch. If paths of
+# separately trained heads are given as arguments, they are exported as a single model with the
+# outputs of all heads in the order of the arguments (it must match the configured KEYWORDS).
+
+torch_paths = sys.argv[1:] if len(sys.argv) > 1 else [ROOT / 'binary_model.pth']
+onnx_path = ROOT / 'binary_model.onnx'
+
+heads = [load_head_model(path) for path in torch_paths]
+model = heads[0] if len(heads) == 1 else StackedHeads(heads)
+model.eval()
+outputs = model(torch.zeros(1, head_model_input_size)).shape[-1]
+if outputs != len(cfg.KEYWORDS):
+    raise ValueError(f'Head model has {outputs} outputs, but {len(cfg.KEYWORDS)} keywords are configured.')
+export_onnx(model, onnx_path)
+
+start = time.perf_counter()
+session = ort.InferenceSession(str(onnx_path))
+load_time = time.perf_counter() - start
+
+features = np.random.default_rng(0).standard_normal((256, head_model_input_size)).astype(np.float32)
+with torch.no_grad():
+    expected = model(torch.from_numpy(features)).numpy()
+actual = session.run(['score'], {'features': features})[0]
+max_error = np.abs(expected - actual).max()
+print(f'Exported {onnx_path} ({onnx_path.stat().st_size / 1024:.1f} KiB), loaded in {load_time * 1000:.1f} ms')
+print(f'Maximum difference from PyTorch model: {max_error:.2e}')
+if max_error > 1e-4:
+    raise ValueError('Exported model does not match the PyTorch model.')
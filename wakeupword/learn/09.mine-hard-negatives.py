@@ -0,0 +1,118 @@
+import os
+import sys
+import hashlib
+import numpy as np
+import numpy.typing as npt
+import torch
+from tqdm import tqdm
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.common import Label, ROOT
+from src.label_index import load_label_index
+from src.features import FeatureExtractor
+from src.feature_cache import KEY_SIZE
+from src.corpus import open_corpus, load_sample_corpus
+from src.head_model import SharedLinearNet, load_head_model
+import src.config as cfg
+
+# Scores the negative recordings and background sounds with the current head model and appends
+# windows scoring above the threshold to the hard negatives used by the training. Windows that are
+# already in the hard negatives are skipped, so the mining can be repeated after each training.
+
+HARD_NEGATIVE_FILE = cfg.DATA_DIR / 'hard_negative.dat'
+HARD_NEGATIVE_KEYS_FILE = cfg.DATA_DIR / 'hard_negative.keys'
+
+# Background sounds packed by 03.download-background.py
+background = open_corpus('esc50')
+# Recordings of the labels packed once, so each recording is decoded only once for all of its labels
+label_index = load_label_index(cfg.SAMPLE_DIR)
+samples = load_sample_corpus(label_index)
+
+
+def load_keys() -> set[bytes]:
+    if not HARD_NEGATIVE_KEYS_FILE.exists() or not HARD_NEGATIVE_FILE.exists():
+        HARD_NEGATIVE_FILE.unlink(missing_ok=True)
+        HARD_NEGATIVE_KEYS_FILE.unlink(missing_ok=True)
+        return set()
+    # An interrupted run can leave a partial window or the files out of step, only complete records are kept
+    window_size = cfg.EMBEDDINGS_COUNT * cfg.FEATURES_COUNT * np.dtype(np.float32).itemsize
+    count = min(HARD_NEGATIVE_FILE.stat().st_size // window_size, HARD_NEGATIVE_KEYS_FILE.stat().st_size // KEY_SIZE)
+    os.truncate(HARD_NEGATIVE_FILE, count * window_size)
+    os.truncate(HARD_NEGATIVE_KEYS_FILE, count * KEY_SIZE)
+    keys = np.fromfile(HARD_NEGATIVE_KEYS_FILE, dtype=np.uint8).reshape(-1, KEY_SIZE)
+    return {key.tobytes() for key in keys}
+
+
+def get_sources() -> list[tuple[str, 'Label|int']]:
+    # Negative labels from the recordings and whole background sounds (indexes in the corpus), name is used for the window keys
+    _, negative_labels = label_index.labels()
+    sources = []
+    for label in negative_labels:
+        sources.append((f'{label.set.wav.relative_to(cfg.SAMPLE_DIR)}:{label.begin}:{label.end}', label))
+    for index, name in enumerate(background.names.tolist()):
+        sources.append((f'esc50/{name}', index))
+    return sources
+
+
+def read_source(source: 'Label|int') -> npt.NDArray[np.float32]:
+    if isinstance(source, int):
+        return background[source].astype(np.float32) / 32767
+    data = samples[samples.find(source.set.wav.relative_to(label_index.root).as_posix())]
+    begin_smpl = int(round(source.begin * cfg.SAMPLE_RATE))
+    end_smpl = int(round(source.end * cfg.SAMPLE_RATE))
+    return data[begin_smpl:end_smpl].astype(np.float32) / 32767
+
+
+def head_windows(features: npt.NDArray[np.float32]) -> npt.NDArray[np.float32]:
+    # Strided view (windows, EMBEDDINGS_COUNT, FEATURES_COUNT) over the features of a recording, one window for each step
+    count = features.shape[0] - cfg.EMBEDDINGS_COUNT + 1
+    return np.lib.stride_tricks.as_strided(
+        features,
+        shape=(count, cfg.EMBEDDINGS_COUNT, cfg.FEATURES_COUNT),
+        strides=(features.strides[0], features.strides[0], features.strides[1]),
+        writeable=False)
+
+
+def score_windows(model: SharedLinearNet, windows: npt.NDArray[np.float32]) -> npt.NDArray[np.float32]:
+    scores = np.empty(windows.shape[0], dtype=np.float32)
+    with torch.inference_mode():
+        for begin in range(0, windows.shape[0], cfg.mining.batch_size):
+            batch = np.ascontiguousarray(windows[begin:begin + cfg.mining.batch_size])
+            # Highest score of all keywords
+            output = model(torch.from_numpy(batch.reshape(batch.shape[0], -1)))
+            scores[begin:begin + batch.shape[0]] = output.amax(-1).numpy()
+    return scores
+
+
+def mine():
+    model = load_head_model(ROOT / 'binary_model.pth')
+    extractor = FeatureExtractor(cfg.generation.feature_batch_size)
+    known_keys = load_keys()
+    print(f'Hard negatives already collected: {len(known_keys)}')
+    windows_total = 0
+    added = 0
+    seconds = 0.0
+    cfg.DATA_DIR.mkdir(parents=True, exist_ok=True)
+    with open(HARD_NEGATIVE_FILE, 'ab') as features_file, open(HARD_NEGATIVE_KEYS_FILE, 'ab') as keys_file:
+        progress_bar = tqdm(get_sources())
+        for name, source in progress_bar:
+            audio = read_source(source)
+            seconds += audio.shape[0] / cfg.SAMPLE_RATE
+            features = extractor.get_recording_features(audio)
+            if features.shape[0] < cfg.EMBEDDINGS_COUNT:
+                continue
+            windows = head_windows(features)
+            windows_total += windows.shape[0]
+            for step in np.flatnonzero(score_windows(model, windows) > cfg.mining.threshold):
+                key = hashlib.blake2b(f'{name}:{step}'.encode(), digest_size=KEY_SIZE).digest()
+                if key in known_keys:
+                    continue
+                known_keys.add(key)
+                features_file.write(windows[step].tobytes())
+                keys_file.write(key)
+                added += 1
+            progress_bar.set_description(f'Added {added}', False)
+    print(f'Scored {windows_total} windows from {seconds / 3600:.2f} h of audio, added {added} hard negatives, {len(known_keys)} in total.')
+
+
+if __name__ == "__main__":
+    mine()
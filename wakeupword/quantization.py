@@ -1,36 +1,189 @@
-import torch
-from onnx2torch import convert
-import onnx
-
-
-# Step 1: Load ONNX model and convert to PyTorch
-#onnx_model_path = 'models/embedding_model.onnx'
-onnx_model_path = 'models/melspectrogram.onnx'
-onnx_model = onnx.load(onnx_model_path)
-onnx.checker.check_model(onnx_model)
-print(onnx.helper.printable_graph(onnx_model.graph))
-pytorch_model = convert(onnx_model)
-pytorch_model.eval()
-
-# Step 2: (Optional) Fuse layers for better quantization performance
-# This works only for certain layer patterns
-# You may skip or modify depending on your model structure
-# Example:
-# pytorch_model = torch.quantization.fuse_modules(pytorch_model, [['conv', 'bn', 'relu']], inplace=False)
-
-# Step 3: Define quantization config
-pytorch_model.qconfig = torch.quantization.get_default_qconfig('fbgemm')
-
-# Step 4: Prepare the model for static quantization
-torch.quantization.prepare(pytorch_model, inplace=True)
-
-# Step 5: Calibrate with representative data
-# Replace this with a batch from your real dataset
-example_input = torch.randn(1, 1, 76, 32)
-pytorch_model(example_input)
-
-# Step 6: Convert the model to quantized version
-quantized_model = torch.quantization.convert(pytorch_model, inplace=False)
-
-# Step 7: Save the quantized PyTorch model
-torch.save(quantized_model.state_dict(), 'quantized_model.pt')
+import json
+import time
+import random
+import numpy as np
+import numpy.typing as npt
+import onnxruntime as ort
+from onnxruntime.quantization import quantize_static, quant_pre_process, CalibrationDataReader, CalibrationMethod, QuantFormat, QuantType
+from scipy.io import wavfile
+from tqdm import tqdm
+from src.common import find_labels, Label
+from src.features import embedding_windows, EMBEDDING_INPUT_FRAMES
+import src.config as cfg
+
+# Creates int8 versions of the melspectrogram and embedding models (models/*.int8.onnx) using static
+# quantization calibrated on real windows from the samples. Set cfg.MODEL_VARIANT = '.int8' to use them.
+# Writes a report comparing size, latency and drift of the features against the float models.
+
+CALIBRATION_WINDOWS = 256
+TEST_WINDOWS = 128
+# Number of embedding model inputs used for calibration, taken from the calibration windows
+EMBEDDING_CALIBRATION_INPUTS = 2048
+CALIBRATION_BATCH_SIZE = 16
+LATENCY_REPEATS = 50
+MODEL_NAMES = ('melspectrogram', 'embedding_model')
+# Only the STFT convolution of the melspectrogram is quantized, the power spectrum has too
+# large dynamic range for int8 and quantized filter bank destroys the quiet parts
+OPS_TO_QUANTIZE = {'melspectrogram': ['Conv'], 'embedding_model': None}
+REPORT_FILE = cfg.MODELS_DIR / 'quantization_report.json'
+
+window_smpl = cfg.INPUT_WINDOW_LENGTH_MS * cfg.SAMPLES_PER_MS
+
+
+def read_window(label: Label, positive: bool) -> npt.NDArray[np.float32]:
+    sample_rate, data = wavfile.read(label.set.wav)
+    if sample_rate != cfg.SAMPLE_RATE:
+        raise ValueError(f"Invalid sample rate in {label.set.wav}.")
+    if positive:
+        # The word ends where the detection is expected, as in the generated positive samples
+        end_smpl = int(round(label.end * sample_rate)) + cfg.WORD_SUFFIX_LENGTH_MS * cfg.SAMPLES_PER_MS
+    else:
+        begin_smpl = int(round(label.begin * sample_rate))
+        end_smpl = max(int(round(label.end * sample_rate)), begin_smpl + window_smpl)
+        end_smpl = random.randint(begin_smpl + window_smpl, end_smpl)
+    window = np.zeros(window_smpl, dtype=np.float32)
+    part = data[max(0, end_smpl - window_smpl):end_smpl]
+    window[window_smpl - part.shape[0]:] = part.astype(np.float32) / 32767
+    return window
+
+
+def read_windows(count: int) -> npt.NDArray[np.float32]:
+    # Half of the windows with positive words, the rest with negative audio
+    positive_labels, negative_labels = find_labels(cfg.SAMPLE_DIR)
+    windows = np.empty((count, window_smpl), dtype=np.float32)
+    for i in range(count):
+        positive = (i % 2 == 0 and len(positive_labels) > 0) or len(negative_labels) == 0
+        windows[i] = read_window(random.choice(positive_labels if positive else negative_labels), positive)
+    return windows
+
+
+class Session:
+    def __init__(self, path):
+        self.session = ort.InferenceSession(str(path), providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, input: npt.NDArray[np.float32]) -> npt.NDArray[np.float32]:
+        return self.session.run(None, {self.input_name: input})[0]
+
+
+def melspectrogram_inputs(windows: npt.NDArray[np.float32]) -> list[npt.NDArray[np.float32]]:
+    return [windows[begin:begin + CALIBRATION_BATCH_SIZE] for begin in range(0, windows.shape[0], CALIBRATION_BATCH_SIZE)]
+
+
+def embedding_inputs(melspectrogram: Session, windows: npt.NDArray[np.float32], limit: int) -> list[npt.NDArray[np.float32]]:
+    inputs = np.concatenate([mel_windows(melspectrogram, batch) for batch in melspectrogram_inputs(windows)])
+    inputs = inputs[np.random.default_rng(0).permutation(inputs.shape[0])[:limit]]
+    return [inputs[begin:begin + CALIBRATION_BATCH_SIZE * cfg.EMBEDDINGS_COUNT] for begin in range(0, inputs.shape[0], CALIBRATION_BATCH_SIZE * cfg.EMBEDDINGS_COUNT)]
+
+
+def mel_windows(melspectrogram: Session, windows: npt.NDArray[np.float32]) -> npt.NDArray[np.float32]:
+    # Embedding model inputs (N * EMBEDDINGS_COUNT, 76, 32, 1) of the windows
+    spec = melspectrogram(windows).reshape(windows.shape[0], -1, cfg.MEL_FREQUENCY_VALUES)
+    return np.ascontiguousarray(embedding_windows(spec, cfg.EMBEDDINGS_COUNT)).reshape(-1, EMBEDDING_INPUT_FRAMES, cfg.MEL_FREQUENCY_VALUES, 1)
+
+
+class Reader(CalibrationDataReader):
+    def __init__(self, input_name: str, inputs: list[npt.NDArray[np.float32]]):
+        self.input_name = input_name
+        self.inputs = iter(tqdm(inputs, desc='Calibration'))
+
+    def get_next(self):
+        input = next(self.inputs, None)
+        return None if input is None else {self.input_name: input}
+
+
+def quantize(name: str, inputs: list[npt.NDArray[np.float32]]) -> None:
+    float_path = cfg.MODELS_DIR / f'{name}.onnx'
+    prepared_path = cfg.MODELS_DIR / f'{name}.prepared.onnx'
+    quant_pre_process(str(float_path), str(prepared_path), skip_symbolic_shape=True)
+    quantize_static(
+        str(prepared_path),
+        str(cfg.MODELS_DIR / f'{name}.int8.onnx'),
+        Reader(Session(float_path).input_name, inputs),
+        quant_format=QuantFormat.QDQ,
+        activation_type=QuantType.QInt8,
+        weight_type=QuantType.QInt8,
+        per_channel=True,
+        op_types_to_quantize=OPS_TO_QUANTIZE[name],
+        calibrate_method=CalibrationMethod.MinMax,
+        # Ranges are averaged over the batches, so rare peaks do not waste the int8 range
+        extra_options={'CalibMovingAverage': True})
+    prepared_path.unlink()
+
+
+def latency_ms(model: Session, input: npt.NDArray[np.float32]) -> float:
+    model(input)
+    start = time.perf_counter()
+    for _ in range(LATENCY_REPEATS):
+        model(input)
+    return (time.perf_counter() - start) / LATENCY_REPEATS * 1000
+
+
+def features(melspectrogram: Session, embedding: Session, windows: npt.NDArray[np.float32]) -> npt.NDArray[np.float32]:
+    result = [embedding(mel_windows(melspectrogram, batch)) for batch in melspectrogram_inputs(windows)]
+    return np.concatenate(result).reshape(windows.shape[0], cfg.EMBEDDINGS_COUNT, cfg.FEATURES_COUNT)
+
+
+def drift(expected: npt.NDArray[np.float32], actual: npt.NDArray[np.float32]) -> dict[str, float]:
+    expected = expected.reshape(-1, cfg.FEATURES_COUNT).astype(np.float64)
+    actual = actual.reshape(-1, cfg.FEATURES_COUNT).astype(np.float64)
+    error = np.abs(expected - actual)
+    cosine = (expected * actual).sum(1) / np.maximum(np.linalg.norm(expected, axis=1) * np.linalg.norm(actual, axis=1), 1e-12)
+    return {
+        'mean_abs_error': float(error.mean()),
+        'max_abs_error': float(error.max()),
+        'relative_rms_error': float(np.sqrt((error ** 2).mean() / (expected ** 2).mean())),
+        'min_cosine_similarity': float(cosine.min()),
+        'mean_cosine_similarity': float(cosine.mean()),
+    }
+
+
+def report(test_windows: npt.NDArray[np.float32]) -> dict:
+    models = {(name, variant): Session(cfg.MODELS_DIR / f'{name}{suffix}.onnx') for name in MODEL_NAMES for variant, suffix in (('float', ''), ('int8', '.int8'))}
+    step_audio = np.zeros((1, (cfg.WORD_SHIFT_LENGTH_MS + cfg.MEL_WINDOW_LENGTH_MS - cfg.MEL_STEP_LENGTH_MS) * cfg.SAMPLES_PER_MS), dtype=np.float32)
+    inputs = {
+        'melspectrogram': {'window': test_windows[:1], 'step': step_audio},
+        'embedding_model': {'window': mel_windows(models['melspectrogram', 'float'], test_windows[:1]), 'step': np.zeros((1, EMBEDDING_INPUT_FRAMES, cfg.MEL_FREQUENCY_VALUES, 1), dtype=np.float32)},
+    }
+    result = {'models': {}, 'drift': {}}
+    for name in MODEL_NAMES:
+        for variant, suffix in (('float', ''), ('int8', '.int8')):
+            model = models[name, variant]
+            result['models'][f'{name}.{variant}'] = {
+                'size_bytes': (cfg.MODELS_DIR / f'{name}{suffix}.onnx').stat().st_size,
+                'window_latency_ms': latency_ms(model, inputs[name]['window']),
+                'step_latency_ms': latency_ms(model, inputs[name]['step']),
+            }
+    expected = features(models['melspectrogram', 'float'], models['embedding_model', 'float'], test_windows)
+    for mel_variant, emb_variant in (('int8', 'float'), ('float', 'int8'), ('int8', 'int8')):
+        actual = features(models['melspectrogram', mel_variant], models['embedding_model', emb_variant], test_windows)
+        result['drift'][f'melspectrogram.{mel_variant}+embedding_model.{emb_variant}'] = drift(expected, actual)
+    return result
+
+
+def print_report(result: dict) -> None:
+    print(f'{"Model":<28} {"Size [KiB]":>11} {"Window [ms]":>12} {"Step [ms]":>10}')
+    for name, item in result['models'].items():
+        print(f'{name:<28} {item["size_bytes"] / 1024:>11.1f} {item["window_latency_ms"]:>12.3f} {item["step_latency_ms"]:>10.3f}')
+    print(f'{"Features drift":<48} {"Mean err":>9} {"Max err":>9} {"Rel. RMS":>9} {"Min cos":>8}')
+    for name, item in result['drift'].items():
+        print(f'{name:<48} {item["mean_abs_error"]:>9.4f} {item["max_abs_error"]:>9.4f} {item["relative_rms_error"]:>9.4f} {item["min_cosine_similarity"]:>8.4f}')
+
+
+def main():
+    random.seed(cfg.generation.seed)
+    windows = read_windows(CALIBRATION_WINDOWS + TEST_WINDOWS)
+    calibration_windows = windows[:CALIBRATION_WINDOWS]
+    test_windows = windows[CALIBRATION_WINDOWS:]
+    melspectrogram = Session(cfg.MODELS_DIR / 'melspectrogram.onnx')
+    quantize('melspectrogram', melspectrogram_inputs(calibration_windows))
+    quantize('embedding_model', embedding_inputs(melspectrogram, calibration_windows, EMBEDDING_CALIBRATION_INPUTS))
+    result = report(test_windows)
+    with open(REPORT_FILE, 'w', encoding='utf-8') as f:
+        json.dump(result, f, indent=4)
+    print_report(result)
+    print(f'Report written to {REPORT_FILE}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+import functools
+import numpy as np
+import numpy.typing as npt
+from scipy.signal import resample_poly
+
+# Additional samples resampled on each side of the requested range, so the filter edges do not affect it
+RESAMPLE_CONTEXT_SMPL = 256
+
+
+@functools.lru_cache(maxsize=None)
+def fade_ramp(length: int, direction: int) -> npt.NDArray[np.float32]:
+    # Ramp going from 1/length to 1 (or from 1 - 1/length to 0 for fade-out), cached for each length
+    ramp = np.arange(1, length + 1, dtype=np.float64) / length
+    if direction < 0:
+        ramp = 1 - ramp
+    ramp = ramp.astype(np.float32)
+    ramp.flags.writeable = False
+    return ramp
+
+
+def fade(data: npt.NDArray[np.float32], direction: int) -> None:
+    # Fade-in for positive direction, fade-out for negative, in place
+    np.multiply(data, fade_ramp(data.shape[0], direction), out=data)
+
+
+def copy_range(data: npt.NDArray[np.float32], begin: int, end: int, out: npt.NDArray[np.float32]) -> npt.NDArray[np.float32]:
+    # Copies data[begin:end] to the beginning of the out buffer, parts outside the data are silence
+    result = out[:end - begin]
+    data_begin = max(begin, 0)
+    data_end = min(end, data.shape[0])
+    result[:data_begin - begin] = 0
+    result[data_begin - begin:data_end - begin] = data[data_begin:data_end]
+    result[data_end - begin:] = 0
+    return result
+
+
+def assemble_window(out: npt.NDArray[np.float32], prepend: npt.NDArray[np.float32], word: npt.NDArray[np.float32], append: npt.NDArray[np.float32], fade_smpl: int) -> None:
+    # Glue prepend, word and append together, the word overlaps fade_smpl samples of prepend and append
+    prepend_smpl = prepend.shape[0]
+    word_end = prepend_smpl + word.shape[0] - 2 * fade_smpl
+    assert word_end + append.shape[0] == out.shape[0]
+    out[:prepend_smpl] = prepend
+    out[prepend_smpl:word_end] = word[fade_smpl:-fade_smpl]
+    out[word_end:] = append
+    out[prepend_smpl - fade_smpl:prepend_smpl] += word[:fade_smpl]
+    out[word_end:word_end + fade_smpl] += word[-fade_smpl:]
+
+
+def resample_range(data: npt.NDArray[np.float32], begin_smpl: int, end_smpl: int, up: int, down: int) -> tuple[npt.NDArray[np.float32], float]:
+    # Resamples data[begin_smpl:end_smpl] (with some context) by the rate up/down using a polyphase filter.
+    # Returns the resampled audio and the position of the original data[0] in the returned audio.
+    begin_smpl = max(0, begin_smpl - RESAMPLE_CONTEXT_SMPL)
+    end_smpl = min(data.shape[0], end_smpl + RESAMPLE_CONTEXT_SMPL)
+    result = resample_poly(data[begin_smpl:end_smpl], up, down).astype(np.float32, copy=False)
+    return result, -begin_smpl * up / down
+
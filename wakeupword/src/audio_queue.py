@@ -0,0 +1,53 @@
+import threading
+import numpy as np
+import numpy.typing as npt
+
+# What the live detection does when the processing falls behind the audio:
+#   drop_oldest: only the oldest blocks are dropped when the queue is full
+#   skip_embedding: the embedding model is also skipped while the queue is deeper than a limit
+OVERLOAD_POLICIES = ('drop_oldest', 'skip_embedding')
+
+
+# Fixed capacity queue of audio blocks between the audio callback and the processing thread. All
+# memory is allocated upfront. When the queue is full, the oldest block is dropped, so the memory
+# and the latency are bounded by the capacity.
+class AudioQueue:
+    def __init__(self, capacity: int, block_smpl: int):
+        self.capacity = capacity
+        self.blocks = np.zeros((capacity, block_smpl), dtype=np.float32)
+        self.lengths = np.zeros(capacity, dtype=np.int64)
+        self.capture_times = np.zeros(capacity, dtype=np.float64)
+        self.condition = threading.Condition()
+        # Index of the oldest block and number of blocks in the queue
+        self.first = 0
+        self.depth = 0
+        # Counters for the statistics
+        self.max_depth = 0
+        self.dropped = 0
+
+    # Called from the audio callback, it never blocks for longer than a copy of a single block
+    def put(self, block: npt.NDArray[np.float32], capture_time: float) -> None:
+        with self.condition:
+            if self.depth == self.capacity:
+                self.first = (self.first + 1) % self.capacity
+                self.depth -= 1
+                self.dropped += 1
+            index = (self.first + self.depth) % self.capacity
+            self.blocks[index, :block.shape[0]] = block
+            self.lengths[index] = block.shape[0]
+            self.capture_times[index] = capture_time
+            self.depth += 1
+            self.max_depth = max(self.max_depth, self.depth)
+            self.condition.notify()
+
+    # Waits for the oldest block and copies it to `output`. Returns number of samples and capture time of the block.
+    def get(self, output: npt.NDArray[np.float32]) -> tuple[int, float]:
+        with self.condition:
+            while self.depth == 0:
+                self.condition.wait()
+            length = int(self.lengths[self.first])
+            output[:length] = self.blocks[self.first, :length]
+            capture_time = float(self.capture_times[self.first])
+            self.first = (self.first + 1) % self.capacity
+            self.depth -= 1
+            return length, capture_time
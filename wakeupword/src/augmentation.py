@@ -0,0 +1,138 @@
+import random
+import numpy as np
+import numpy.typing as npt
+import scipy.fft
+import src.config as cfg
+from src.loudness import normalize_loudness
+from src.corpus import Corpus
+
+# Augmentation of the generated windows applied to a whole batch at once. It does the same as the
+# audiomentations chain used before (AddBackgroundNoise, AddColorNoise, ApplyImpulseResponse,
+# LoudnessNormalization, Gain, Clip) with the same parameters and the same distributions of the
+# random values. Background sounds are read from the memory-mapped corpus, the spectra of the
+# impulse responses are computed upfront.
+
+# Random decay of the color noise spectrum in dB per octave and size of its shaping filter (audiomentations defaults)
+COLOR_NOISE_MIN_DECAY = -6.0
+COLOR_NOISE_MAX_DECAY = 6.0
+COLOR_NOISE_FFT = 128
+# Background sound quieter than this (RMS) is not added
+BACKGROUND_MIN_RMS = 1e-9
+
+
+def rms(data: npt.NDArray[np.float32]) -> npt.NDArray[np.float32]:
+    return np.sqrt(np.mean(np.square(data), axis=-1))
+
+
+class BatchAugmenter:
+    def __init__(self, batch_size: int, window_smpl: int, background: Corpus, impulse_responses: Corpus):
+        self.window_smpl = window_smpl
+        # Background sounds are read directly from the memory-mapped corpus
+        self.background, self.background_offsets, self.background_lengths = background.data, background.offsets, background.lengths
+        lengths = impulse_responses.lengths
+        # Full linear convolution of a window with the longest impulse response fits into the FFT
+        self.fft_size = scipy.fft.next_fast_len(window_smpl + int(lengths.max(initial=1)) - 1, real=True)
+        self.impulse_response_spectra = np.zeros((lengths.shape[0], self.fft_size // 2 + 1), dtype=np.complex64)
+        for index in range(lengths.shape[0]):
+            impulse_response = impulse_responses[index].astype(np.float32) / 32768
+            self.impulse_response_spectra[index] = scipy.fft.rfft(impulse_response, self.fft_size)
+        self.impulse_response_lengths = lengths
+        frequencies = np.fft.rfftfreq(COLOR_NOISE_FFT, 1 / cfg.SAMPLE_RATE)
+        frequencies[0] = 1
+        self.color_noise_log_frequencies = np.log(frequencies)
+        # Random parameters of each window in the batch, -1 index or NaN value if the modification is not applied
+        self.background_index = np.full(batch_size, -1, dtype=np.int64)
+        self.background_start = np.zeros(batch_size, dtype=np.int64)
+        self.background_snr = np.zeros(batch_size, dtype=np.float32)
+        self.color_noise_snr = np.full(batch_size, np.nan, dtype=np.float32)
+        self.color_noise_decay = np.zeros(batch_size, dtype=np.float64)
+        self.noise_seed = np.zeros(batch_size, dtype=np.uint64)
+        self.impulse_response_index = np.full(batch_size, -1, dtype=np.int64)
+        self.loudness = np.zeros(batch_size, dtype=np.float64)
+        self.gain_db = np.zeros(batch_size, dtype=np.float32)
+
+    # Draws random parameters of the window in the row of the batch from the `random` module, so
+    # seeding it before each window gives the same modifications of the window regardless of the batch
+    def draw(self, row: int) -> None:
+        params = cfg.modifications
+        self.background_index[row] = -1
+        if random.random() < params.background_noise_probability and self.background_lengths.shape[0] > 0:
+            index = random.randrange(self.background_lengths.shape[0])
+            self.background_index[row] = index
+            self.background_start[row] = random.randint(0, max(0, int(self.background_lengths[index]) - self.window_smpl - 1))
+            self.background_snr[row] = random.uniform(params.background_noise_min_db, params.background_noise_max_db)
+        self.color_noise_snr[row] = np.nan
+        if random.random() < params.color_noise_probability:
+            self.color_noise_snr[row] = random.uniform(params.color_noise_min_db, params.color_noise_max_db)
+            self.color_noise_decay[row] = random.uniform(COLOR_NOISE_MIN_DECAY, COLOR_NOISE_MAX_DECAY)
+        self.noise_seed[row] = random.getrandbits(64)
+        self.impulse_response_index[row] = -1
+        if random.random() < params.impulse_response_probability and self.impulse_response_lengths.shape[0] > 0:
+            self.impulse_response_index[row] = random.randrange(self.impulse_response_lengths.shape[0])
+        self.loudness[row] = cfg.LOUDNESS_NORMALIZATION_DB
+        self.gain_db[row] = 0.0
+        if random.random() < params.gain_probability:
+            self.gain_db[row] = random.uniform(params.gain_min_db, params.gain_max_db)
+
+    # Modifies the windows (count, window_smpl) in place using the parameters drawn for the first count rows
+    def apply(self, windows: npt.NDArray[np.float32]) -> None:
+        count = windows.shape[0]
+        self._add_background(windows, count)
+        self._add_color_noise(windows, count)
+        self._apply_impulse_response(windows, count)
+        self._normalize_loudness(windows, count)
+        np.multiply(windows, np.power(10, self.gain_db[:count] / 20)[:, None], out=windows)
+        np.clip(windows, -1, 1, out=windows)
+
+    def _add_background(self, windows: npt.NDArray[np.float32], count: int) -> None:
+        rows = np.flatnonzero(self.background_index[:count] >= 0)
+        if rows.shape[0] == 0:
+            return
+        index = self.background_index[rows]
+        # Sounds shorter than the window are repeated
+        length = np.minimum(self.background_lengths[index] - self.background_start[rows], self.window_smpl)
+        positions = np.arange(self.window_smpl)
+        noise = self.background[(self.background_offsets[index] + self.background_start[rows])[:, None] + positions[None, :] % length[:, None]]
+        noise = noise.astype(np.float32) / 32768
+        noise_rms = np.sqrt(np.sum(np.square(noise) * (positions[None, :] < length[:, None]), axis=1) / length)
+        desired_rms = rms(windows[rows]) / np.power(10, self.background_snr[rows] / 20)
+        scale = np.where(noise_rms < BACKGROUND_MIN_RMS, 0, desired_rms / np.maximum(noise_rms, BACKGROUND_MIN_RMS))
+        windows[rows] += noise * scale[:, None].astype(np.float32)
+
+    def _add_color_noise(self, windows: npt.NDArray[np.float32], count: int) -> None:
+        rows = np.flatnonzero(~np.isnan(self.color_noise_snr[:count]))
+        if rows.shape[0] == 0:
+            return
+        # White noise filtered by a short filter with magnitude falling by the decay in dB per octave and random phase
+        noise = np.empty((rows.shape[0], self.window_smpl), dtype=np.float32)
+        filters = np.empty((rows.shape[0], COLOR_NOISE_FFT // 2 + 1), dtype=np.complex128)
+        beta = self.color_noise_decay[rows] / -10.0 / np.log10(2.0)
+        for i, row in enumerate(rows):
+            generator = np.random.default_rng(int(self.noise_seed[row]))
+            noise[i] = generator.standard_normal(self.window_smpl, dtype=np.float32)
+            filters[i] = np.exp(1j * generator.uniform(0, 2 * np.pi, filters.shape[1]))
+        filters *= np.exp(-0.5 * beta[:, None] * self.color_noise_log_frequencies[None, :])
+        impulse_responses = np.fft.irfft(filters, axis=1)
+        # Convolution of the "same" size
+        size = scipy.fft.next_fast_len(self.window_smpl + COLOR_NOISE_FFT - 1, real=True)
+        spectrum = scipy.fft.rfft(noise, size, axis=1) * scipy.fft.rfft(impulse_responses.astype(np.float32), size, axis=1)
+        start = (COLOR_NOISE_FFT - 1) // 2
+        noise = scipy.fft.irfft(spectrum, size, axis=1)[:, start:start + self.window_smpl]
+        desired_rms = rms(windows[rows]) / np.power(10, self.color_noise_snr[rows] / 20)
+        windows[rows] += noise * (desired_rms / rms(noise))[:, None]
+
+    def _apply_impulse_response(self, windows: npt.NDArray[np.float32], count: int) -> None:
+        rows = np.flatnonzero(self.impulse_response_index[:count] >= 0)
+        if rows.shape[0] == 0:
+            return
+        spectrum = scipy.fft.rfft(windows[rows], self.fft_size, axis=1)
+        spectrum *= self.impulse_response_spectra[self.impulse_response_index[rows]]
+        convolved = scipy.fft.irfft(spectrum, self.fft_size, axis=1)
+        # Peak of the whole convolution (including the reverb tail) is scaled to 0.5
+        peak = np.abs(convolved).max(axis=1)
+        scale = np.where(peak > 0, 0.5 / np.maximum(peak, 1e-30), 1)
+        windows[rows] = convolved[:, :self.window_smpl] * scale[:, None]
+
+    def _normalize_loudness(self, windows: npt.NDArray[np.float32], count: int) -> None:
+        # Digital silence is left unchanged
+        normalize_loudness(windows, self.loudness[:count])
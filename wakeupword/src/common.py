@@ -1,12 +1,18 @@
 from pathlib import Path
 from dataclasses import dataclass
 from typing import List
+import src.config as cfg
 
 SAMPLE_RATE = 16000
 
 ROOT = Path(__file__).parent.parent
 
 
+def model_path(name: str, extension: str) -> Path:
+    # Path of the melspectrogram or embedding model in the variant selected in the configuration
+    return cfg.MODELS_DIR / f'{name}{cfg.MODEL_VARIANT}.{extension}'
+
+
 @dataclass
 class Label:
     begin: float
@@ -20,9 +26,9 @@ class SampleSet:
     txt: Path
     labels: List[Label]
 
-def process_file(wav_path: Path, txt_path: Path) -> SampleSet:
-    labels: List[Label] = []
-    result = SampleSet(wav=wav_path, txt=txt_path, labels=labels)
+def read_label_file(txt_path: Path) -> List[tuple[float, float, str]]:
+    # Begin, end and text of each label in the file
+    labels: List[tuple[float, float, str]] = []
     with txt_path.open("r", encoding="utf-8") as f:
         for line in f:
             line = line.strip()
@@ -33,29 +39,26 @@ def process_file(wav_path: Path, txt_path: Path) -> SampleSet:
                 raise ValueError(f"Invalid line format in {txt_path}: {line}")
             begin, end, text = parts
             try:
-                label = Label(begin=float(begin), end=float(end), text=text, set=result)
-                labels.append(label)
+                labels.append((float(begin), float(end), text))
             except ValueError:
                 raise ValueError(f"Invalid line format in {txt_path}: {line}")
-    return result
+    return labels
 
 def find_samples(root_dir: 'str|Path') -> List[SampleSet]:
-    root = Path(root_dir)
-    samples: List[SampleSet] = []
-    for wav_path in root.rglob("*.wav"):
-        txt_path = wav_path.with_suffix('.txt')
-        if txt_path.exists():
-            sample = process_file(wav_path, txt_path)
-            samples.append(sample)
-    return samples
+    # Samples are read from the label index, it parses only the label files changed since the last call
+    from src.label_index import load_label_index
+    return load_label_index(root_dir).samples()
+
+def keyword_index(label: Label) -> int:
+    # Index of the keyword in cfg.KEYWORDS with the longest prefix matching the label, -1 if none
+    text = label.text.lower()
+    result = -1
+    for index, keyword in enumerate(cfg.KEYWORDS):
+        if text.startswith(keyword.label_prefix.lower()) and (result < 0 or len(keyword.label_prefix) > len(cfg.KEYWORDS[result].label_prefix)):
+            result = index
+    return result
 
 def find_labels(root_dir: 'str|Path') -> tuple[List[Label], List[Label]]:
-    positive: List[Label] = []
-    negative: List[Label] = []
-    for sample in find_samples(root_dir):
-        for label in sample.labels:
-            if label.text.lower().startswith('p'):
-                positive.append(label)
-            elif label.text.lower().startswith('n'):
-                negative.append(label)
-    return (positive, negative)
+    # Positive labels of all keywords and negative labels
+    from src.label_index import load_label_index
+    return load_label_index(root_dir).labels()
@@ -7,6 +7,9 @@ from pathlib import Path
 # Source of samples (WAV + TXT files with labels)
 SAMPLE_DIR = (Path(__file__).parent / '../../../home-asist-samples').resolve()
 MODELS_DIR = (Path(__file__).parent / '../models').resolve()
+# Variant of the melspectrogram and embedding models, '' for the original float models or '.int8' for
+# the quantized ones created by quantization.py (available only in the ONNX format)
+MODEL_VARIANT = ''
 DATA_DIR = (Path(__file__).parent / '../data').resolve()
 
 # Maximum wake up word length (how long the word can be spoken if it is spoken slowly)
@@ -14,6 +17,24 @@ REQUIRED_MAX_WORD_LENGTH_MS = 1200
 # Minimum wake up word length (how long the word can be spoken if it is spoken very fast)
 MIN_WORD_LENGTH_MS = 500
 
+# Keyword recognized by the head model, each keyword has its own output
+class Keyword:
+    def __init__(self, name: str, label_prefix: str, threshold: float = 0.0, debounce_steps: int = 1, refractory_ms: int = 1000):
+        self.name = name
+        # Labels of this keyword start with this prefix, the longest matching prefix wins
+        self.label_prefix = label_prefix
+        # Score (model output before sigmoid) above which the keyword is detected
+        self.threshold = threshold
+        # Number of consecutive steps above the threshold needed for the detection
+        self.debounce_steps = debounce_steps
+        # Time after a detection when the following detections of the same keyword are ignored
+        self.refractory_ms = refractory_ms
+
+# Keywords to detect, labels starting with "n" that do not match any keyword are negative
+KEYWORDS = [
+    Keyword('wake', 'p'),
+]
+
 # Possible modifications to the samples when generating distorted samples for training
 class Modifications:
     resample_probability = 0.5
@@ -41,6 +62,104 @@ class Generation:
     negative_from_background = 10000 * 3
     negative_from_start_of_label_probability = 0.5
     dump_probability = 0.001
+    # Number of worker processes, each one generates samples from its own shard of the labels
+    workers = 1
+    # Seed of the random number generators, output is the same for the same seed, inputs and number of
+    # workers (the number of windows drawn from each label is split among the workers)
+    seed = 1234
+    # Number of windows passed to the melspectrogram and embedding models in a single call
+    feature_batch_size = 32
+    # Maximum size of the cache of already generated features (in DATA_DIR/feature_cache), zero to disable
+    cache_max_bytes = 8 * 1024 ** 3
+
+# Runtime of the melspectrogram and embedding models
+class Inference:
+    # 'tflite', 'onnx' or 'auto' to use the fastest one measured by benchmarks/inference_backends.py
+    backend = 'auto'
+    # Number of threads used by a single model, zero for the runtime default. With several generation
+    # workers, the threads are divided among them (one thread per worker for the runtime default).
+    threads = 0
+
+# Training of the head model
+class Training:
+    epochs = 100
+    batch_size = 1024
+    # Learning rate is scaled linearly from this reference batch size to the actual batch size
+    base_batch_size = 32
+    base_learning_rate = 1e-5
+    # Weight of the positive samples in the loss function
+    positive_weight = 3.0
+    # Processes reading batches from the dataset files, zero to read in the main process
+    loader_workers = 2
+    # Number of batches prepared in advance by each loader process
+    prefetch_batches = 4
+    # Number of threads used by PyTorch for computations, zero to use the default
+    threads = 0
+    # False accept rate for which the validation reports the threshold and the recall
+    target_false_accept_rate = 0.001
+
+# Augmentation of the generated features done during training, all probabilities zero to disable
+class EmbeddingAugmentation:
+    # Shift in time by whole embedding steps (WORD_SHIFT_LENGTH_MS), missing steps are taken from a negative sample
+    shift_probability = 0.5
+    negative_max_shift_steps = 6
+    positive_max_shift_steps = 1
+    # Mixing with a negative sample, the weight of the negative sample is random up to the maximum
+    mix_probability = 0.3
+    mix_max_weight = 0.3
+    # Probability of zeroing each single feature
+    feature_dropout = 0.05
+
+# Mining of hard negatives (false accepts of the current model) from the negative recordings and background sounds
+class Mining:
+    # Score (model output before sigmoid) above which the window is added to the hard negatives,
+    # it is below the detection threshold, so also the near misses are collected
+    threshold = -2.0
+    # Number of windows scored by the head model at once
+    batch_size = 4096
+    # Fraction of each training batch taken from the hard negatives, zero to disable
+    train_ratio = 0.1
+
+# Voice activity gate of the streaming detection, the embedding model is not run while the audio is quiet
+class Vad:
+    enabled = True
+    # Step is active if the mean melspectrogram level (in dB) of any of its frames is this much above the noise floor
+    margin_db = 6.0
+    # Noise floor follows quieter frames immediately and rises at most by this rate
+    floor_rise_db_per_second = 3.0
+    # Frames quieter than this are never active
+    min_level_db = -70.0
+    # How long the embedding model runs after the last active step
+    hangover_ms = 1000
+    # Number of skipped steps recomputed from the melspectrogram history when the audio becomes active,
+    # so the start of the word is not lost if the gate opens a bit late. Older skipped steps repeat the
+    # last embedding, EMBEDDINGS_COUNT makes the scores the same as without the gate.
+    warmup_steps = 8
+
+# Audio queue between the audio input and the processing thread of the live detection (06.check.py)
+class Streaming:
+    # Capacity of the queue in steps (WORD_SHIFT_LENGTH_MS), the oldest audio is dropped when it is full
+    queue_steps = 32
+    # What to do when the processing falls behind, one of src.audio_queue.OVERLOAD_POLICIES
+    overload_policy = 'drop_oldest'
+    # Queue depth above which the embedding model is skipped with the 'skip_embedding' policy
+    skip_embedding_depth = 4
+    # How often the queue depth, dropped blocks and latency are printed
+    report_interval_steps = 100
+
+# Offline evaluation of the trained model on the labeled samples
+class Evaluation:
+    # How long after the end of the word the detection is still counted as correct,
+    # detection thresholds and refractory times are taken from KEYWORDS
+    max_latency_ms = 1000
+
+# Time spent in each stage of the generation (04.generate.py), printed as a table at the end
+class Timing:
+    enabled = True
+    # The table is also saved as JSON to DATA_DIR/timing with the configuration, so the runs can be compared
+    save_json = True
+    # Runs each worker under cProfile and saves its statistics to DATA_DIR/timing (for pstats or snakeviz)
+    profile = False
 
 ########## Not so ofter changed configuration options ##########
 
@@ -83,11 +202,22 @@ LOUDNESS_NORMALIZATION_DB = -22.0
 
 modifications = Modifications()
 generation = Generation()
+inference = Inference()
+training = Training()
+embedding_augmentation = EmbeddingAugmentation()
+mining = Mining()
+vad = Vad()
+streaming = Streaming()
+evaluation = Evaluation()
+timing = Timing()
 
 
 if __name__ == "__main__":
     print(f"REQUIRED_MAX_WORD_LENGTH_MS = {REQUIRED_MAX_WORD_LENGTH_MS}")
     print(f"SAMPLE_DIR = {SAMPLE_DIR}")
+    print(f"MODEL_VARIANT = '{MODEL_VARIANT}'")
+    for keyword in KEYWORDS:
+        print(f"KEYWORDS: {keyword.name} (prefix '{keyword.label_prefix}', threshold {keyword.threshold}, debounce {keyword.debounce_steps} steps, refractory {keyword.refractory_ms} ms)")
     print(f"EMBEDDINGS_WINDOW_DEVISABLE_BY = {EMBEDDINGS_WINDOW_DEVISABLE_BY}")
     print(f"INPUT_WINDOW_LENGTH_MS = {INPUT_WINDOW_LENGTH_MS}")
     print(f"MAX_WORD_LENGTH_MS = {MAX_WORD_LENGTH_MS}")
@@ -114,3 +244,41 @@ if __name__ == "__main__":
     print(f"generation.positive_from_samples = {generation.positive_from_samples}")
     print(f"generation.negative_from_samples = {generation.negative_from_samples}")
     print(f"generation.negative_from_background = {generation.negative_from_background}")
+    print(f"generation.workers = {generation.workers}")
+    print(f"generation.seed = {generation.seed}")
+    print(f"generation.feature_batch_size = {generation.feature_batch_size}")
+    print(f"generation.cache_max_bytes = {generation.cache_max_bytes}")
+    print(f"inference.backend = {inference.backend}")
+    print(f"inference.threads = {inference.threads}")
+    print(f"training.epochs = {training.epochs}")
+    print(f"training.batch_size = {training.batch_size}")
+    print(f"training.base_batch_size = {training.base_batch_size}")
+    print(f"training.base_learning_rate = {training.base_learning_rate}")
+    print(f"training.positive_weight = {training.positive_weight}")
+    print(f"training.loader_workers = {training.loader_workers}")
+    print(f"training.prefetch_batches = {training.prefetch_batches}")
+    print(f"training.threads = {training.threads}")
+    print(f"training.target_false_accept_rate = {training.target_false_accept_rate}")
+    print(f"embedding_augmentation.shift_probability = {embedding_augmentation.shift_probability}")
+    print(f"embedding_augmentation.negative_max_shift_steps = {embedding_augmentation.negative_max_shift_steps}")
+    print(f"embedding_augmentation.positive_max_shift_steps = {embedding_augmentation.positive_max_shift_steps}")
+    print(f"embedding_augmentation.mix_probability = {embedding_augmentation.mix_probability}")
+    print(f"embedding_augmentation.mix_max_weight = {embedding_augmentation.mix_max_weight}")
+    print(f"embedding_augmentation.feature_dropout = {embedding_augmentation.feature_dropout}")
+    print(f"mining.threshold = {mining.threshold}")
+    print(f"mining.batch_size = {mining.batch_size}")
+    print(f"mining.train_ratio = {mining.train_ratio}")
+    print(f"vad.enabled = {vad.enabled}")
+    print(f"vad.margin_db = {vad.margin_db}")
+    print(f"vad.floor_rise_db_per_second = {vad.floor_rise_db_per_second}")
+    print(f"vad.min_level_db = {vad.min_level_db}")
+    print(f"vad.hangover_ms = {vad.hangover_ms}")
+    print(f"vad.warmup_steps = {vad.warmup_steps}")
+    print(f"streaming.queue_steps = {streaming.queue_steps}")
+    print(f"streaming.overload_policy = {streaming.overload_policy}")
+    print(f"streaming.skip_embedding_depth = {streaming.skip_embedding_depth}")
+    print(f"streaming.report_interval_steps = {streaming.report_interval_steps}")
+    print(f"evaluation.max_latency_ms = {evaluation.max_latency_ms}")
+    print(f"timing.enabled = {timing.enabled}")
+    print(f"timing.save_json = {timing.save_json}")
+    print(f"timing.profile = {timing.profile}")
@@ -0,0 +1,204 @@
+import os
+import hashlib
+from pathlib import Path
+from typing import Iterable
+import numpy as np
+import numpy.typing as npt
+import scipy.signal
+from scipy.io import wavfile
+import src.config as cfg
+from src.label_index import LabelIndex
+
+# Many short recordings stored as a single file of raw int16 samples (the blob) and an index with the
+# name, offset and length of each recording. The blob is memory-mapped, so a recording is a view of it
+# without opening and decoding a file, and its pages are shared by all processes through the OS page cache.
+
+CORPUS_DIR = cfg.DATA_DIR / 'corpus'
+# Number of recordings converted together during the ingest
+INGEST_CHUNK = 256
+# Onset of an impulse response is the first sample louder than this part of its peak
+ONSET_THRESHOLD = 1 / 4
+
+
+def corpus_paths(name: str) -> tuple[Path, Path]:
+    return CORPUS_DIR / f'{name}.pcm', CORPUS_DIR / f'{name}.npz'
+
+
+class Corpus:
+    def __init__(self, data: npt.NDArray[np.int16], names: npt.NDArray[np.str_], offsets: npt.NDArray[np.int64], lengths: npt.NDArray[np.int64],
+                 mtimes: 'npt.NDArray[np.int64]|None' = None, sizes: 'npt.NDArray[np.int64]|None' = None):
+        self.data = data
+        self.names = names
+        self.offsets = offsets
+        self.lengths = lengths
+        # Modification time and size of the source files, if the corpus is packed from files that can change
+        self.mtimes = mtimes
+        self.sizes = sizes
+        self.indexes = {name: index for index, name in enumerate(names.tolist())}
+
+    def __len__(self) -> int:
+        return self.names.shape[0]
+
+    # Read-only view of the recording
+    def __getitem__(self, index: int) -> npt.NDArray[np.int16]:
+        offset = int(self.offsets[index])
+        return self.data[offset:offset + int(self.lengths[index])]
+
+    def find(self, name: str) -> int:
+        return self.indexes[name]
+
+
+def open_corpus(name: str) -> Corpus:
+    blob_path, index_path = corpus_paths(name)
+    if not index_path.exists():
+        raise FileNotFoundError(f'Corpus "{name}" does not exist ({index_path}).')
+    index = np.load(index_path)
+    total = int(index['lengths'].sum())
+    if int(index['sample_rate']) != cfg.SAMPLE_RATE or blob_path.stat().st_size != 2 * total:
+        raise ValueError(f'Corpus "{name}" does not match its index or the sample rate, ingest it again.')
+    # Memory map of an empty file is not allowed
+    data = np.memmap(blob_path, dtype=np.int16, mode='r', shape=(total,)) if total > 0 else np.zeros(0, dtype=np.int16)
+    return Corpus(data, index['names'], index['offsets'], index['lengths'],
+                  index['mtimes'] if 'mtimes' in index else None, index['sizes'] if 'sizes' in index else None)
+
+
+# Appends recordings to a new corpus, the old one is replaced when the writer is closed
+class CorpusWriter:
+    def __init__(self, name: str):
+        self.blob_path, self.index_path = corpus_paths(name)
+        CORPUS_DIR.mkdir(parents=True, exist_ok=True)
+        self.temp_path = self.blob_path.with_suffix('.tmp.pcm')
+        self.file = open(self.temp_path, 'wb')
+        self.names: list[str] = []
+        self.lengths: list[int] = []
+
+    # Recordings are data[offsets[i]:offsets[i] + lengths[i]]
+    def add(self, names: list[str], data: npt.NDArray[np.int16], offsets: npt.NDArray[np.int64], lengths: npt.NDArray[np.int64]) -> None:
+        for name, offset, length in zip(names, offsets.tolist(), lengths.tolist()):
+            self.file.write(data[offset:offset + length].astype('<i2', copy=False).tobytes())
+            self.names.append(name)
+            self.lengths.append(length)
+
+    def close(self, **sources: npt.NDArray) -> Corpus:
+        self.file.close()
+        lengths = np.array(self.lengths, dtype=np.int64)
+        offsets = np.concatenate(([0], np.cumsum(lengths)[:-1])).astype(np.int64)
+        temp_index_path = self.index_path.with_suffix('.tmp.npz')
+        np.savez(temp_index_path, names=np.array(self.names, dtype=np.str_), offsets=offsets, lengths=lengths, sample_rate=cfg.SAMPLE_RATE, **sources)
+        # Without the index, a corpus left half-replaced by a crash is treated as missing
+        self.index_path.unlink(missing_ok=True)
+        os.replace(self.temp_path, self.blob_path)
+        os.replace(temp_index_path, self.index_path)
+        return open_corpus(self.blob_path.stem)
+
+
+def resample(parts: list[npt.NDArray], rates: list[int]) -> list[npt.NDArray]:
+    # Recordings with the same rate and length (like all ESC-50 clips) are resampled by a single FFT call
+    result = list(parts)
+    groups: dict[tuple[int, int], list[int]] = {}
+    for index, (part, rate) in enumerate(zip(parts, rates)):
+        if rate != cfg.SAMPLE_RATE:
+            groups.setdefault((rate, part.shape[0]), []).append(index)
+    for (rate, length), indexes in groups.items():
+        resampled = scipy.signal.resample(np.stack([parts[index] for index in indexes]), int(length / rate * cfg.SAMPLE_RATE), axis=1)
+        for row, index in enumerate(indexes):
+            # Ringing of the FFT resampling can overshoot the int16 range near full scale
+            result[index] = np.clip(resampled[row], -32768, 32767).astype(np.int16) if parts[index].dtype == np.int16 else resampled[row]
+    return result
+
+
+def trim_onsets(data: npt.NDArray[np.int16], offsets: npt.NDArray[np.int64], lengths: npt.NDArray[np.int64]) -> tuple[npt.NDArray[np.int64], npt.NDArray[np.int64]]:
+    # Removes the silence before the first loud sample of each recording (keeping one sample before it) by moving its offset
+    magnitude = np.abs(data.astype(np.int32))
+    nonempty = lengths > 0
+    peaks = np.zeros(offsets.shape[0], dtype=np.int32)
+    peaks[nonempty] = np.maximum.reduceat(magnitude, offsets[nonempty])
+    loud = np.flatnonzero(magnitude > np.repeat(peaks * ONSET_THRESHOLD, lengths))
+    first = np.searchsorted(loud, offsets)
+    onsets = np.where(first < loud.shape[0], loud[np.minimum(first, loud.shape[0] - 1)], offsets + lengths)
+    # Recordings without any loud sample (silence) are not trimmed
+    trim = np.where(onsets < offsets + lengths, np.maximum(onsets - offsets - 1, 0), 0)
+    return offsets + trim, lengths - trim
+
+
+def ingest(name: str, rows: Iterable[tuple[str, npt.NDArray, int]], trim_onset: bool = False, **sources: npt.NDArray) -> tuple[Corpus, npt.NDArray[np.int64]]:
+    # Packs the recordings (name, float -1..1 or int16 audio, sample rate) converted to mono int16 at the
+    # sample rate. Returns the corpus and the number of samples trimmed from the beginning of each recording.
+    writer = CorpusWriter(name)
+    trimmed: list[npt.NDArray[np.int64]] = []
+    def flush(chunk: list[tuple[str, npt.NDArray, int]]) -> None:
+        parts = [data.mean(axis=1).astype(data.dtype) if data.ndim > 1 else data for _, data, _ in chunk]
+        parts = resample(parts, [rate for _, _, rate in chunk])
+        parts = [part if part.dtype == np.int16 else np.clip(part * 32767, -32768, 32767).astype(np.int16) for part in parts]
+        lengths = np.array([part.shape[0] for part in parts], dtype=np.int64)
+        offsets = np.concatenate(([0], np.cumsum(lengths)[:-1])).astype(np.int64)
+        data = np.concatenate(parts) if len(parts) > 0 else np.zeros(0, dtype=np.int16)
+        if trim_onset:
+            new_offsets, lengths = trim_onsets(data, offsets, lengths)
+            trimmed.append(new_offsets - offsets)
+            offsets = new_offsets
+        writer.add([name for name, _, _ in chunk], data, offsets, lengths)
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == INGEST_CHUNK:
+            flush(chunk)
+            chunk = []
+    if len(chunk) > 0:
+        flush(chunk)
+    corpus = writer.close(**sources)
+    return corpus, np.concatenate(trimmed) if len(trimmed) > 0 else np.zeros(len(corpus), dtype=np.int64)
+
+
+def read_files(root: Path, files: list[str], require_rate: bool = False) -> Iterable[tuple[str, npt.NDArray, int]]:
+    # Recordings at a different sample rate are resampled when packed, unless the rate is required
+    for file in files:
+        sample_rate, data = wavfile.read(root / file)
+        if require_rate and sample_rate != cfg.SAMPLE_RATE:
+            raise ValueError(f'Recording {root / file} has sample rate {sample_rate}, expected {cfg.SAMPLE_RATE}.')
+        yield file, data, sample_rate
+
+
+def ingest_directory(name: str, directory: Path, trim_onset: bool = False) -> tuple[Corpus, npt.NDArray[np.int64]]:
+    # Packs WAV files of a directory (as written by the older versions of the download scripts)
+    files = sorted(file.name for file in directory.glob('*.wav'))
+    return ingest(name, read_files(directory, files), trim_onset)
+
+
+def read_changed_files(name: str, root: Path, files: list[str], changed: npt.NDArray[np.bool_]) -> Iterable[tuple[str, npt.NDArray, int]]:
+    # Recordings of the old corpus are copied, only the changed (or new) files are decoded
+    old = open_corpus(name) if not changed.all() else None
+    for file, file_changed in zip(files, changed.tolist()):
+        if file_changed:
+            yield from read_files(root, [file], require_rate=True)
+        else:
+            # Copied out of the old blob, so it is not mapped any more when it is replaced
+            yield file, np.array(old[old.find(file)]), cfg.SAMPLE_RATE
+    del old
+
+
+def load_sample_corpus(index: LabelIndex) -> Corpus:
+    # Recordings of the label index in the same order, packed again when any of them changes (only the
+    # changed and new files are decoded, removed files are dropped)
+    name = f'samples-{hashlib.blake2b(str(index.root).encode(), digest_size=8).hexdigest()}'
+    files = index.files.tolist()
+    mtimes = np.zeros(len(files), dtype=np.int64)
+    sizes = np.zeros(len(files), dtype=np.int64)
+    for file_id, file in enumerate(files):
+        stat = (index.root / file).stat()
+        mtimes[file_id] = stat.st_mtime_ns
+        sizes[file_id] = stat.st_size
+    changed = np.ones(len(files), dtype=bool)
+    if corpus_paths(name)[1].exists():
+        corpus = open_corpus(name)
+        if np.array_equal(corpus.names, index.files) and np.array_equal(corpus.mtimes, mtimes) and np.array_equal(corpus.sizes, sizes):
+            return corpus
+        # Corpus without the modification times and sizes is packed again completely
+        if corpus.mtimes is not None and corpus.sizes is not None:
+            for file_id, file in enumerate(files):
+                old_id = corpus.indexes.get(file)
+                changed[file_id] = old_id is None or corpus.mtimes[old_id] != mtimes[file_id] or corpus.sizes[old_id] != sizes[file_id]
+        del corpus
+    print(f'Packing the recordings ({int(changed.sum())} of {len(files)} new or changed)...')
+    corpus, _ = ingest(name, read_changed_files(name, index.root, files, changed), mtimes=mtimes, sizes=sizes)
+    return corpus
@@ -0,0 +1,161 @@
+import math
+from typing import Callable
+import numpy as np
+import numpy.typing as npt
+import src.config as cfg
+
+# Number of new audio samples needed for a single detection step (80 ms)
+STEP_SMPL = cfg.WORD_SHIFT_LENGTH_MS * cfg.SAMPLES_PER_MS
+# Number of additional past samples needed by the melspectrogram model to produce full frames
+AUDIO_CONTEXT_SMPL = (cfg.MEL_WINDOW_LENGTH_MS - cfg.MEL_STEP_LENGTH_MS) * cfg.SAMPLES_PER_MS
+# Number of melspectrogram frames produced by a single step
+MEL_FRAMES_PER_STEP = STEP_SMPL // (cfg.MEL_STEP_LENGTH_MS * cfg.SAMPLES_PER_MS)
+# Number of melspectrogram frames needed by the embedding model
+MEL_WINDOW_FRAMES = cfg.EMBEDDING_MODEL_INPUT_LENGTH_MS // cfg.MEL_STEP_LENGTH_MS
+
+
+# Keeps the last `length` rows. Each row is stored twice, so the window is always a contiguous
+# view of the buffer and nothing has to be shifted when new rows arrive.
+class RingBuffer:
+    def __init__(self, length: int, row_shape: tuple[int, ...] = (), dtype=np.float32):
+        self.length = length
+        self.data = np.zeros((2 * length,) + row_shape, dtype=dtype)
+        self.pos = 0
+
+    def push(self, rows: npt.NDArray) -> None:
+        count = rows.shape[0]
+        assert count <= self.length
+        first = min(count, self.length - self.pos)
+        self.data[self.pos:self.pos + first] = rows[:first]
+        self.data[self.pos + self.length:self.pos + self.length + first] = rows[:first]
+        rest = count - first
+        if rest > 0:
+            self.data[:rest] = rows[first:]
+            self.data[self.length:self.length + rest] = rows[first:]
+        self.pos = (self.pos + count) % self.length
+
+    # Forgets the newest `count` rows, so they are overwritten by the next push
+    def rewind(self, count: int) -> None:
+        self.pos = (self.pos - count) % self.length
+
+    # Rows from the oldest to the newest, valid until the next push
+    def window(self) -> npt.NDArray:
+        return self.data[self.pos:self.pos + self.length]
+
+
+# Energy based voice activity detection on the melspectrogram frames that are computed anyway.
+# The noise floor follows the quietest frames, so a steady background noise is also treated as quiet.
+class VoiceActivityGate:
+    def __init__(self, params: cfg.Vad = cfg.vad):
+        self.margin = params.margin_db
+        self.min_level = params.min_level_db
+        self.floor_rise = params.floor_rise_db_per_second * cfg.MEL_STEP_LENGTH_MS / 1000
+        self.hangover_steps = math.ceil(params.hangover_ms / cfg.WORD_SHIFT_LENGTH_MS)
+        self.noise_floor = np.inf
+        # Steps since the last active one, the gate starts open
+        self.quiet_steps = 0
+
+    # Takes melspectrogram frames of a single step, returns True if the embedding model should run
+    def update(self, mel: npt.NDArray[np.float32]) -> bool:
+        active = False
+        for level in mel.mean(1):
+            active |= bool(level > max(self.noise_floor + self.margin, self.min_level))
+            self.noise_floor = min(level, self.noise_floor + self.floor_rise)
+        self.quiet_steps = 0 if active else self.quiet_steps + 1
+        return self.quiet_steps <= self.hangover_steps
+
+
+# Real-time wake word detection on a stream of audio. Models are callables:
+#   melspectrogram: (1, AUDIO_CONTEXT_SMPL + STEP_SMPL) audio -> MEL_FRAMES_PER_STEP x MEL_FREQUENCY_VALUES values
+#   embedding: (1, MEL_WINDOW_FRAMES, MEL_FREQUENCY_VALUES, 1) -> FEATURES_COUNT values
+#   head: (EMBEDDINGS_COUNT * FEATURES_COUNT) features -> scores of all keywords
+# The embedding window is computed once for each step and shared by all keywords. With the voice
+# activity gate, the embedding model is skipped while the audio is quiet and the last embedding is
+# repeated instead. The melspectrogram history is kept longer, so the last skipped steps can be
+# recomputed when the gate opens. Steps skipped to catch up with the audio are never recomputed.
+class StreamingDetector:
+    def __init__(self, melspectrogram: Callable, embedding: Callable, head: Callable, vad: bool = cfg.vad.enabled):
+        self.melspectrogram = melspectrogram
+        self.embedding = embedding
+        self.head = head
+        self.gate = VoiceActivityGate() if vad else None
+        self.warmup_steps = cfg.vad.warmup_steps if vad else 0
+        self.audio = RingBuffer(AUDIO_CONTEXT_SMPL + STEP_SMPL)
+        self.mel = RingBuffer(MEL_WINDOW_FRAMES + self.warmup_steps * MEL_FRAMES_PER_STEP, (cfg.MEL_FREQUENCY_VALUES,))
+        self.features = RingBuffer(cfg.EMBEDDINGS_COUNT, (cfg.FEATURES_COUNT,))
+        # Number of samples received since the last step
+        self.pending_smpl = 0
+        # Number of steps done so far, step N covers audio up to sample (N + 1) * STEP_SMPL of the stream
+        self.steps = 0
+        # Number of runs of the embedding model and number of consecutive steps skipped by the gate
+        self.embedding_runs = 0
+        self.skipped_steps = 0
+        # Number of steps skipped because of the overload, these are never recomputed
+        self.overload_skips = 0
+
+    # Accepts any number of float samples in range -1..1 or int16 samples. Returns scores of completed steps.
+    # The embedding model can be skipped to catch up when the processing falls behind the audio.
+    def process(self, audio: npt.NDArray, skip_embedding: bool = False) -> list[npt.NDArray[np.float32]]:
+        if audio.dtype == np.int16:
+            audio = audio.astype(np.float32) / 32767
+        scores = []
+        offset = 0
+        while offset < audio.shape[0]:
+            count = min(audio.shape[0] - offset, STEP_SMPL - self.pending_smpl)
+            self.audio.push(audio[offset:offset + count])
+            self.pending_smpl += count
+            offset += count
+            if self.pending_smpl == STEP_SMPL:
+                self.pending_smpl = 0
+                scores.append(self.step(skip_embedding))
+        return scores
+
+    def step(self, skip_embedding: bool = False) -> npt.NDArray[np.float32]:
+        mel = self.melspectrogram(self.audio.window().reshape(1, -1)).reshape(MEL_FRAMES_PER_STEP, cfg.MEL_FREQUENCY_VALUES)
+        self.mel.push(mel)
+        active = self.gate is None or self.gate.update(mel)
+        if active and not skip_embedding:
+            recompute = min(self.skipped_steps, self.warmup_steps)
+            self.features.rewind(recompute)
+            for back in range(recompute, -1, -1):
+                self.features.push(self.embed(back))
+            self.skipped_steps = 0
+        else:
+            # Embedding of a quiet audio changes slowly
+            self.features.push(self.features.window()[-1:].copy())
+            if active:
+                # Skipped to catch up, so the work is shed and the older steps skipped by the gate
+                # cannot be recomputed either (they are no longer the newest rows)
+                self.overload_skips += 1
+                self.skipped_steps = 0
+            else:
+                self.skipped_steps += 1
+        self.steps += 1
+        return np.array(self.head(self.features.window().reshape(-1)), dtype=np.float32).reshape(-1)
+
+    # Embedding of the melspectrogram window ending `back` steps before the current step
+    def embed(self, back: int) -> npt.NDArray[np.float32]:
+        end = self.mel.length - back * MEL_FRAMES_PER_STEP
+        window = self.mel.window()[end - MEL_WINDOW_FRAMES:end]
+        self.embedding_runs += 1
+        return self.embedding(window.reshape(1, MEL_WINDOW_FRAMES, cfg.MEL_FREQUENCY_VALUES, 1)).reshape(1, cfg.FEATURES_COUNT)
+
+
+# Turns scores of consecutive steps into detections. Each keyword is detected when its score stays
+# above its threshold for debounce_steps steps, detections closer than the refractory time are ignored.
+class KeywordDecoder:
+    def __init__(self, keywords: list[cfg.Keyword] = cfg.KEYWORDS):
+        self.thresholds = np.array([keyword.threshold for keyword in keywords], dtype=np.float32)
+        self.debounce_steps = np.array([keyword.debounce_steps for keyword in keywords], dtype=np.int64)
+        self.refractory_steps = np.array([keyword.refractory_ms / cfg.WORD_SHIFT_LENGTH_MS for keyword in keywords])
+        # Number of consecutive steps above the threshold and steps since the last detection
+        self.above = np.zeros(len(keywords), dtype=np.int64)
+        self.since_detection = np.full(len(keywords), np.inf)
+
+    # Returns indexes of the keywords detected in this step
+    def update(self, scores: npt.NDArray[np.float32]) -> npt.NDArray[np.int64]:
+        self.above = np.where(scores > self.thresholds, self.above + 1, 0)
+        self.since_detection += 1
+        detected = (self.above == self.debounce_steps) & (self.since_detection >= self.refractory_steps)
+        self.since_detection[detected] = 0
+        return np.flatnonzero(detected)
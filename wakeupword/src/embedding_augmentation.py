@@ -0,0 +1,46 @@
+import torch
+import src.config as cfg
+
+
+# Cheap augmentation of already generated features applied to each training batch, so every epoch
+# sees new variants without running the audio pipeline again. Each sample is paired with a random
+# negative sample from the same batch that provides the audio context for shifting and mixing.
+class EmbeddingAugmenter:
+    def __init__(self, seed: int = 0):
+        self.generator = torch.Generator().manual_seed(seed)
+        self.steps = torch.arange(cfg.EMBEDDINGS_COUNT)
+
+    def _uniform(self, *shape: int) -> torch.Tensor:
+        return torch.rand(shape, generator=self.generator)
+
+    def _integers(self, low: int, high: int, count: int) -> torch.Tensor:
+        return torch.randint(low, high + 1, (count,), generator=self.generator)
+
+    # Returns augmented copy of the (batch, EMBEDDINGS_COUNT * FEATURES_COUNT) features, labels
+    # (batch) or (batch, keywords) are not changed
+    def __call__(self, x: torch.Tensor, y: torch.Tensor) -> torch.Tensor:
+        params = cfg.embedding_augmentation
+        batch = x.shape[0]
+        x = x.reshape(batch, cfg.EMBEDDINGS_COUNT, cfg.FEATURES_COUNT)
+        positive = y.reshape(batch, -1).amax(1) >= 0.5
+        negative = torch.nonzero(~positive).view(-1)
+        if negative.shape[0] > 0:
+            other = x[negative[self._integers(0, negative.shape[0] - 1, batch)]]
+            # Shift by whole embedding steps, the positive word may only move to the past, because
+            # the detection must not happen before the end of the word
+            shift = torch.where(
+                positive,
+                self._integers(0, params.positive_max_shift_steps, batch),
+                self._integers(-params.negative_max_shift_steps, params.negative_max_shift_steps, batch))
+            shift *= self._uniform(batch) < params.shift_probability
+            source = self.steps[None, :] + shift[:, None]
+            inside = (source >= 0) & (source < cfg.EMBEDDINGS_COUNT)
+            shifted = torch.gather(x, 1, source.clamp(0, cfg.EMBEDDINGS_COUNT - 1)[:, :, None].expand_as(x))
+            x = torch.where(inside[:, :, None], shifted, other)
+            # Mix with the negative sample
+            weight = self._uniform(batch) * params.mix_max_weight
+            weight *= self._uniform(batch) < params.mix_probability
+            x = torch.lerp(x, other, weight[:, None, None])
+        if params.feature_dropout > 0:
+            x = x.masked_fill(self._uniform(*x.shape) < params.feature_dropout, 0.0)
+        return x.reshape(batch, -1)
@@ -0,0 +1,143 @@
+import json
+import numpy as np
+import numpy.typing as npt
+from pathlib import Path
+
+# Size of the key identifying single cached window
+KEY_SIZE = 16
+# Number of slots added to the cache file when it needs to grow
+GROW_SLOTS = 4096
+# Number of rows copied at once when updating the cache
+COPY_ROWS = 4096
+
+
+# Persistent features of generated windows indexed by a key. Slots are evicted by the least
+# recent run that used them when the cache exceeds its size limit.
+class FeatureCache:
+    def __init__(self, path: 'str|Path', shape: tuple[int, ...], max_bytes: int):
+        self.path = Path(path)
+        self.shape = tuple(shape)
+        self.max_slots = max_bytes // (int(np.prod(self.shape)) * 4)
+        self.keys = np.zeros((0, KEY_SIZE), dtype=np.uint8)
+        # Number of the last run that used the slot, zero for free slots
+        self.stamps = np.zeros(0, dtype=np.int64)
+        self.run = 1
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        index_file = self.path / 'index.npz'
+        features_file = self.path / 'features.dat'
+        if index_file.exists() and features_file.exists():
+            index = np.load(index_file)
+            if tuple(index['shape']) == self.shape:
+                self.keys = index['keys']
+                self.stamps = index['stamps']
+                self.run = int(index['run']) + 1
+        if self.keys.shape[0] > self.max_slots:
+            self._shrink()
+        self.slots = {self.keys[i].tobytes(): i for i in np.flatnonzero(self.stamps)}
+        self.features = self._open('r') if self.keys.shape[0] > 0 else None
+
+    def _shrink(self) -> None:
+        # Size limit was lowered, keep the most recently used entries at the beginning of the file
+        used = np.flatnonzero(self.stamps)
+        keep = np.sort(used[np.argsort(-self.stamps[used], kind='stable')][:self.max_slots])
+        self.evicted += used.shape[0] - keep.shape[0]
+        features = self._open('r+')
+        for slot, source in enumerate(keep):
+            if slot != source:
+                features[slot] = features[source]
+        features.flush()
+        del features
+        self.keys = np.concatenate((self.keys[keep], np.zeros((self.max_slots - keep.shape[0], KEY_SIZE), dtype=np.uint8)))
+        self.stamps = np.concatenate((self.stamps[keep], np.zeros(self.max_slots - keep.shape[0], dtype=np.int64)))
+        with open(self.path / 'features.dat', 'r+b') as f:
+            f.truncate(self.max_slots * int(np.prod(self.shape)) * 4)
+
+    def _open(self, mode: str) -> np.memmap:
+        return np.memmap(self.path / 'features.dat', dtype='float32', mode=mode, shape=(self.keys.shape[0],) + self.shape)
+
+    def get(self, key: bytes) -> 'npt.NDArray[np.float32]|None':
+        slot = self.slots.get(key)
+        if slot is None:
+            return None
+        return np.array(self.features[slot])
+
+    def _grow(self, count: int) -> None:
+        old_count = self.keys.shape[0]
+        new_count = min(self.max_slots, max(old_count + count, old_count + GROW_SLOTS))
+        if new_count <= old_count:
+            return
+        self.keys = np.concatenate((self.keys, np.zeros((new_count - old_count, KEY_SIZE), dtype=np.uint8)))
+        self.stamps = np.concatenate((self.stamps, np.zeros(new_count - old_count, dtype=np.int64)))
+        self.features = None
+        self.path.mkdir(parents=True, exist_ok=True)
+        with open(self.path / 'features.dat', 'ab') as f:
+            f.truncate(new_count * int(np.prod(self.shape)) * 4)
+
+    def _allocate(self, count: int) -> npt.NDArray[np.int64]:
+        free = np.flatnonzero(self.stamps == 0)
+        if free.shape[0] < count:
+            self._grow(count - free.shape[0])
+            free = np.flatnonzero(self.stamps == 0)
+        if free.shape[0] < count:
+            # Evict slots used by the oldest runs, but never the ones used by the current run
+            used = np.flatnonzero((self.stamps > 0) & (self.stamps < self.run))
+            used = used[np.argsort(self.stamps[used], kind='stable')][:count - free.shape[0]]
+            for slot in used:
+                del self.slots[self.keys[slot].tobytes()]
+            self.stamps[used] = 0
+            self.evicted += used.shape[0]
+            free = np.sort(np.concatenate((free, used)))
+        return free[:count]
+
+    # Marks keys as used by the current run and stores features of the keys that are not cached yet
+    def update(self, keys: npt.NDArray[np.uint8], features: npt.NDArray[np.float32]) -> None:
+        new_rows: dict[bytes, int] = {}
+        for row in range(keys.shape[0]):
+            key = keys[row].tobytes()
+            slot = self.slots.get(key)
+            if slot is not None:
+                self.stamps[slot] = self.run
+            elif key not in new_rows:
+                new_rows[key] = row
+        self.hits += keys.shape[0] - len(new_rows)
+        self.misses += len(new_rows)
+        if self.max_slots == 0 or len(new_rows) == 0:
+            return
+        slots = self._allocate(len(new_rows))
+        rows = np.fromiter(new_rows.values(), dtype=np.int64, count=len(new_rows))[:slots.shape[0]]
+        self.keys[slots] = keys[rows]
+        self.stamps[slots] = self.run
+        for key, slot in zip(new_rows.keys(), slots):
+            self.slots[key] = int(slot)
+        self.features = self._open('r+')
+        for begin in range(0, rows.shape[0], COPY_ROWS):
+            end = begin + COPY_ROWS
+            self.features[slots[begin:end]] = features[rows[begin:end]]
+        self.features.flush()
+        self.features = self._open('r')
+
+    def save(self, datasets: dict[str, dict]) -> None:
+        self.path.mkdir(parents=True, exist_ok=True)
+        np.savez(self.path / 'index.npz', keys=self.keys, stamps=self.stamps, run=self.run, shape=self.shape)
+        manifest = {
+            'run': self.run,
+            'shape': list(self.shape),
+            'entries': len(self.slots),
+            'max_entries': int(self.max_slots),
+            'hits': int(self.hits),
+            'misses': int(self.misses),
+            'evicted': int(self.evicted),
+            'datasets': datasets,
+        }
+        with open(self.path / 'manifest.json', 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=4)
+
+
+def read_manifest(path: 'str|Path') -> 'dict|None':
+    file = Path(path) / 'manifest.json'
+    if not file.exists():
+        return None
+    with open(file, 'r', encoding='utf-8') as f:
+        return json.load(f)
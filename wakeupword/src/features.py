@@ -0,0 +1,105 @@
+import numpy as np
+import numpy.typing as npt
+import src.config as cfg
+from src.inference import load_model
+from src.timing import StageTimer
+
+# Number of mel frames needed by the embedding model
+EMBEDDING_INPUT_FRAMES = 76
+# Number of mel frames between two consecutive embedding vectors
+EMBEDDING_STEP_FRAMES = 8
+# Number of audio samples between two consecutive mel frames
+MEL_STEP_SMPL = cfg.MEL_STEP_LENGTH_MS * cfg.SAMPLES_PER_MS
+# Number of additional audio samples needed by the first mel frame
+MEL_CONTEXT_SMPL = (cfg.MEL_WINDOW_LENGTH_MS - cfg.MEL_STEP_LENGTH_MS) * cfg.SAMPLES_PER_MS
+
+
+def embedding_windows(spec: npt.NDArray[np.float32], count: int) -> npt.NDArray[np.float32]:
+    # Strided view (batch, count, 76, 32) over mel spectrogram (batch, frames, 32), nothing is copied
+    assert spec.shape[1] >= (count - 1) * EMBEDDING_STEP_FRAMES + EMBEDDING_INPUT_FRAMES
+    batch_stride, frame_stride, value_stride = spec.strides
+    return np.lib.stride_tricks.as_strided(
+        spec,
+        shape=(spec.shape[0], count, EMBEDDING_INPUT_FRAMES, spec.shape[2]),
+        strides=(batch_stride, frame_stride * EMBEDDING_STEP_FRAMES, frame_stride, value_stride),
+        writeable=False)
+
+
+# Runs melspectrogram and embedding models over batches of fixed-length windows
+class FeatureExtractor:
+    def __init__(self, batch_size: int, window_samples: int = cfg.INPUT_WINDOW_LENGTH_MS * cfg.SAMPLES_PER_MS, timer: 'StageTimer|None' = None,
+                 processes: int = 1):
+        self.batch_size = batch_size
+        self.window_samples = window_samples
+        # Runs of the models are measured as the 'melspectrogram' and 'embedding' stages
+        self.timer = timer if timer is not None else StageTimer(False)
+        # Number of processes running the models at the same time, they share the threads
+        self.melspec_model = load_model('melspectrogram', [batch_size, window_samples], processes=processes)
+        self.emb_model = load_model('embedding_model', [batch_size * cfg.EMBEDDINGS_COUNT, EMBEDDING_INPUT_FRAMES, cfg.MEL_FREQUENCY_VALUES, 1], processes=processes)
+
+    # Returns (N, EMBEDDINGS_COUNT, FEATURES_COUNT) features for (N, window_samples) windows
+    def get_features(self, windows: npt.NDArray[np.float32]) -> npt.NDArray[np.float32]:
+        count = windows.shape[0]
+        result = np.empty((count, cfg.EMBEDDINGS_COUNT, cfg.FEATURES_COUNT), dtype=np.float32)
+        for begin in range(0, count, self.batch_size):
+            end = min(count, begin + self.batch_size)
+            result[begin:end] = self._run_batch(windows[begin:end])
+        return result
+
+    # Returns (steps, FEATURES_COUNT) features of a recording of any length, one vector for each
+    # EMBEDDING_STEP_FRAMES mel frames. Mel spectrogram is computed once for the whole recording.
+    def get_recording_features(self, audio: npt.NDArray[np.float32]) -> npt.NDArray[np.float32]:
+        frames = (audio.shape[0] - MEL_CONTEXT_SMPL) // MEL_STEP_SMPL
+        if frames < EMBEDDING_INPUT_FRAMES:
+            return np.zeros((0, cfg.FEATURES_COUNT), dtype=np.float32)
+        # Consecutive chunks overlap by the context, so their mel frames follow each other
+        chunk_frames = (self.window_samples - MEL_CONTEXT_SMPL) // MEL_STEP_SMPL
+        chunks = (frames + chunk_frames - 1) // chunk_frames
+        padded = np.zeros(chunks * chunk_frames * MEL_STEP_SMPL + MEL_CONTEXT_SMPL, dtype=np.float32)
+        length = min(audio.shape[0], padded.shape[0])
+        padded[:length] = audio[:length]
+        windows = np.lib.stride_tricks.as_strided(
+            padded,
+            shape=(chunks, self.window_samples),
+            strides=(chunk_frames * MEL_STEP_SMPL * padded.strides[0], padded.strides[0]),
+            writeable=False)
+        spec = np.empty((chunks, chunk_frames, cfg.MEL_FREQUENCY_VALUES), dtype=np.float32)
+        for begin in range(0, chunks, self.batch_size):
+            count = min(chunks - begin, self.batch_size)
+            spec[begin:begin + count] = self._run_melspec(windows[begin:begin + count])[:count, :chunk_frames]
+        count = (frames - EMBEDDING_INPUT_FRAMES) // EMBEDDING_STEP_FRAMES + 1
+        mel_windows = embedding_windows(spec.reshape(1, -1, cfg.MEL_FREQUENCY_VALUES), count)[0]
+        result = np.empty((count, cfg.FEATURES_COUNT), dtype=np.float32)
+        capacity = self.batch_size * cfg.EMBEDDINGS_COUNT
+        for begin in range(0, count, capacity):
+            result[begin:begin + capacity] = self._run_embedding(mel_windows[begin:begin + capacity])
+        return result
+
+    def _run_melspec(self, windows: npt.NDArray[np.float32]) -> npt.NDArray[np.float32]:
+        # Models have fixed batch size, so the missing windows of the last batch are silence
+        melspec_input = self.melspec_model.input()
+        count = windows.shape[0]
+        melspec_input[:count] = windows
+        melspec_input[count:] = 0
+        del melspec_input
+        with self.timer.stage('melspectrogram'):
+            output = self.melspec_model.run()
+        return output.reshape((self.batch_size, -1, cfg.MEL_FREQUENCY_VALUES))
+
+    def _run_embedding(self, windows: npt.NDArray[np.float32]) -> npt.NDArray[np.float32]:
+        # Write the windows (..., EMBEDDING_INPUT_FRAMES, MEL_FREQUENCY_VALUES) directly to the input buffer, the rest is silence
+        emb_input = self.emb_model.input()
+        rows = emb_input.reshape((-1, EMBEDDING_INPUT_FRAMES, cfg.MEL_FREQUENCY_VALUES))
+        count = int(np.prod(windows.shape[:-2]))
+        rows[:count].reshape(windows.shape)[...] = windows
+        rows[count:] = 0
+        del emb_input, rows
+        with self.timer.stage('embedding'):
+            output = self.emb_model.run()
+        return output.reshape((-1, cfg.FEATURES_COUNT))[:count]
+
+    def _run_batch(self, windows: npt.NDArray[np.float32]) -> npt.NDArray[np.float32]:
+        count = windows.shape[0]
+        spec = self._run_melspec(windows)
+        features = self._run_embedding(embedding_windows(spec, cfg.EMBEDDINGS_COUNT))
+        return features.reshape((self.batch_size, cfg.EMBEDDINGS_COUNT, cfg.FEATURES_COUNT))[:count]
@@ -0,0 +1,80 @@
+from pathlib import Path
+import torch
+import torch.nn as nn
+import src.config as cfg
+
+head_model_input_size = cfg.EMBEDDINGS_COUNT * cfg.FEATURES_COUNT
+shared_input_parts = cfg.EMBEDDINGS_WINDOW_DEVISABLE_BY
+shared_output_size = 16
+middle_layer_size = 16
+
+# ===== Model Definition =====
+
+class SharedLinearNet(nn.Module):
+    # One output (score) for each keyword
+    def __init__(self, outputs: int = len(cfg.KEYWORDS)):
+        super(SharedLinearNet, self).__init__()
+
+        assert head_model_input_size % shared_input_parts == 0, "Input size must be divisible by number of parts"
+
+        self.part_size = head_model_input_size // shared_input_parts
+        self.shared_linear = nn.Linear(self.part_size, shared_output_size)
+
+        self.classifier = nn.Sequential(
+            nn.ReLU(),
+            nn.Linear(shared_output_size * shared_input_parts, middle_layer_size),
+            nn.ReLU(),
+            nn.Linear(middle_layer_size, outputs),
+            #nn.Sigmoid()
+        )
+
+    def forward(self, x):
+        # Input is (batch, head_model_input_size) or just (head_model_input_size). All parts go through
+        # the shared layer in a single matrix multiplication.
+        parts = x.reshape(*x.shape[:-1], shared_input_parts, self.part_size)
+        combined = self.shared_linear(parts).flatten(-2)
+        return self.classifier(combined)
+
+
+# Separately trained heads evaluated together with batched matrix multiplications, outputs of
+# all heads are concatenated in the order of the heads
+class StackedHeads(nn.Module):
+    def __init__(self, heads: list[SharedLinearNet]):
+        super(StackedHeads, self).__init__()
+        self.part_size = heads[0].part_size
+        self.layers = nn.ParameterList()
+        for index in (0, 1, 3):
+            for name in ('weight', 'bias'):
+                layers = [(head.shared_linear if index == 0 else head.classifier[index]) for head in heads]
+                self.layers.append(nn.Parameter(torch.stack([getattr(layer, name).detach() for layer in layers]), requires_grad=False))
+
+    def forward(self, x):
+        shared_weight, shared_bias, middle_weight, middle_bias, output_weight, output_bias = self.layers
+        parts = x.reshape(*x.shape[:-1], 1, shared_input_parts, self.part_size)
+        # (..., heads, parts, shared_output_size)
+        combined = torch.relu(torch.matmul(parts, shared_weight.transpose(-1, -2)) + shared_bias.unsqueeze(-2))
+        middle = torch.relu(torch.matmul(middle_weight, combined.flatten(-2).unsqueeze(-1)).squeeze(-1) + middle_bias)
+        output = torch.matmul(output_weight, middle.unsqueeze(-1)).squeeze(-1) + output_bias
+        return output.flatten(-2)
+
+
+def load_head_model(path: 'str|Path') -> SharedLinearNet:
+    # Number of outputs is taken from the saved weights
+    state = torch.load(path)
+    model = SharedLinearNet(state['classifier.3.weight'].shape[0])
+    model.load_state_dict(state)
+    model.eval()
+    return model
+
+
+def export_onnx(model: 'SharedLinearNet|StackedHeads', path: 'str|Path') -> None:
+    # Exported model has input "features" (batch, head_model_input_size) and output "score" (batch, keywords)
+    model.eval()
+    torch.onnx.export(
+        model,
+        (torch.zeros(2, head_model_input_size),),
+        str(path),
+        input_names=['features'],
+        output_names=['score'],
+        dynamic_axes={'features': {0: 'batch'}, 'score': {0: 'batch'}},
+        external_data=False)
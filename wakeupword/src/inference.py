@@ -0,0 +1,116 @@
+import json
+from pathlib import Path
+import numpy as np
+import numpy.typing as npt
+import src.config as cfg
+from src.common import model_path
+
+# Runs the melspectrogram and embedding models with TFLite or ONNX Runtime. Each model has a fixed
+# input shape, preallocated input and output buffers and explicitly configured threads.
+
+BACKENDS = ('tflite', 'onnx')
+# Fastest backend for each usage measured on this host by benchmarks/inference_backends.py
+BENCHMARK_FILE = cfg.MODELS_DIR / 'inference_benchmark.json'
+
+
+class InferenceModel:
+    # Output buffer is reused, so the returned array is valid until the next run
+    output: npt.NDArray[np.float32]
+
+    # Writable input buffer, it must be released before calling run() (TFLite does not allow
+    # references to its internal buffers during the inference)
+    def input(self) -> npt.NDArray[np.float32]:
+        raise NotImplementedError()
+
+    def run(self) -> npt.NDArray[np.float32]:
+        raise NotImplementedError()
+
+    def __call__(self, input: npt.NDArray[np.float32]) -> npt.NDArray[np.float32]:
+        buffer = self.input()
+        buffer[...] = input.reshape(buffer.shape)
+        del buffer
+        return self.run()
+
+
+class TfliteModel(InferenceModel):
+    def __init__(self, path: Path, input_shape: list[int], threads: int):
+        import tensorflow as tf
+        self.interpreter = tf.lite.Interpreter(model_path=str(path), num_threads=threads if threads > 0 else None)
+        self.input_index = self.interpreter.get_input_details()[0]['index']
+        self.interpreter.resize_tensor_input(self.input_index, input_shape, strict=True)
+        self.interpreter.allocate_tensors()
+        output_details = self.interpreter.get_output_details()[0]
+        self.output_index = output_details['index']
+        self.output = np.zeros(output_details['shape'], dtype=np.float32)
+
+    def input(self) -> npt.NDArray[np.float32]:
+        return self.interpreter.tensor(self.input_index)()
+
+    def run(self) -> npt.NDArray[np.float32]:
+        self.interpreter.invoke()
+        self.output[...] = self.interpreter.tensor(self.output_index)()
+        return self.output
+
+
+class OnnxModel(InferenceModel):
+    def __init__(self, path: Path, input_shape: list[int], threads: int):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(str(path), options, providers=['CPUExecutionProvider'])
+        input_name = self.session.get_inputs()[0].name
+        output_name = self.session.get_outputs()[0].name
+        self.input_buffer = np.zeros(input_shape, dtype=np.float32)
+        # Output shape depends on the input shape, so it is taken from a single run
+        self.output = np.zeros_like(self.session.run([output_name], {input_name: self.input_buffer})[0])
+        # Both buffers are bound once, the session reads and writes them directly
+        self.binding = self.session.io_binding()
+        self.binding.bind_input(input_name, 'cpu', 0, np.float32, self.input_buffer.shape, self.input_buffer.ctypes.data)
+        self.binding.bind_output(output_name, 'cpu', 0, np.float32, self.output.shape, self.output.ctypes.data)
+
+    def input(self) -> npt.NDArray[np.float32]:
+        return self.input_buffer
+
+    def run(self) -> npt.NDArray[np.float32]:
+        self.session.run_with_iobinding(self.binding)
+        return self.output
+
+
+def select_backend(usage: str, processes: int = 1) -> tuple[str, int]:
+    # Returns backend name and number of threads for 'batch' (generation) or 'streaming' (detection) usage.
+    # Threads are measured and configured for a single process, so when `processes` run the models at
+    # the same time (generation workers), they are divided among them to not oversubscribe the CPU.
+    if cfg.MODEL_VARIANT != '':
+        # Quantized variants of the models exist only in the ONNX format
+        backend, threads = 'onnx', cfg.inference.threads
+    elif cfg.inference.backend != 'auto':
+        backend, threads = cfg.inference.backend, cfg.inference.threads
+    elif BENCHMARK_FILE.exists():
+        with open(BENCHMARK_FILE, 'r', encoding='utf-8') as f:
+            best = json.load(f)['best'][usage]
+        backend, threads = best['backend'], best['threads']
+    else:
+        backend, threads = 'tflite', cfg.inference.threads
+    if processes > 1:
+        # Runtime default is all cores in each process, so it is one thread per process instead
+        threads = max(1, threads // processes)
+    return backend, threads
+
+
+def model_file(name: str, backend: str) -> Path:
+    return model_path(name, 'tflite' if backend == 'tflite' else 'onnx')
+
+
+def load_model(name: str, input_shape: list[int], usage: str = 'batch', backend: 'str|None' = None, threads: 'int|None' = None,
+               processes: int = 1) -> InferenceModel:
+    selected_backend, selected_threads = select_backend(usage, processes)
+    backend = backend or selected_backend
+    threads = selected_threads if threads is None else threads
+    if backend == 'tflite':
+        return TfliteModel(model_file(name, backend), input_shape, threads)
+    elif backend == 'onnx':
+        return OnnxModel(model_file(name, backend), input_shape, threads)
+    raise ValueError(f'Unknown inference backend "{backend}", expected one of {BACKENDS}.')
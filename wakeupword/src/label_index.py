@@ -0,0 +1,152 @@
+import os
+import random
+import hashlib
+from pathlib import Path
+import numpy as np
+import numpy.typing as npt
+import src.config as cfg
+from src.common import Label, SampleSet, read_label_file
+
+# Class of a label in LabelIndex.classes, values >= 0 are indexes of the keywords in cfg.KEYWORDS
+NEGATIVE_CLASS = -1
+OTHER_CLASS = -2
+
+
+def label_classes(texts: npt.NDArray[np.str_]) -> npt.NDArray[np.int16]:
+    # Vectorized src.common.keyword_index, labels starting with "n" that are not keywords are negative
+    texts = np.char.lower(texts)
+    result = np.where(np.char.startswith(texts, 'n'), NEGATIVE_CLASS, OTHER_CLASS).astype(np.int16)
+    # Longer prefixes are assigned last, so they win, the first keyword wins between the same prefixes
+    order = sorted(range(len(cfg.KEYWORDS)), key=lambda index: (len(cfg.KEYWORDS[index].label_prefix), -index))
+    for index in order:
+        result[np.char.startswith(texts, cfg.KEYWORDS[index].label_prefix.lower())] = index
+    return result
+
+
+# Labels of all recordings in a directory stored as arrays (struct-of-arrays), so it can be saved and
+# loaded without parsing the label files again. Files are in the same order as sorted paths of the
+# recordings and labels are in the order of the lines, so the order is the same as if they were parsed.
+class LabelIndex:
+    def __init__(self, root: Path, files: npt.NDArray[np.str_], mtimes: npt.NDArray[np.int64], sizes: npt.NDArray[np.int64],
+                 file_ids: npt.NDArray[np.int32], begins: npt.NDArray[np.float64], ends: npt.NDArray[np.float64], texts: npt.NDArray[np.str_]):
+        self.root = root
+        # Recordings relative to the root and modification time and size of their label files
+        self.files = files
+        self.mtimes = mtimes
+        self.sizes = sizes
+        # One item for each label
+        self.file_ids = file_ids
+        self.begins = begins
+        self.ends = ends
+        self.texts = texts
+        self.classes = label_classes(texts)
+        self.begin_smpl = np.round(begins * cfg.SAMPLE_RATE).astype(np.int64)
+        self.end_smpl = np.round(ends * cfg.SAMPLE_RATE).astype(np.int64)
+        # Labels of each class sorted by length for the random draws, created when needed
+        self.by_length: dict[int, tuple[npt.NDArray[np.int64], npt.NDArray[np.int64]]] = {}
+
+    def __len__(self) -> int:
+        return self.file_ids.shape[0]
+
+    def wav(self, label: int) -> Path:
+        return self.root / self.files[self.file_ids[label]]
+
+    # Random label of the class at least min_smpl samples long, -1 if there is no such label
+    def random_label(self, label_class: int, min_smpl: int = 0) -> int:
+        if label_class not in self.by_length:
+            labels = np.flatnonzero(self.classes == label_class)
+            labels = labels[np.argsort(self.end_smpl[labels] - self.begin_smpl[labels], kind='stable')]
+            self.by_length[label_class] = (labels, self.end_smpl[labels] - self.begin_smpl[labels])
+        labels, lengths = self.by_length[label_class]
+        first = int(np.searchsorted(lengths, min_smpl))
+        if first == labels.shape[0]:
+            return -1
+        return int(labels[random.randint(first, labels.shape[0] - 1)])
+
+    def samples(self) -> list[SampleSet]:
+        samples = [SampleSet(wav=self.root / file, txt=(self.root / file).with_suffix('.txt'), labels=[]) for file in self.files]
+        for file_id, begin, end, text in zip(self.file_ids.tolist(), self.begins.tolist(), self.ends.tolist(), self.texts.tolist()):
+            sample = samples[file_id]
+            sample.labels.append(Label(begin=begin, end=end, text=text, set=sample))
+        return samples
+
+    # Positive labels of all keywords and negative labels
+    def labels(self) -> tuple[list[Label], list[Label]]:
+        labels = [label for sample in self.samples() for label in sample.labels]
+        positive = [labels[index] for index in np.flatnonzero(self.classes >= 0)]
+        negative = [labels[index] for index in np.flatnonzero(self.classes == NEGATIVE_CLASS)]
+        return positive, negative
+
+    def save(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_suffix('.tmp.npz')
+        np.savez(temp_path, root=str(self.root), files=self.files, mtimes=self.mtimes, sizes=self.sizes,
+                 file_ids=self.file_ids, begins=self.begins, ends=self.ends, texts=self.texts)
+        os.replace(temp_path, path)
+
+
+def index_path(root: Path) -> Path:
+    return cfg.DATA_DIR / 'label_index' / f'{hashlib.blake2b(str(root).encode(), digest_size=8).hexdigest()}.npz'
+
+
+def scan_files(root: Path) -> list[Path]:
+    # Recordings (relative to the root) that have a label file, in the order of sorted paths
+    files = []
+    for directory, _, names in os.walk(root):
+        names = set(names)
+        for name in names:
+            if name.endswith('.wav') and name[:-4] + '.txt' in names:
+                files.append((Path(directory) / name).relative_to(root))
+    return sorted(files)
+
+
+def load_label_index(root_dir: 'str|Path') -> LabelIndex:
+    # Only the label files that changed (by modification time or size) since the last call are parsed again.
+    # Each call still walks the directory tree and reads the status of every label file, which is fast on
+    # a local disk, but can take a while on a network drive with many recordings.
+    root = Path(root_dir)
+    path = index_path(root)
+    files = np.array([file.as_posix() for file in scan_files(root)], dtype=np.str_)
+    mtimes = np.zeros(files.shape[0], dtype=np.int64)
+    sizes = np.zeros(files.shape[0], dtype=np.int64)
+    for file_id, file in enumerate(files.tolist()):
+        stat = (root / file).with_suffix('.txt').stat()
+        mtimes[file_id] = stat.st_mtime_ns
+        sizes[file_id] = stat.st_size
+    saved = None
+    if path.exists():
+        # Members of the archive are decompressed on each access, so each one is read once
+        with np.load(path) as archive:
+            saved = {key: archive[key] for key in archive.files}
+    if saved is not None and str(saved['root']) != str(root):
+        saved = None
+    if saved is not None and np.array_equal(saved['files'], files) and np.array_equal(saved['mtimes'], mtimes) and np.array_equal(saved['sizes'], sizes):
+        return LabelIndex(root, files, mtimes, sizes, saved['file_ids'], saved['begins'], saved['ends'], saved['texts'])
+    # Labels of the unchanged files are taken from the saved index
+    cached: dict[str, tuple[int, int, list[tuple[float, float, str]]]] = {}
+    if saved is not None:
+        begins, ends, texts = saved['begins'].tolist(), saved['ends'].tolist(), saved['texts'].tolist()
+        bounds = np.searchsorted(saved['file_ids'], np.arange(saved['files'].shape[0] + 1)).tolist()
+        for file_id, file in enumerate(saved['files'].tolist()):
+            begin, end = bounds[file_id], bounds[file_id + 1]
+            cached[file] = (int(saved['mtimes'][file_id]), int(saved['sizes'][file_id]), list(zip(begins[begin:end], ends[begin:end], texts[begin:end])))
+    labels: list[tuple[float, float, str]] = []
+    file_ids: list[int] = []
+    for file_id, file in enumerate(files.tolist()):
+        if file in cached and cached[file][:2] == (mtimes[file_id], sizes[file_id]):
+            file_labels = cached[file][2]
+        else:
+            file_labels = read_label_file((root / file).with_suffix('.txt'))
+        labels.extend(file_labels)
+        file_ids.extend([file_id] * len(file_labels))
+    index = LabelIndex(
+        root,
+        files,
+        mtimes,
+        sizes,
+        np.array(file_ids, dtype=np.int32),
+        np.array([label[0] for label in labels], dtype=np.float64),
+        np.array([label[1] for label in labels], dtype=np.float64),
+        np.array([label[2] for label in labels], dtype=np.str_))
+    index.save(path)
+    return index
@@ -0,0 +1,125 @@
+import math
+import functools
+import numpy as np
+import numpy.typing as npt
+import scipy.signal
+import src.config as cfg
+
+# Integrated loudness (ITU-R BS.1770-4) of many mono segments at once. It gives the same results as
+# pyloudnorm.Meter(rate).integrated_loudness() (within float rounding), but the K-weighting filter is
+# designed once for each sample rate and the blocks and gating are computed for all segments together.
+
+# Gating block length in seconds and the overlap of the consecutive blocks
+BLOCK_LENGTH = 0.4
+BLOCK_OVERLAP = 0.75
+# Absolute gate in LUFS and the relative gate in LU below the loudness of the blocks above the absolute gate
+ABSOLUTE_GATE = -70.0
+RELATIVE_GATE = -10.0
+
+
+def biquad(gain_db: float, q: float, frequency: float, rate: int, kind: str) -> npt.NDArray[np.float64]:
+    # Second-order section (b0, b1, b2, a0, a1, a2) from the Audio EQ Cookbook, same as in pyloudnorm
+    a = 10 ** (gain_db / 40)
+    w0 = 2 * math.pi * (frequency / rate)
+    alpha = math.sin(w0) / (2 * q)
+    cos_w0 = math.cos(w0)
+    if kind == 'high_shelf':
+        b = [a * ((a + 1) + (a - 1) * cos_w0 + 2 * math.sqrt(a) * alpha),
+             -2 * a * ((a - 1) + (a + 1) * cos_w0),
+             a * ((a + 1) + (a - 1) * cos_w0 - 2 * math.sqrt(a) * alpha)]
+        d = [(a + 1) - (a - 1) * cos_w0 + 2 * math.sqrt(a) * alpha,
+             2 * ((a - 1) - (a + 1) * cos_w0),
+             (a + 1) - (a - 1) * cos_w0 - 2 * math.sqrt(a) * alpha]
+    elif kind == 'high_pass':
+        b = [(1 + cos_w0) / 2, -(1 + cos_w0), (1 + cos_w0) / 2]
+        d = [1 + alpha, -2 * cos_w0, 1 - alpha]
+    else:
+        raise ValueError(f'Unknown filter kind "{kind}".')
+    return np.array(b + d, dtype=np.float64) / d[0]
+
+
+@functools.lru_cache(maxsize=None)
+def k_weighting(rate: int) -> npt.NDArray[np.float64]:
+    # High shelf (head effects) followed by the high pass (RLB weighting) as second-order sections
+    # (scipy.signal.sosfilt does not accept a read-only array, so it is not protected from changes)
+    return np.stack([
+        biquad(4.0, 1 / math.sqrt(2), 1500.0, rate, 'high_shelf'),
+        biquad(0.0, 0.5, 38.0, rate, 'high_pass'),
+    ])
+
+
+@functools.lru_cache(maxsize=None)
+def block_bounds(length: int, rate: int) -> tuple[npt.NDArray[np.int64], npt.NDArray[np.int64]]:
+    # Begin and end of each gating block of a segment, computed exactly as pyloudnorm does it
+    step = 1 - BLOCK_OVERLAP
+    count = int(np.round((length / rate - BLOCK_LENGTH) / (BLOCK_LENGTH * step))) + 1
+    blocks = np.arange(count, dtype=np.float64)
+    begins = (BLOCK_LENGTH * (blocks * step) * rate).astype(np.int64)
+    ends = np.minimum((BLOCK_LENGTH * (blocks * step + 1) * rate).astype(np.int64), length)
+    begins.flags.writeable = False
+    ends.flags.writeable = False
+    return begins, ends
+
+
+def integrated_loudness(data: npt.NDArray[np.float32], lengths: 'npt.NDArray[np.int64]|None' = None, rate: int = cfg.SAMPLE_RATE) -> npt.NDArray[np.float64]:
+    # Loudness in LUFS of each row of data (count, samples), -inf for silence. Rows can be shorter than
+    # the array, then the samples after their lengths are ignored.
+    data = np.atleast_2d(data)
+    if lengths is None:
+        lengths = np.full(data.shape[0], data.shape[1], dtype=np.int64)
+    if data.shape[0] == 0:
+        return np.zeros(0, dtype=np.float64)
+    if int(lengths.min()) < BLOCK_LENGTH * rate:
+        raise ValueError('Audio must have length greater than the block size.')
+    # Samples after the length of a row are not filtered, the filter would fill them with slow subnormal numbers
+    weighted = np.zeros(data.shape, dtype=np.float64)
+    full = lengths == data.shape[1]
+    weighted[full] = scipy.signal.sosfilt(k_weighting(rate), data[full], axis=1)
+    for row in np.flatnonzero(~full):
+        weighted[row, :lengths[row]] = scipy.signal.sosfilt(k_weighting(rate), data[row, :lengths[row]])
+    # Blocks of all rows, rows with fewer blocks are padded with blocks that are never selected
+    bounds = [block_bounds(int(length), rate) for length in lengths]
+    blocks = max(begins.shape[0] for begins, _ in bounds)
+    begins = np.zeros((data.shape[0], blocks), dtype=np.int64)
+    ends = np.zeros((data.shape[0], blocks), dtype=np.int64)
+    valid = np.zeros((data.shape[0], blocks), dtype=bool)
+    for row, (row_begins, row_ends) in enumerate(bounds):
+        begins[row, :row_begins.shape[0]] = row_begins
+        ends[row, :row_ends.shape[0]] = row_ends
+        valid[row, :row_begins.shape[0]] = True
+    # Blocks overlap, so the energy is summed between all block boundaries first and each block is a
+    # difference of the cumulative sums at its boundaries (much faster than the cumulative sum of all samples)
+    edges = np.unique(np.concatenate((begins.reshape(-1), ends.reshape(-1), [0])))
+    edges = edges[edges < data.shape[1]]
+    energy = np.zeros((data.shape[0], edges.shape[0] + 1), dtype=np.float64)
+    np.cumsum(np.add.reduceat(np.square(weighted), edges, axis=1), axis=1, out=energy[:, 1:])
+    rows = np.arange(data.shape[0])[:, None]
+    mean_square = (energy[rows, np.searchsorted(edges, ends)] - energy[rows, np.searchsorted(edges, begins)]) / (BLOCK_LENGTH * rate)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        block_loudness = -0.691 + 10 * np.log10(mean_square)
+        # Absolute gating, then relative gating against the mean of the blocks that passed it
+        selected = valid & (block_loudness >= ABSOLUTE_GATE)
+        relative_gate = -0.691 + 10 * np.log10(np.sum(mean_square * selected, axis=1) / np.sum(selected, axis=1)) + RELATIVE_GATE
+        selected = valid & (block_loudness > relative_gate[:, None]) & (block_loudness > ABSOLUTE_GATE)
+        gated = np.nan_to_num(np.sum(mean_square * selected, axis=1) / np.sum(selected, axis=1))
+        return -0.691 + 10 * np.log10(gated)
+
+
+def normalize_loudness(data: npt.NDArray[np.float32], target: 'float|npt.NDArray', lengths: 'npt.NDArray[np.int64]|None' = None) -> None:
+    # Scales each row of data (count, samples) in place to the target loudness, silent rows are left unchanged
+    loudness = integrated_loudness(data, lengths)
+    gain = np.where(np.isfinite(loudness), np.power(10, (target - loudness) / 20), 1)
+    np.multiply(np.atleast_2d(data), gain[:, None].astype(data.dtype), out=np.atleast_2d(data))
+
+
+def normalize_segments(segments: list[npt.NDArray[np.float32]], target: float) -> None:
+    # Scales segments of different lengths in place, their loudness is measured together
+    lengths = np.array([segment.shape[0] for segment in segments], dtype=np.int64)
+    data = np.empty((len(segments), int(lengths.max())), dtype=np.float32)
+    for row, segment in enumerate(segments):
+        data[row, :segment.shape[0]] = segment
+    loudness = integrated_loudness(data, lengths)
+    for row, segment in enumerate(segments):
+        if math.isfinite(loudness[row]):
+            segment *= np.float32(10 ** ((target - loudness[row]) / 20))
+
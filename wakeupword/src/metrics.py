@@ -0,0 +1,59 @@
+import torch
+
+
+# Metrics of a binary classifier computed from the scores of the whole dataset at once. Scores are
+# sorted once and all possible thresholds are evaluated using cumulative sums of the labels. At least one
+# positive and one negative sample is needed, the rates are undefined otherwise.
+def binary_metrics(scores: torch.Tensor, labels: torch.Tensor, threshold: float, target_false_accept_rate: float) -> dict:
+    scores = scores.reshape(-1)
+    positive = labels.reshape(-1) >= 0.5
+    positive_count = int(positive.sum())
+    negative_count = positive.shape[0] - positive_count
+    if positive_count == 0 or negative_count == 0:
+        raise ValueError(f'Binary metrics need positive and negative samples, got {positive_count} positive and {negative_count} negative.')
+
+    # Confusion matrix at the given threshold
+    predicted = scores >= threshold
+    tp = int((predicted & positive).sum())
+    fp = int(predicted.sum()) - tp
+    fn = positive_count - tp
+    tn = positive.shape[0] - tp - fp - fn
+
+    # True and false accepts for each distinct score used as a threshold, starting from accepting nothing
+    order = torch.argsort(scores, descending=True)
+    sorted_scores = scores[order]
+    sorted_positive = positive[order].to(torch.float64)
+    last = torch.cat((torch.nonzero(sorted_scores[1:] != sorted_scores[:-1]).view(-1), torch.tensor([scores.shape[0] - 1])))
+    zero = torch.zeros(1, dtype=torch.float64)
+    true_accepts = torch.cat((zero, torch.cumsum(sorted_positive, 0)[last]))
+    false_accepts = torch.cat((zero, (last + 1).to(torch.float64) - true_accepts[1:]))
+    thresholds = torch.cat((torch.tensor([float('inf')]), sorted_scores[last].to(torch.float32)))
+    tpr = true_accepts / positive_count
+    fpr = false_accepts / negative_count
+    precision = true_accepts / (true_accepts + false_accepts).clamp_min(1)
+    precision[0] = 1.0
+
+    # Equal error rate where the false reject rate crosses the false accept rate
+    crossing = int(torch.nonzero(fpr >= 1 - tpr)[0, 0])
+    eer = float(fpr[crossing] + 1 - tpr[crossing]) / 2
+
+    # Lowest threshold that keeps the false accept rate within the target
+    target = int(torch.nonzero(fpr <= target_false_accept_rate)[-1, 0])
+
+    return {
+        'tp': tp,
+        'fp': fp,
+        'fn': fn,
+        'tn': tn,
+        'precision': tp / max(1, tp + fp),
+        'recall': tp / max(1, tp + fn),
+        'f1': 2 * tp / max(1, 2 * tp + fp + fn),
+        'roc_auc': float(torch.trapezoid(tpr, fpr)),
+        'average_precision': float(((tpr[1:] - tpr[:-1]) * precision[1:]).sum()),
+        'eer': eer,
+        'eer_threshold': float(thresholds[crossing]),
+        'target_threshold': float(thresholds[target]),
+        'target_recall': float(tpr[target]),
+        'target_false_accept_rate': float(fpr[target]),
+        'curve': {'thresholds': thresholds, 'tpr': tpr, 'fpr': fpr, 'precision': precision},
+    }
@@ -0,0 +1,105 @@
+import time
+import json
+import array
+import functools
+from pathlib import Path
+from typing import Callable
+import numpy as np
+
+# Low overhead timing of the named stages of a pipeline. Each stage keeps the duration of every call in
+# a compact array, so the percentiles can be computed at the end. Stages can be nested (the time of the
+# inner stage is also included in the outer one), but a stage must not be nested in itself.
+
+PERCENTILES = (50, 90, 99)
+
+
+class Stage:
+    # Context manager measuring the calls of a single stage
+    __slots__ = ('durations', 'start')
+
+    def __init__(self):
+        self.durations = array.array('d')
+        self.start = 0.0
+
+    def __enter__(self) -> None:
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exception) -> None:
+        self.durations.append(time.perf_counter() - self.start)
+
+
+class NullStage:
+    __slots__ = ()
+
+    def __enter__(self) -> None:
+        pass
+
+    def __exit__(self, *exception) -> None:
+        pass
+
+
+NULL_STAGE = NullStage()
+
+
+class StageTimer:
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.stages: dict[str, Stage] = {}
+
+    # Usage: with timer.stage('name'): ...
+    def stage(self, name: str) -> 'Stage|NullStage':
+        if not self.enabled:
+            return NULL_STAGE
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = Stage()
+        return stage
+
+    # Decorator measuring all calls of the function as the stage, the function keeps its own name in profiles
+    def timed(self, name: str) -> Callable[[Callable], Callable]:
+        def decorator(function: Callable) -> Callable:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return function(*args, **kwargs)
+            return wrapper if self.enabled else function
+        return decorator
+
+    # Picklable durations, so the timers of the worker processes can be merged by the main process
+    def state(self) -> dict[str, bytes]:
+        return {name: stage.durations.tobytes() for name, stage in self.stages.items()}
+
+    def merge(self, state: dict[str, bytes]) -> None:
+        for name, durations in state.items():
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = Stage()
+            stage.durations.frombytes(durations)
+
+    def summary(self) -> dict[str, dict[str, float]]:
+        result = {}
+        for name, stage in self.stages.items():
+            durations = np.frombuffer(stage.durations, dtype=np.float64) if len(stage.durations) > 0 else np.zeros(1)
+            result[name] = {
+                'calls': len(stage.durations),
+                'total_seconds': float(durations.sum()),
+                'mean_ms': float(durations.mean() * 1000),
+                **{f'p{percentile}_ms': float(np.percentile(durations, percentile) * 1000) for percentile in PERCENTILES},
+                'max_ms': float(durations.max() * 1000),
+            }
+        return result
+
+    # Stages sorted by their total time, the share is relative to the wall time of all workers together
+    def print_summary(self, wall_seconds: float) -> None:
+        summary = self.summary()
+        percentiles = ''.join(f'{f"p{percentile} ms":>10}' for percentile in PERCENTILES)
+        print(f'{"Stage":<20}{"Calls":>10}{"Total s":>10}{"Share":>8}{"Mean ms":>10}{percentiles}{"Max ms":>10}')
+        for name, item in sorted(summary.items(), key=lambda item: -item[1]['total_seconds']):
+            percentiles = ''.join(f'{item[f"p{percentile}_ms"]:>10.3f}' for percentile in PERCENTILES)
+            share = item['total_seconds'] / wall_seconds * 100 if wall_seconds > 0 else 0
+            print(f'{name:<20}{item["calls"]:>10}{item["total_seconds"]:>10.2f}{share:>7.1f}%{item["mean_ms"]:>10.3f}{percentiles}{item["max_ms"]:>10.3f}')
+
+    def save(self, path: Path, wall_seconds: float, **info) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'wall_seconds': wall_seconds, **info, 'stages': self.summary()}, f, indent=4)
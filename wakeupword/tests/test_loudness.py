@@ -0,0 +1,83 @@
+import os
+import sys
+import pytest
+pyloudnorm = pytest.importorskip('pyloudnorm')
+import numpy as np
+import scipy.signal
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import src.config as cfg
+from src.loudness import BLOCK_LENGTH, integrated_loudness, normalize_loudness, normalize_segments
+
+# Maximum allowed difference from pyloudnorm in LU (only float rounding is expected)
+TOLERANCE_LU = 1e-4
+
+
+def random_segments(count: int = 64) -> tuple[np.ndarray, np.ndarray]:
+    # Noise with a random length, level, slope and bursts, some rows are partly below the gates, row 0
+    # (and each 16th) is silent and row 1 is near silent (below the absolute gate)
+    generator = np.random.default_rng(0)
+    lengths = generator.integers(int(BLOCK_LENGTH * cfg.SAMPLE_RATE), 3 * cfg.SAMPLE_RATE, count)
+    data = np.zeros((count, int(lengths.max())), dtype=np.float32)
+    for row, length in enumerate(lengths):
+        noise = generator.standard_normal(length) * 10 ** generator.uniform(-4, 0)
+        noise = scipy.signal.lfilter([1], [1, -generator.uniform(-0.95, 0.95)], noise)
+        noise *= np.repeat(10 ** generator.uniform(-5, 0, length // 1600 + 1), 1600)[:length]
+        data[row, :length] = np.clip(noise, -1, 1) * (row % 16 != 0)
+    data[1, :lengths[1]] = generator.standard_normal(lengths[1]) * 1e-6
+    return data, lengths
+
+
+def pyloudnorm_loudness(data: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    meter = pyloudnorm.Meter(cfg.SAMPLE_RATE)
+    return np.array([meter.integrated_loudness(data[row, :length]) for row, length in enumerate(lengths.tolist())])
+
+
+def test_integrated_loudness():
+    data, lengths = random_segments()
+    assert np.unique(lengths).shape[0] > 1
+    expected = pyloudnorm_loudness(data, lengths)
+    result = integrated_loudness(data, lengths)
+    finite = np.isfinite(expected)
+    assert not finite[0] and not finite[1]
+    assert np.array_equal(finite, np.isfinite(result))
+    assert np.abs(result[finite] - expected[finite]).max() < TOLERANCE_LU
+
+
+def test_integrated_loudness_full_rows():
+    data, lengths = random_segments(8)
+    data = data[:, :int(lengths.min())]
+    lengths = np.full(data.shape[0], data.shape[1], dtype=np.int64)
+    expected = pyloudnorm_loudness(data, lengths)
+    result = integrated_loudness(data)
+    finite = np.isfinite(expected)
+    assert np.array_equal(finite, np.isfinite(result))
+    assert np.abs(result[finite] - expected[finite]).max() < TOLERANCE_LU
+
+
+def test_normalize_loudness():
+    data, lengths = random_segments()
+    expected = pyloudnorm_loudness(data, lengths)
+    normalized = data.copy()
+    normalize_loudness(normalized, cfg.LOUDNESS_NORMALIZATION_DB, lengths)
+    for row, length in enumerate(lengths.tolist()):
+        if np.isfinite(expected[row]):
+            expected_data = pyloudnorm.normalize.loudness(data[row, :length], expected[row], cfg.LOUDNESS_NORMALIZATION_DB)
+            np.testing.assert_allclose(normalized[row, :length], expected_data, rtol=1e-4, atol=1e-7)
+        else:
+            np.testing.assert_array_equal(normalized[row, :length], data[row, :length])
+    loudness = pyloudnorm_loudness(normalized, lengths)
+    finite = np.isfinite(expected)
+    assert np.abs(loudness[finite] - cfg.LOUDNESS_NORMALIZATION_DB).max() < TOLERANCE_LU
+
+
+def test_normalize_segments():
+    data, lengths = random_segments()
+    expected = pyloudnorm_loudness(data, lengths)
+    segments = [data[row, :length].copy() for row, length in enumerate(lengths.tolist())]
+    normalize_segments(segments, cfg.LOUDNESS_NORMALIZATION_DB)
+    for row, segment in enumerate(segments):
+        if np.isfinite(expected[row]):
+            expected_data = pyloudnorm.normalize.loudness(data[row, :lengths[row]], expected[row], cfg.LOUDNESS_NORMALIZATION_DB)
+            np.testing.assert_allclose(segment, expected_data, rtol=1e-4, atol=1e-7)
+        else:
+            np.testing.assert_array_equal(segment, data[row, :lengths[row]])